@@ -1,10 +1,23 @@
 from utils import *
-from dbase import dbase
+from dbase import dbase, release_proxies, load_graph
 from redisstr import RedisStr
 from redislist import RedisList
 from redisdict import RedisDict
 from redisobj import RedisObject
 from redisset import RedisSet
+from sharded import ShardedRedisDict, ShardedRedisSet, ShardedRedisList
+from migrate import migrate_to_compact
+from codec import register_type, use_binary_codec, use_text_codec
+from dlock import RedisLock, lock_stats
+from batch import batch, primary_reads
+from nearcache import enable_near_cache, disable_near_cache, near_cache_stats
+from aio import AsyncProxy, gather
+from instrument import enable_instrumentation, disable_instrumentation, metrics, prometheus_text, LoggingSink
 
-__all__ = ["RedisClientPool","enable_debug", "disable_debug", "dbase", 
-	"RedisStr", "RedisDict", "RedisSet", "RedisList", "RedisObject"]
+__all__ = ["RedisClientPool","enable_debug", "disable_debug", "dbase", "release_proxies", "load_graph",
+	"RedisStr", "RedisDict", "RedisSet", "RedisList", "RedisObject", "migrate_to_compact",
+	"ShardedRedisDict", "ShardedRedisSet", "ShardedRedisList",
+	"register_type", "use_binary_codec", "use_text_codec", "CodecInUse",
+	"RedisLock", "lock_stats", "LockTimeout", "batch", "primary_reads",
+	"enable_near_cache", "disable_near_cache", "near_cache_stats", "AsyncProxy", "gather",
+	"enable_instrumentation", "disable_instrumentation", "metrics", "prometheus_text", "LoggingSink"]
@@ -0,0 +1,81 @@
+import threading
+import operator
+from multiprocessing.pool import ThreadPool
+
+DEFAULT_WORKERS = 32
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPool(DEFAULT_WORKERS)
+        return _executor
+
+def set_workers(workers):
+    """ Replace the thread pool running asynchronous calls with one of workers
+    threads, calls already submitted still complete on the old pool.
+    """
+    global _executor
+    with _executor_lock:
+        old, _executor = _executor, ThreadPool(workers)
+    if old is not None:
+        old.close()
+
+def submit(func, *args, **kwargs):
+    # runs func in the thread pool, returns an AsyncResult
+    return get_executor().apply_async(func, args, kwargs)
+
+def gather(results, timeout=None):
+    # waits for a list of AsyncResults, returns their values in order
+    return [r.get(timeout) for r in results]
+
+# operations without a method name of their own, called with the object first
+OPERATIONS = {
+    "get": operator.getitem,
+    "set": operator.setitem,
+    "delete": operator.delitem,
+    "contains": operator.contains,
+    "len": len,
+    "getattr": getattr,
+    "setattr": setattr,
+}
+
+class AsyncProxy(object):
+    """ Runs the operations of a dmem object in a thread pool. Each call returns
+    a multiprocessing AsyncResult right away (get(timeout), ready(), wait()), so
+    the round trips of many calls overlap, on as many connections as needed:
+    >>> alist = AsyncProxy(mylist)
+    >>> pending = [alist.get(i) for i in range(100)]
+    >>> values = gather(pending)
+    Besides the object's own methods (append, update, _load, ...), the proxy has
+    get/set/delete/contains/len for the item operators and getattr/setattr for
+    RedisObject attributes.
+    Calls run in other threads, so they are not part of the caller's batch().
+    """
+    def __init__(self, obj):
+        self.__dict__['_obj_'] = obj
+
+    def __getattr__(self, name):
+        obj = self._obj_
+        if name in OPERATIONS:
+            op = OPERATIONS[name]
+            return lambda *args: submit(op, obj, *args)
+        method = getattr(obj, name)
+        if not callable(method):
+            raise AttributeError("%s is not a method of %s" % (name, type(obj).__name__))
+        return lambda *args, **kwargs: submit(method, *args, **kwargs)
+
+    def for_each(self, func, **kwargs):
+        """ Stream the object in the thread pool, calling func on each item
+        (keys for dicts), returns an AsyncResult completed after the last one.
+        kwargs are passed to the object's iterate/iterkeys.
+        """
+        obj = self._obj_
+        iterate = getattr(obj, "iterate", None) or obj.iterkeys
+        def run():
+            for item in iterate(**kwargs):
+                func(item)
+        return submit(run)
@@ -0,0 +1,115 @@
+import threading
+import contextlib
+
+_local = threading.local()
+
+def current_batch():
+    return getattr(_local, "batch", None)
+
+class _ReadPins(object):
+    # the read pins of a thread, a lock can be released by another thread
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+def reads_pinned():
+    # reads go to the primaries, not replicas, inside batch(), while a lock is
+    # held and inside primary_reads()
+    if current_batch() is not None:
+        return True
+    pins = getattr(_local, "pins", None)
+    return pins is not None and pins.count > 0
+
+def pin_reads():
+    """ Pins the reads of this thread to the primaries, returns the pin to pass
+    to unpin_reads(), which can be called from any thread.
+    """
+    pins = getattr(_local, "pins", None)
+    if pins is None:
+        pins = _local.pins = _ReadPins()
+    with pins.lock:
+        pins.count += 1
+    return pins
+
+def unpin_reads(pins):
+    with pins.lock:
+        pins.count -= 1
+
+@contextlib.contextmanager
+def primary_reads():
+    pins = pin_reads()
+    try:
+        yield
+    finally:
+        unpin_reads(pins)
+
+def keep_reads_pinned(func):
+    """ func as it has to run in another thread, with the reads pinned to the
+    primaries if they are in the calling thread: pool threads don't share its pins.
+    """
+    if not reads_pinned():
+        return func
+    def pinned(*args, **kwargs):
+        with primary_reads():
+            return func(*args, **kwargs)
+    return pinned
+
+class batch(object):
+    """ Buffers the mutations of all dmem objects made in the block, and sends
+    them with one pipeline per node when the block exits:
+    >>> with batch():
+    ...     mydict["a"] = 1
+    ...     mylist.append(2)
+    With transaction=True each node's pipeline runs as MULTI/EXEC.
+    Operations that need a reply (reads, pop, ...) run immediately. In a plain batch
+    they first send the writes already buffered for their node, so they see them;
+    in a transactional batch they see the state from before the batch.
+    If the block raises, the buffered mutations are discarded, but loaded()
+    caches will have seen them. Nested batches join the outermost one.
+    """
+    def __init__(self, transaction=False):
+        self.transaction = transaction
+        self.pipelines = {}
+        self.outer = None
+
+    def pipeline_for(self, node, client):
+        pipe = self.pipelines.get(node)
+        if pipe is None:
+            pipe = self.pipelines[node] = client.pipeline(transaction=self.transaction)
+        return pipe
+
+    def has_pending(self, node):
+        return node in self.pipelines
+
+    def flush_node(self, node):
+        pipe = self.pipelines.pop(node, None)
+        if pipe is not None:
+            with pipe:
+                return pipe.execute()
+
+    def flush(self):
+        # returns the replies of each node's pipeline
+        results = {}
+        for node in self.pipelines.keys():
+            results[node] = self.flush_node(node)
+        return results
+
+    def discard(self):
+        for pipe in self.pipelines.itervalues():
+            pipe.reset()
+        self.pipelines = {}
+
+    def __enter__(self):
+        self.outer = current_batch()
+        if self.outer is None:
+            _local.batch = self
+        return self.outer or self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.outer is not None:
+            return
+        _local.batch = None
+        if exc_type is None:
+            self.flush()
+        else:
+            self.discard()
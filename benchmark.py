@@ -0,0 +1,511 @@
+""" Benchmarks for dmem, to be run against a local, otherwise idle redis-server:
+
+    python benchmark.py [--host H] [--port P] [--server PATH] [--sizes 100,10000]
+                        [--repeat N] [--bulk-items N] [--json FILE] [benchmark names...]
+
+With --server, a throwaway redis-server is started from PATH on a free port and
+stopped at the end, --host and --port are ignored.
+Most benchmarks report the number of commands the server processed (from INFO
+stats). The "ops" benchmark covers each public method of the five containers at
+every size in --sizes, reporting ops/sec, p50/p99 latency and the round trips
+per call, counted by the instrumentation. The "bulk" benchmark builds containers
+of --bulk-items items from generators, at several bulk write chunk sizes, and
+"surgery" times list operations rewriting the middle of 10k to 1M item lists,
+"index" compares lookups in lists with and without indexed=True and "sort" times
+sorting lists of ints, mixed items and dicts by a field. "graph" loads a document
+three levels deep one object at a time, with load_graph() and with loaded(depth=3).
+--json writes all results to FILE, to compare revisions.
+"""
+import sys, time, random
+import threading
+import argparse
+import json
+import socket
+import subprocess
+import os
+import redis
+from utils import RedisClientPool
+from redislist import RedisList
+from redisdict import RedisDict
+from redisset import RedisSet
+from redisstr import RedisStr
+from redisobj import RedisObject
+from dbase import load_graph
+from batch import batch
+import codec
+import nearcache
+import instrument
+import utils
+
+SIZES = [100, 10000]
+REPEAT = 200            # calls per operation
+BULK_ITEMS = 1000000    # items touched per operation that reads the whole container
+BULK_LOAD_ITEMS = 1000000   # items per container of the bulk load benchmark
+LIST_SURGERY_SIZES = [10000, 100000, 1000000]
+RESULTS = []
+
+def commands_processed(client):
+    return client.info("stats")["total_commands_processed"]
+
+def measure(client, func):
+    # returns (seconds, commands processed by the server) for one call of func
+    before = commands_processed(client)
+    start = time.time()
+    func()
+    elapsed = time.time() - start
+    # the INFO call itself is counted too
+    return elapsed, commands_processed(client) - before - 1
+
+def memory_usage(client, *keys):
+    total = 0
+    for key in keys:
+        total += client.execute_command("MEMORY", "USAGE", key) or 0
+    return total
+
+def report(name, **fields):
+    RESULTS.append(dict(fields, name=name))
+    print "%-40s %s" % (name, "  ".join("%s=%s" % (k, fields[k]) for k in sorted(fields)))
+
+def bench_compact_encoding(n=10000):
+    for compact in (False, True):
+        label = "compact" if compact else "typed"
+        l = RedisList(compact=compact)
+        elapsed, cmds = measure(l.client, lambda: [l.append(i) for i in xrange(n)])
+        keys = [k for k in (l._addr_, l._type_addr_) if l.client.exists(k)]
+        report("list append x%d (%s)" % (n, label), secs="%.3f" % elapsed,
+               cmds_per_op="%.2f" % (float(cmds)/n), keys=len(keys),
+               bytes=memory_usage(l.client, *keys))
+        elapsed, cmds = measure(l.client, l._load)
+        report("list _load x%d (%s)" % (n, label), secs="%.3f" % elapsed, cmds=cmds)
+
+        d = RedisDict(compact=compact)
+        elapsed, cmds = measure(d.client, lambda: d.update(("k%d" % i, i) for i in xrange(n)))
+        keys = [k for k in (d._addr_, d._type_addr_) if d.client.exists(k)]
+        report("dict update x%d (%s)" % (n, label), secs="%.3f" % elapsed, cmds=cmds,
+               keys=len(keys), bytes=memory_usage(d.client, *keys))
+        elapsed, cmds = measure(d.client, d._load)
+        report("dict _load x%d (%s)" % (n, label), secs="%.3f" % elapsed, cmds=cmds)
+
+def bench_create(n=10000):
+    client = RedisClientPool.get_pool().get_client("bench")
+    objs = []
+    elapsed, cmds = measure(client, lambda: objs.extend(RedisDict() for i in xrange(n)))
+    report("create empty RedisDict x%d" % n, secs="%.3f" % elapsed,
+           cmds_per_op="%.3f" % (float(cmds)/n))
+
+def _legacy_encode(v):
+    # the isinstance chain used before the codec registry, kept for comparison
+    if isinstance(v, bool):
+        return "1" if v else "0", "bool"
+    atom_types = [(int, "int"), (long, "long"), (float, "float"), (basestring, "str")]
+    for atype, type_name in atom_types:
+        if isinstance(v, atype):
+            return str(v), type_name
+
+def _legacy_decode(obj, t):
+    # the if/elif chain used before the codec registry, kept for comparison
+    if t == "str":
+        return obj
+    elif t == "int":
+        return int(obj)
+    elif t == "long":
+        return long(obj)
+    elif t == "float":
+        return float(obj)
+    elif t == "bool":
+        return bool(int(obj))
+
+def bench_codec(n=200000):
+    values = [i*7919 for i in xrange(n/4)] + [i/3.0 for i in xrange(n/4)] + \
+             [i % 2 == 0 for i in xrange(n/4)] + ["s%d" % i for i in xrange(n/4)]
+    codecs = [("legacy", _legacy_encode, _legacy_decode, None),
+              ("text", codec.encode, codec.decode, codec.use_text_codec),
+              ("binary", codec.encode, codec.decode, codec.use_binary_codec)]
+    # the values are only encoded in memory, the containers of the other benchmarks keep working
+    for name, encode, decode, install in codecs:
+        if install:
+            install(force=True)
+        start = time.time()
+        pairs = [encode(v) for v in values]
+        encode_secs = time.time() - start
+        objs, types = zip(*pairs)
+        start = time.time()
+        if decode is codec.decode:
+            codec.decode_many(objs, types)
+        else:
+            [decode(obj, t) for obj, t in pairs]
+        decode_secs = time.time() - start
+        report("codec x%d (%s)" % (n, name), encode_secs="%.3f" % encode_secs,
+               decode_secs="%.3f" % decode_secs, bytes=sum(len(obj) for obj, t in pairs))
+    codec.use_text_codec(force=True)
+
+def bench_near_cache(n=1000, reads=10000):
+    d = RedisDict(("k%d" % i, i) for i in xrange(n))
+    keys = ["k%d" % (i % n) for i in xrange(reads)]
+    for enabled in (False, True):
+        if enabled:
+            nearcache.enable_near_cache()
+            d._load()
+        elapsed, cmds = measure(d.client, lambda: [d[k] for k in keys])
+        report("dict getitem x%d (near cache %s)" % (reads, "on" if enabled else "off"),
+               secs="%.3f" % elapsed, cmds=cmds, **nearcache.near_cache_stats())
+    nearcache.disable_near_cache()
+
+def bench_threads(ops=20000, thread_counts=(1, 2, 4, 8, 16)):
+    # the same number of operations split between more and more threads sharing
+    # the proxies, throughput grows while round trips are the bottleneck
+    d = RedisDict(("k%d" % i, i) for i in xrange(100))
+    l = RedisList(range(100))
+    def work(n):
+        for i in xrange(n):
+            d["k%d" % (i % 100)] = i
+            l[i % 100]
+    for count in thread_counts:
+        threads = [threading.Thread(target=work, args=(ops/2/count,)) for i in xrange(count)]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+        report("dict set + list get, %d threads" % count, secs="%.3f" % elapsed,
+               ops_per_sec="%.0f" % (ops/elapsed))
+
+def bench_bulk_load(chunk_sizes=(100, 1000, 10000)):
+    # containers built from generators of BULK_LOAD_ITEMS items, per chunk size
+    bulk_loads = [
+        ("list", lambda n: RedisList(xrange(n))),
+        ("list (compact)", lambda n: RedisList(xrange(n), compact=True)),
+        ("set", lambda n: RedisSet(xrange(n))),
+        ("dict", lambda n: RedisDict(("k%d" % i, i) for i in xrange(n))),
+    ]
+    instrument.enable_instrumentation()
+    try:
+        for chunk_size in chunk_sizes:
+            utils.set_bulk_chunk_size(chunk_size)
+            for type_name, make in bulk_loads:
+                created = []
+                before = instrument.metrics.round_trips
+                elapsed, cmds = measure(RedisClientPool.get_pool().get_client("bench"),
+                                        lambda: created.append(make(BULK_LOAD_ITEMS)))
+                report("%s bulk load x%d" % (type_name, BULK_LOAD_ITEMS), chunk_size=chunk_size,
+                       secs="%.3f" % elapsed, items_per_sec="%.0f" % (BULK_LOAD_ITEMS/elapsed),
+                       cmds=cmds, round_trips=instrument.metrics.round_trips - before)
+                created[0].destroy()
+    finally:
+        utils.set_bulk_chunk_size(utils.DEFAULT_BULK_CHUNK_SIZE)
+        instrument.disable_instrumentation()
+
+def bench_list_surgery(sizes=LIST_SURGERY_SIZES, calls=5):
+    # operations rewriting the middle of a list, their time should grow at most
+    # linearly with the size, and stay flat near the ends
+    operations = [
+        ("reverse", lambda l, n: l.reverse()),
+        ("insert middle", lambda l, n: l.insert(n / 2, "x")),
+        ("insert near head", lambda l, n: l.insert(10, "x")),
+        ("del middle", lambda l, n: l.__delitem__(n / 2)),
+        ("del near tail", lambda l, n: l.__delitem__(-10)),
+        ("del slice middle x100", lambda l, n: l.__delslice__(n / 2, n / 2 + 100)),
+        ("remove last", lambda l, n: l.remove(n - 1)),
+        # last, it shrinks the list
+        ("del slice middle x1/10", lambda l, n: l.__delslice__(n / 4, n / 4 + n / 10)),
+    ]
+    for size in sizes:
+        l = RedisList(xrange(size))
+        for name, op in operations:
+            latencies = []
+            for i in xrange(calls):
+                start = time.time()
+                op(l, size)
+                latencies.append(time.time() - start)
+            report("list %s" % name, size=size, calls=calls,
+                   ms_per_call="%.3f" % (sum(latencies) / calls * 1000))
+        l.destroy()
+
+def bench_list_index(sizes=LIST_SURGERY_SIZES, calls=5):
+    # membership, count and index() of a list with and without indexed=True
+    operations = [
+        ("contains missing", lambda l, n: -1 in l),
+        ("count", lambda l, n: l.count(n / 2)),
+        ("index last", lambda l, n: l.index(n - 1)),
+        ("append", lambda l, n: l.append(n)),
+    ]
+    for size in sizes:
+        for indexed in (False, True):
+            l = RedisList(xrange(size), indexed=indexed)
+            for name, op in operations:
+                start = time.time()
+                for i in xrange(calls):
+                    op(l, size)
+                report("list %s (%s)" % (name, "indexed" if indexed else "plain"), size=size,
+                       calls=calls, ms_per_call="%.3f" % ((time.time() - start) / calls * 1000))
+            l.destroy()
+
+def bench_list_sort(sizes=LIST_SURGERY_SIZES):
+    # sort() of shuffled lists, typed and compact
+    kinds = [
+        ("ints", lambda i: i),
+        ("mixed", lambda i: (i, float(i), str(i))[i % 3]),
+    ]
+    for size in sizes:
+        order = range(size)
+        random.shuffle(order)
+        for kind, make in kinds:
+            for compact in (False, True):
+                l = RedisList((make(i) for i in order), compact=compact)
+                start = time.time()
+                l.sort()
+                report("list sort %s (%s)" % (kind, "compact" if compact else "typed"), size=size,
+                       ms="%.1f" % ((time.time() - start) * 1000))
+                l.destroy()
+    size = min(sizes)
+    people = [RedisDict({"age": i % 100}) for i in xrange(size)]
+    l = RedisList(people)
+    start = time.time()
+    l.sort(by="age")
+    report("list sort by field", size=size, ms="%.1f" % ((time.time() - start) * 1000))
+    l.destroy()
+
+def bench_graph(sections=10, items=100):
+    # a dict of lists of dicts, sections*items objects at the third level
+    parts = [[RedisDict({"id": i, "name": "item %d" % i}) for i in xrange(items)]
+             for s in xrange(sections)]
+    lists = [RedisList(part) for part in parts]
+    doc = RedisDict(dict(("section %d" % s, l) for s, l in enumerate(lists)))
+    def one_by_one():
+        with doc.loaded() as d:
+            for l in d.values():
+                with l.loaded() as part:
+                    [item._load() for item in part]
+    def with_depth():
+        with doc.loaded(depth=3):
+            # the proxies of the tree are dropped on exit, one DECR each like any proxy
+            report("graph loaded(depth=3)", objects=sections*items,
+                   round_trips=instrument.metrics.round_trips - before,
+                   ms="%.1f" % ((time.time() - start) * 1000))
+    instrument.enable_instrumentation()
+    try:
+        for name, load in [("one by one", one_by_one), ("load_graph", lambda: load_graph(doc))]:
+            before = instrument.metrics.round_trips
+            start = time.time()
+            load()
+            report("graph %s" % name, objects=sections*items, round_trips=instrument.metrics.round_trips - before,
+                   ms="%.1f" % ((time.time() - start) * 1000))
+        before = instrument.metrics.round_trips
+        start = time.time()
+        with_depth()
+    finally:
+        instrument.disable_instrumentation()
+
+def percentile(sorted_values, p):
+    return sorted_values[int(round(p * (len(sorted_values) - 1)))]
+
+def time_calls(op, obj, calls):
+    # returns the latency of each call and the round trips they took in total
+    latencies = []
+    before = instrument.metrics.round_trips
+    for i in xrange(calls):
+        start = time.time()
+        op(obj, i)
+        latencies.append(time.time() - start)
+    return latencies, instrument.metrics.round_trips - before
+
+def _make_object(size):
+    o = RedisObject()
+    with batch():
+        for i in xrange(size):
+            setattr(o, "a%d" % i, i)
+    return o
+
+def _other_set(s):
+    # the operand of the set operations, on s's node so the same-node path is timed
+    return RedisSet(range(0, 200, 2), node=s._node_)
+
+def _loaded(obj, i):
+    with obj.loaded():
+        pass
+
+# per container: how to build one of a size, and its operations as
+# (name, op(obj, i), whether the operation reads or moves the whole container).
+# Operations growing the container come before the ones shrinking it by as much.
+CONTAINER_OPERATIONS = [
+    ("list", lambda size: RedisList(range(size)), [
+        ("getitem", lambda l, i: l[i % l.size], False),
+        ("setitem", lambda l, i: l.__setitem__(i % l.size, i), False),
+        ("len", lambda l, i: len(l), False),
+        ("getslice", lambda l, i: l[i % l.size:i % l.size + 10], False),
+        ("contains", lambda l, i: l.size - 1 in l, True),
+        ("index", lambda l, i: l.index(l.size - 1), True),
+        ("count", lambda l, i: l.count(i), True),
+        ("append", lambda l, i: l.append(i), False),
+        ("pop", lambda l, i: l.pop(), False),
+        ("lpush", lambda l, i: l.lpush(i), False),
+        ("lpop", lambda l, i: l.lpop(), False),
+        ("extend", lambda l, i: l.extend([i] * 10), False),
+        ("delslice", lambda l, i: l.__delslice__(l.size, l.size + 10), True),
+        ("insert", lambda l, i: l.insert(l.size / 2, i), True),
+        ("delitem", lambda l, i: l.__delitem__(l.size / 2), True),
+        ("remove", lambda l, i: l.remove(l.size - 1), True),
+        ("reverse", lambda l, i: l.reverse(), True),
+        ("sort", lambda l, i: l.sort(), True),
+        ("load", lambda l, i: l._load(), True),
+        ("iterate", lambda l, i: list(l.iterate()), True),
+        ("loaded", _loaded, True),
+    ]),
+    ("dict", lambda size: RedisDict(("k%d" % i, i) for i in xrange(size)), [
+        ("getitem", lambda d, i: d["k%d" % (i % d.size)], False),
+        ("setitem", lambda d, i: d.__setitem__("k%d" % (i % d.size), i), False),
+        ("contains", lambda d, i: "k%d" % (i % d.size) in d, False),
+        ("len", lambda d, i: len(d), False),
+        ("get", lambda d, i: d.get("k%d" % (i % d.size)), False),
+        ("setdefault", lambda d, i: d.setdefault("k%d" % (i % d.size), 0), False),
+        ("update", lambda d, i: d.update({"u%d" % i: i}), False),
+        ("delitem", lambda d, i: d.__delitem__("u%d" % i), False),
+        ("pop", lambda d, i: d.pop("k%d" % i), False),
+        ("keys", lambda d, i: d.keys(), True),
+        ("values", lambda d, i: d.values(), True),
+        ("items", lambda d, i: d.items(), True),
+        ("iteritems", lambda d, i: list(d.iteritems()), True),
+        ("copy", lambda d, i: d.copy(), True),
+        ("loaded", _loaded, True),
+    ]),
+    ("set", lambda size: RedisSet(range(size)), [
+        ("contains", lambda s, i: i in s, False),
+        ("len", lambda s, i: len(s), False),
+        ("add", lambda s, i: s.add(s.size + i), False),
+        ("discard", lambda s, i: s.discard(s.size + i), False),
+        ("update", lambda s, i: s.update([-i]), False),
+        ("pop", lambda s, i: s.pop(), False),
+        ("iterate", lambda s, i: list(s.iterate()), True),
+        ("union", lambda s, i: s | s.other, True),
+        ("intersection", lambda s, i: s & s.other, True),
+        ("difference", lambda s, i: s - s.other, True),
+        ("symmetric_difference", lambda s, i: s ^ s.other, True),
+        ("copy", lambda s, i: s.copy(), True),
+        ("loaded", _loaded, True),
+    ]),
+    ("str", lambda size: RedisStr("x" * size), [
+        ("getvalue", lambda s, i: s.getvalue(), False),
+        ("setvalue", lambda s, i: s.setvalue("y" * s.size), False),
+        ("len", lambda s, i: len(s), False),
+        ("getslice", lambda s, i: s[0:10], False),
+        ("iadd", lambda s, i: s.__iadd__("z"), False),
+        ("getitem", lambda s, i: s[i % s.size], True),
+        ("contains", lambda s, i: "zz" in s, True),
+    ]),
+    ("object", _make_object, [
+        ("getattr", lambda o, i: getattr(o, "a%d" % (i % o.size)), False),
+        ("setattr", lambda o, i: setattr(o, "a%d" % (i % o.size), i), False),
+        ("setattr_new", lambda o, i: setattr(o, "n%d" % i, i), False),
+        ("delattr", lambda o, i: delattr(o, "n%d" % i), False),
+        ("load", lambda o, i: o._load(), True),
+        ("loaded", _loaded, True),
+    ]),
+]
+
+def bench_operations():
+    instrument.enable_instrumentation()
+    try:
+        for type_name, make, operations in CONTAINER_OPERATIONS:
+            created = []
+            latencies, round_trips = time_calls(lambda size, i: created.append(make(size)), 1, REPEAT)
+            report("%s create" % type_name, size=1, calls=REPEAT, **op_stats(latencies, round_trips))
+            for size in SIZES:
+                obj = make(size)
+                # set through __dict__, RedisObject would store the attributes in redis
+                obj.__dict__["size"] = size
+                if type_name == "set":
+                    obj.__dict__["other"] = _other_set(obj)
+                for op_name, op, bulk in operations:
+                    calls = max(3, min(REPEAT, BULK_ITEMS / size)) if bulk else min(REPEAT, size / 2)
+                    latencies, round_trips = time_calls(op, obj, calls)
+                    report("%s %s" % (type_name, op_name), size=size, calls=calls,
+                           **op_stats(latencies, round_trips))
+    finally:
+        instrument.disable_instrumentation()
+
+def op_stats(latencies, round_trips):
+    ordered = sorted(latencies)
+    return {"ops_per_sec": round(len(latencies) / (sum(latencies) or 1e-9), 1),
+            "p50_ms": round(percentile(ordered, 0.5) * 1000, 3),
+            "p99_ms": round(percentile(ordered, 0.99) * 1000, 3),
+            "round_trips_per_call": round(float(round_trips) / len(latencies), 2)}
+
+# (name, function, whether it needs a redis-server)
+BENCHMARKS = [
+    ("compact", bench_compact_encoding, True),
+    ("create", bench_create, True),
+    ("codec", bench_codec, False),
+    ("nearcache", bench_near_cache, True),
+    ("threads", bench_threads, True),
+    ("bulk", bench_bulk_load, True),
+    ("surgery", bench_list_surgery, True),
+    ("index", bench_list_index, True),
+    ("sort", bench_list_sort, True),
+    ("graph", bench_graph, True),
+    ("ops", bench_operations, True),
+]
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def start_redis_server(path, timeout=10):
+    # a redis-server without persistence on a free port, returns (process, port)
+    port = free_port()
+    devnull = open(os.devnull, "w")
+    process = subprocess.Popen([path, "--port", str(port), "--save", "", "--appendonly", "no"],
+                               stdout=devnull, stderr=devnull)
+    client = redis.StrictRedis(port=port)
+    deadline = time.time() + timeout
+    while True:
+        try:
+            client.ping()
+            return process, port
+        except redis.ConnectionError:
+            if process.poll() is not None or time.time() > deadline:
+                process.kill()
+                raise
+            time.sleep(0.05)
+
+def main(argv):
+    global SIZES, REPEAT, BULK_LOAD_ITEMS
+    parser = argparse.ArgumentParser(description="dmem benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--server", help="start a throwaway redis-server from this path")
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)),
+                        help="container sizes of the ops benchmark, e.g. 100,10000,1000000")
+    parser.add_argument("--repeat", type=int, default=REPEAT, help="calls per operation")
+    parser.add_argument("--bulk-items", type=int, default=BULK_LOAD_ITEMS,
+                        help="items per container of the bulk benchmark")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("names", nargs="*", help="benchmarks to run, all by default")
+    args = parser.parse_args(argv[1:])
+    SIZES = [int(float(size)) for size in args.sizes.split(",")]
+    REPEAT = args.repeat
+    BULK_LOAD_ITEMS = args.bulk_items
+    benchmarks = [b for b in BENCHMARKS if not args.names or b[0] in args.names]
+    server = None
+    try:
+        if any(needs_redis for name, bench, needs_redis in benchmarks):
+            host, port = args.host, args.port
+            if args.server:
+                server, port = start_redis_server(args.server)
+                host = "127.0.0.1"
+            RedisClientPool.get_pool().load_config({"bench": {"host": host, "port": port, "db": 0}})
+        for name, bench, needs_redis in benchmarks:
+            bench()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"sizes": SIZES, "repeat": REPEAT, "results": RESULTS}, f, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,153 @@
+import struct
+from itertools import izip
+from utils import *
+
+# A value is stored as a string plus the name of its type. Encoders are looked up
+# by the python type of the value (then along its MRO), decoders by the type name.
+_encoders = {}
+_resolved_encoders = {}
+_decoders = {}
+
+# short tags used by the compact "tag#value" encoding, types without a tag use their name
+TYPE_TAGS = {
+    "str": "s", "int": "i", "long": "l", "float": "f", "bool": "b",
+    "bint": "I", "bfloat": "F", "bbool": "B",
+    "dmem:str": "S", "dmem:list": "L", "dmem:dict": "D", "dmem:set": "T", "dmem:object": "O",
+    "dmem:list:c": "cL", "dmem:dict:c": "cD", "dmem:object:c": "cO",
+    "dmem:list:i": "iL", "dmem:list:c:i": "ciL",
+}
+TAG_TYPES = dict((tag, t) for t, tag in TYPE_TAGS.items())
+
+# set by dbase once a dmem object was created or read in this process, the codec
+# can't be switched after that, see use_binary_codec()
+_objects_exist = False
+
+def register_encoder(pytype, encoder):
+    """ encoder(v) returns the (string, type name) pair to store for v """
+    _encoders[pytype] = encoder
+    _resolved_encoders.clear()
+
+def register_decoder(type_name, decoder):
+    """ decoder(s) returns the value stored as s with type type_name """
+    _decoders[type_name] = decoder
+
+def register_type(pytype, type_name, encode, decode, tag=None):
+    """ Make values of a user type storable in dmem containers:
+    encode(v) returns a string and decode(s) turns it back into a value.
+    >>> register_type(complex, "complex", repr, lambda s: complex(s.strip("()")))
+    >>> RedisList([1+2j])[0]
+    (1+2j)
+    """
+    register_encoder(pytype, lambda v: (encode(v), type_name))
+    register_decoder(type_name, decode)
+    if tag:
+        TYPE_TAGS[type_name] = tag
+        TAG_TYPES[tag] = type_name
+
+def _resolve_encoder(pytype):
+    for klass in pytype.__mro__:
+        if klass in _encoders:
+            _resolved_encoders[pytype] = _encoders[klass]
+            return _encoders[klass]
+    raise RedisNestedTypeError("Nested type should either be an atomic type (int, float, str, etc) or a Redis Type")
+
+def encode(v):
+    try:
+        encoder = _resolved_encoders[type(v)]
+    except KeyError:
+        encoder = _resolve_encoder(type(v))
+    return encoder(v)
+
+def decode(obj, t):
+    decoder = _decoders.get(t)
+    if decoder is None:
+        return None
+    return decoder(obj)
+
+def decode_many(objs, types):
+    """ decode parallel lists of strings and type names, faster than decode() in a loop """
+    decoders = _decoders
+    try:
+        return [decoders[t](obj) for obj, t in izip(objs, types)]
+    except KeyError:
+        # some type has no decoder, decode one by one so those come back as None
+        return [decode(obj, t) for obj, t in izip(objs, types)]
+
+def tag_object(obj, t):
+    return TYPE_TAGS.get(t, t) + "#" + obj
+
+def untag_object(tagged):
+    if tagged is None:
+        return None, None
+    split_at = tagged.index("#")
+    tag = tagged[:split_at]
+    return tagged[split_at+1:], TAG_TYPES.get(tag, tag)
+
+def split_tagged_objects(tagged_list):
+    objs, types = [], []
+    for tagged in tagged_list:
+        obj, t = untag_object(tagged)
+        objs.append(obj)
+        types.append(t)
+    return objs, types
+
+def split_tagged_dict(tagged_dict):
+    objdict, tdict = {}, {}
+    for key, tagged in tagged_dict.iteritems():
+        objdict[key], tdict[key] = untag_object(tagged)
+    return objdict, tdict
+
+def _check_codec_switch(force):
+    if _objects_exist and not force:
+        raise CodecInUse("The codec has to be chosen before any dmem object is created or read")
+
+# text codec, the default
+def use_text_codec(force=False):
+    """ Store ints, floats and bools as text, the default. Like use_binary_codec(),
+    it has to be called before any dmem object is created or read.
+    """
+    _check_codec_switch(force)
+    register_encoder(bool, lambda v: ("1" if v else "0", "bool"))
+    register_encoder(int, lambda v: (str(v), "int"))
+    register_encoder(long, lambda v: (str(v), "long"))
+    register_encoder(float, lambda v: (str(v), "float"))
+
+register_encoder(basestring, lambda v: (v, "str"))
+register_decoder("str", str)
+register_decoder("int", int)
+register_decoder("long", long)
+register_decoder("float", float)
+register_decoder("bool", "0".__ne__)
+use_text_codec()
+
+# binary codec: ints are packed big-endian into the fewest of 1, 2, 4 or 8 bytes,
+# floats into 8 bytes, bools into one byte
+_INT_STRUCTS = [struct.Struct(">b"), struct.Struct(">h"), struct.Struct(">i"), struct.Struct(">q")]
+_INT_STRUCT_BY_SIZE = dict((s.size, s) for s in _INT_STRUCTS)
+_INT_LIMITS = [(-(1 << (s.size*8-1)), (1 << (s.size*8-1)) - 1, s) for s in _INT_STRUCTS]
+_FLOAT_STRUCT = struct.Struct(">d")
+
+def _encode_bint(v):
+    for low, high, s in _INT_LIMITS:
+        if low <= v <= high:
+            return s.pack(v), "bint"
+    return str(v), "long"
+
+def use_binary_codec(force=False):
+    """ Store ints, floats and bools packed, which is smaller and faster to decode
+    than their text form. Note that packed numbers can't be used by SORT or INCR on
+    the server. The codec has to be chosen before any data is written: values
+    stored with the text codec still decode, but lookups compare encoded values,
+    so `1 in l`, count(), index(), remove() and set membership miss them, and a
+    set can end up holding 1 twice. CodecInUse is raised once a dmem object was
+    created or read in this process, unless force is True, e.g. for values that
+    are only encoded in memory.
+    """
+    _check_codec_switch(force)
+    register_encoder(bool, lambda v: ("\x01" if v else "\x00", "bbool"))
+    register_encoder(int, _encode_bint)
+    register_encoder(float, lambda v: (_FLOAT_STRUCT.pack(v), "bfloat"))
+
+register_decoder("bint", lambda obj: _INT_STRUCT_BY_SIZE[len(obj)].unpack(obj)[0])
+register_decoder("bfloat", lambda obj: _FLOAT_STRUCT.unpack(obj)[0])
+register_decoder("bbool", lambda obj: obj == "\x01")
@@ -1,26 +1,51 @@
-from utils import RedisClientPool
+from utils import RedisClientPool, chunked
+from codec import *
+from dlock import *
+import codec
+from nearcache import get_near_cache
+from batch import primary_reads, current_batch, keep_reads_pinned
+from aio import submit, gather
 import random, string
+import itertools
+import threading
+import contextlib
 
 REF_PREFIX  = "_ref_"
-LOCK_PREFIX = "_lock_"
-
-UNLOCK_LUA_SCRIPT = """
-    if redis.call("get", KEYS[1]) == ARGV[1] then
-        return redis.call("del",KEYS[1])
-    else
-        return 0
-    end
-"""
+# incremented by every mutation of the object, to tell if a loaded() copy is stale
+VERSION_PREFIX = "_ver_"
+
+# compact containers store "tag#value" inline instead of a parallel _type_ structure,
+# their type name carries this suffix so references know how to read them
+COMPACT_SUFFIX = ":c"
+# lists created with indexed=True keep a count of each value in a hash next to
+# them, their type name carries this suffix too
+INDEXED_SUFFIX = ":i"
+INDEX_PREFIX = "_idx_"
+
+# bulk writes outside a batch send a pipeline every this many chunks
+PIPELINE_CHUNKS = 16
+# items per command of the Lua scripts copying containers, unpack() is limited
+# to a few thousand values
+SCRIPT_CHUNK_SIZE = 1000
+
+# proxies materialized inside batched_refcounts(), per thread
+_refcnt_batch = threading.local()
+
 class dbase(object):
-    def __init__(self):
-        # first choose a node randomly
+    _compact_ = False
+    _released_ = False
+
+    def __init__(self, compact=False, node=None):
+        # first choose a node, randomly unless given
         poll = RedisClientPool.get_pool()
         node_names = poll.names
-        self._node_ = random.choice(node_names)
+        self._node_ = node or random.choice(node_names)
         self.client = poll.get_client(self._node_)
-        # then pick a random address for the object
+        self._compact_ = compact
+        # then allocate an address for the object
         self._addr_ = self.get_a_valid_redis_addr()
         self.initialize()
+        codec._objects_exist = True
 
     def initialize(self): # initialization specific to each subtype
         pass
@@ -28,15 +53,41 @@ class dbase(object):
     def addr(self):
         return self._addr_
 
+    def _thread_state(self):
+        # what loaded() keeps, separately for each thread sharing the proxy
+        # set through __dict__, RedisObject would store the attribute in redis
+        state = self.__dict__.get('_local_')
+        if state is None:
+            state = self.__dict__.setdefault('_local_', threading.local())
+        return state
+
+    @property
+    def cache(self):
+        # the copy loaded() took in this thread, other threads keep reading redis
+        return getattr(self._thread_state(), "cache", None)
+
+    @cache.setter
+    def cache(self, value):
+        self._thread_state().cache = value
+
     @classmethod
-    def _from_addr(cls, addr):
+    def _from_addr(cls, addr, compact=False, indexed=False):
         obj = cls.__new__(cls)
+        obj._compact_ = compact
+        if indexed:
+            # only lists are indexed, RedisObject would store the attribute in redis
+            obj.__dict__['_indexed_'] = True
         obj._addr_ = addr
         obj._node_ = cls.get_node_from_addr(addr)
         obj.client = RedisClientPool.get_pool().get_client(obj._node_)
         obj.initialize()
+        codec._objects_exist = True
         # when instantiate a redis object from address, increment the counter
-        obj._incr_refcnt() 
+        proxies = getattr(_refcnt_batch, "proxies", None)
+        if proxies is None:
+            obj._incr_refcnt()
+        else:
+            proxies.append(obj)
         return obj
 
     @classmethod
@@ -54,12 +105,8 @@ class dbase(object):
         return True
 
     def get_a_valid_redis_addr(self):
-        while True:
-            key = ''.join([random.choice(string.digits+string.lowercase) for i in range(10)])
-            presence_key = REF_PREFIX + self._node_  +":" + key
-            present = self.client.getset(presence_key, 1)
-            if not present:
-                return self._node_ + ":" + key
+        # addresses are unique per node, no need to check for collisions
+        return RedisClientPool.get_pool().get_allocator(self._node_).allocate()
 
     def _incr_refcnt(self):
         presence_key = REF_PREFIX + self._addr_
@@ -67,70 +114,424 @@ class dbase(object):
 
     def __del__(self):
         # This implements a reference couting on redis, each reference represents a node using the object
-        # when the counter reaches 0, the redis key is removed
-        # also the presence key is open for address allocation
+        # The counter holds the references besides the one of the creating proxy, so that
+        # creating an object doesn't need to write it. When it drops below 0 the redis key is removed
+        if self._released_:
+            return
         presence_key = REF_PREFIX + self._addr_
         refcnt = self.client.decr(presence_key)
-        if not refcnt:
+        if self._unreferenced(refcnt):
             self.destroy()
 
+    def _unreferenced(self, refcnt):
+        # whether no proxy is left once the counter is down to refcnt. Objects created
+        # before addresses were allocated, with a random key without "-", also counted
+        # the creating proxy, they are removed when it reaches 0 as they used to be
+        if "-" not in self._addr_.split(":", 1)[1]:
+            return refcnt <= 0
+        return refcnt < 0
+
     def destroy(self):
         # should be overrided if subclass needs to destroy other keys
-        self.client.delete(self._addr_)
+        self.client.delete(self._addr_, REF_PREFIX + self._addr_, VERSION_PREFIX + self._addr_)
+        self._invalidate()
+
+    def _near_cached(self, loader):
+        # loader() reads the raw content of the object, with the near cache enabled
+        # it's kept across calls until the object changes
+        cache = get_near_cache()
+        if cache is None:
+            return loader()
+        raw = cache.get(self._addr_)
+        if raw is None:
+            token = cache.begin_load(self._addr_)
+            # invalidations come from the primary, a lagging replica could be cached for good
+            with primary_reads():
+                raw = loader()
+            cache.put(self._addr_, raw, token)
+        return raw
+
+    def _near_cache_entry(self):
+        # the raw content of the object if it's in the near cache, else None
+        cache = get_near_cache()
+        if cache is None:
+            return None
+        return cache.get(self._addr_)
+
+    def _invalidate(self):
+        cache = get_near_cache()
+        if cache is not None:
+            cache.invalidate(self._addr_)
+
+    def _encode(self, v):
+        # returns (obj, t) to store for v, compact objects fold the type into obj
+        obj, t = get_redis_object_and_type(v)
+        if self._compact_:
+            return tag_object(obj, t), None
+        return obj, t
+
+    def _reader(self):
+        # the client reads of this object go to, a replica of its node if it has any
+        return self.client.reader(self._addr_)
+
+    def _script_keys(self):
+        return [self._addr_] if self._compact_ else [self._addr_, self._type_addr_]
+
+    def _run_script(self, script, *args, **kwargs):
+        # runs a script taking the keys of _script_keys(): the value key and, unless
+        # compact, the type key (then the index hash of indexed lists),
+        # on the client or pipeline passed as pipe if any. Scripts that only read
+        # pass readonly=True, they may run on a replica
+        keys = self._script_keys()
+        client = kwargs.get("pipe") or (self._reader() if kwargs.get("readonly") else self.client)
+        return script(client, keys, args)
+
+    @contextlib.contextmanager
+    def _pipeline(self):
+        """ The pipeline mutations are queued in. Inside dmem.batch() that's the
+        batch's pipeline for this node, sent when the batch exits, otherwise a new
+        pipeline sent when the block exits.
+        """
+        self._invalidate()
+        batch = current_batch()
+        if batch is not None:
+            pipe = batch.pipeline_for(self._node_, self.client)
+            yield pipe
+            self._bump_version(pipe)
+        else:
+            with self.client.pipeline() as pipe:
+                yield pipe
+                self._bump_version(pipe)
+                pipe.execute()
+            # a read may have cached the old content while the pipeline was sent
+            self._invalidate()
+
+    def _pipeline_chunks(self, items, queue):
+        """ Bulk write of items, an iterable consumed lazily: queue(pipe, chunk)
+        queues the commands writing a list of at most BULK_CHUNK_SIZE items.
+        Outside a batch, a pipeline is sent every PIPELINE_CHUNKS chunks, so
+        items can be a generator of any length; each pipeline is applied on its
+        own, other clients may see the write half done.
+        """
+        if current_batch() is not None:
+            with self._pipeline() as pipe:
+                for chunk in chunked(items):
+                    queue(pipe, chunk)
+            return
+        for chunks in chunked(chunked(items), PIPELINE_CHUNKS):
+            with self._pipeline() as pipe:
+                for chunk in chunks:
+                    queue(pipe, chunk)
+
+    def _bump_version(self, pipe):
+        # queued after the commands of each mutation
+        pipe.incr(VERSION_PREFIX + self._addr_)
+        self.client.record_write(self._addr_)
+
+    def version(self):
+        # the number of mutations made to the object so far
+        return int(self.client.get(VERSION_PREFIX + self._addr_) or 0)
 
-    def lock(self, ttl=6):
-        # add a distributed lock on redis for this object
-        lock_key = LOCK_PREFIX + self._addr_
-        self._lockval = ''.join([random.choice(string.digits+string.lowercase) for i in range(6)])
-        while True:
-            result = self.client.set(lock_key, self._lockval, nx=True, px=ttl)
-            if result:
-                return 
+    @contextlib.contextmanager
+    def loaded(self, depth=1):
+        """ Load the object once and keep the copy for the block, reads in this
+        thread are served from it and writes update both redis and the copy.
+        With depth > 1, the objects it references are loaded too, that many levels
+        deep in total (None for the whole graph), each level with one pipeline per
+        node, and their proxies in the copy are loaded() for the block as well:
+        >>> with doc.loaded(depth=3) as d:
+        ...     d["sections"][0]["title"]
+        """
+        if depth != 1:
+            with _loaded_graph(self, depth) as cache:
+                yield cache
+            return
+        self.cache = self._load_snapshot()
+        try:
+            yield self.cache
+        finally:
+            self.cache = None
+
+    def _load_snapshot(self):
+        # the copy loaded() keeps, with the version it was taken at. The version is
+        # read first, so a write racing with the load only causes an extra reload
+        self._thread_state().version = self.version()
+        return self._load()
+
+    def refresh_if_stale(self):
+        """ Inside loaded(), reload the local copy if the object was changed since
+        it was taken, which costs a single GET when it wasn't. The copy is updated
+        in place. Returns True if it was reloaded.
+        >>> with mylist.loaded() as items:
+        ...     mylist.refresh_if_stale()
+        False
+        """
+        if self.cache is None:
+            return False
+        version = self.version()
+        if version == getattr(self._thread_state(), "version", None):
+            return False
+        self._thread_state().version = version
+        fresh = self._load()
+        if isinstance(self.cache, basestring):
+            self.cache = fresh
+        elif isinstance(self.cache, list):
+            self.cache[:] = fresh
+        else:
+            self.cache.clear()
+            self.cache.update(fresh)
+        return True
+
+    def locked(self, lease=DEFAULT_LEASE, auto_renew=True, notify=False, timeout=None):
+        """ A distributed lock on redis for this object, to be used as
+        >>> with obj.locked():
+        ...     obj.x += 1
+        See RedisLock for the parameters, lock_stats records the time spent waiting.
+        """
+        return RedisLock(self.client, LOCK_PREFIX + self._addr_, lease=lease,
+                         auto_renew=auto_renew, notify=notify, timeout=timeout)
+
+    def lock(self, ttl=DEFAULT_LEASE*1000, **kwargs):
+        # add a distributed lock on redis for this object, ttl is in milliseconds
+        # the lease is kept per thread, threads sharing the proxy lock it in turn
+        kwargs.setdefault("auto_renew", False)
+        lock = self._thread_state().lock = self.locked(lease=ttl/1000.0, **kwargs)
+        lock.acquire()
 
     def unlock(self):
-        lock_key = LOCK_PREFIX + self._addr_
-        self.client.eval(UNLOCK_LUA_SCRIPT, 1, lock_key, self._lockval)
-
-def get_redis_object_and_type(v):    
-    if isinstance(v, bool):
-        return "1" if v else "0", "bool"
-    atom_types = [(int, "int"), (long, "long"), (float, "float"), (basestring, "str")]
-    for atype, type_name in atom_types:
-        if isinstance(v, atype):
-            return str(v), type_name
-    if isinstance(v, dbase):        
-        return v.addr(), v._type_
+        state = self._thread_state()
+        lock, state.lock = state.lock, None
+        lock.release()
+
+register_encoder(dbase, lambda v: (v.addr(), v._type_))
+
+def _update_refcnts(proxies, delta):
+    # one pipelined INCRBY per node, returns the new counts in the order of proxies
+    by_node = {}
+    for i, proxy in enumerate(proxies):
+        by_node.setdefault(proxy._node_, []).append(i)
+    refcnts = [None] * len(proxies)
+    for node, indexes in by_node.iteritems():
+        with RedisClientPool.get_pool().get_client(node).pipeline(transaction=False) as pipe:
+            for i in indexes:
+                pipe.incrby(REF_PREFIX + proxies[i]._addr_, delta)
+            for i, refcnt in zip(indexes, pipe.execute()):
+                refcnts[i] = refcnt
+    return refcnts
+
+@contextlib.contextmanager
+def batched_refcounts():
+    """ Proxies materialized from addresses inside the block get their reference
+    counts incremented together on exit, with one pipeline per node, instead of
+    one INCR round trip each.
+    """
+    if getattr(_refcnt_batch, "proxies", None) is not None:
+        # nested, the outermost block sends the increments
+        yield
+        return
+    _refcnt_batch.proxies = []
+    try:
+        yield
+    finally:
+        proxies, _refcnt_batch.proxies = _refcnt_batch.proxies, None
+        if proxies:
+            _update_refcnts(proxies, 1)
+
+@contextlib.contextmanager
+def collected_proxies():
+    # proxies materialized from addresses inside the block are appended to the
+    # list it yields, counting their references is left to the caller
+    outer = getattr(_refcnt_batch, "proxies", None)
+    _refcnt_batch.proxies = collected = []
+    try:
+        yield collected
+    finally:
+        _refcnt_batch.proxies = outer
+
+def _node_reader(node, objs, increments):
+    # (reader, objs, increments) for reading objs on node, picked in the caller's
+    # thread, which holds the batch and the read pins
+    client = RedisClientPool.get_pool().get_client(node)
+    reader = client
+    for obj in objs:
+        reader = client.reader(obj._addr_)
+        if reader is client:
+            break
+    if increments and reader is not client:
+        # the replica reading the objects can't take the increments
+        _update_refcnts(increments, 1)
+        increments = []
+    return reader, objs, increments
+
+def _read_node_level(reader, objs, increments):
+    # the replies of one node's pipeline: increments of the reference counts of
+    # the proxies in increments, then the version and content of each of objs
+    with reader.pipeline(transaction=False) as pipe:
+        for proxy in increments:
+            pipe.incr(REF_PREFIX + proxy._addr_)
+        for obj in objs:
+            pipe.get(VERSION_PREFIX + obj._addr_)
+            obj._queue_load(pipe)
+        return pipe.execute()[len(increments):]
+
+def _read_level(objs, increments):
+    """ Reads a level of the graph, sending one pipeline per node, in parallel,
+    which also carries the reference count increments of the proxies in
+    increments. Yields (object, version, snapshot) for each of objs.
+    """
+    by_node = {}
+    for obj in objs:
+        by_node.setdefault(obj._node_, ([], []))[0].append(obj)
+    for proxy in increments:
+        by_node.setdefault(proxy._node_, ([], []))[1].append(proxy)
+    nodes = by_node.keys()
+    reads = [_node_reader(node, *by_node[node]) for node in nodes]
+    if len(reads) > 1 and current_batch() is None:
+        read = keep_reads_pinned(_read_node_level)
+        replies = gather([submit(read, *args) for args in reads])
     else:
-        raise RedisNestedTypeError("Nested type should either be an atomic type (int, float, str, etc) or a Redis Type")
+        # inside a batch the pending writes are flushed by reading in this thread
+        replies = [_read_node_level(*args) for args in reads]
+    # decoded in this thread, where the proxies materialized are collected
+    for node, node_replies in zip(nodes, replies):
+        node_replies = iter(node_replies)
+        for obj in by_node[node][0]:
+            version = int(next(node_replies) or 0)
+            yield obj, version, obj._parse_load(node_replies)
 
-def get_value_from_object_and_type(obj, t):
-    if t == "str":
-        return obj
-    elif t == "int":
-        return int(obj)
-    elif t == "long":
-        return long(obj)
-    elif t == "float":
-        return float(obj)
-    elif t == "bool":
-        return bool(int(obj))
-    elif t == "dmem:str":
-        from redisstr import RedisStr
-        return RedisStr._from_addr(obj)
-    elif t == "dmem:list":
-        from redislist import RedisList
-        return RedisList._from_addr(obj)
-    elif t == "dmem:dict":
-        from redisdict import RedisDict
-        return RedisDict._from_addr(obj)
-    elif t == "dmem:set":
-        from redisset import RedisSet
-        return RedisSet._from_addr(obj)
-    elif t == "dmem:object":
-        from redisobj import RedisObject
-        return RedisObject._from_addr(obj)
+def _proxies_in(snapshot):
+    # the dmem objects in the snapshot of a dict, list or set
+    values = snapshot.itervalues() if isinstance(snapshot, dict) else snapshot
+    return [v for v in values if isinstance(v, dbase)]
+
+def _next_level(proxies, snapshots):
+    # the objects of proxies to read next, once each
+    level, queued = [], set()
+    for proxy in proxies:
+        addr = proxy._addr_
+        if addr not in snapshots and addr not in queued and hasattr(type(proxy), "_queue_load"):
+            queued.add(addr)
+            level.append(proxy)
+    return level
+
+def _walk_graph(root, depth, counted):
+    """ Loads root and the objects it references, breadth first, depth levels deep
+    (None for no limit), with one round trip per node and level. Returns the
+    snapshots and versions of the loaded objects by address, the proxies
+    materialized in the snapshots and those of them already counted. If counted,
+    the references of the others are counted, the increments sent with the reads
+    of the next level; otherwise that's left to the caller.
+    Objects that can't be read in a pipeline, like the sharded containers, are
+    left as proxies. Such a root is read on its own, the proxies in it are
+    counted as they are decoded, and the walk goes on from them.
+    """
+    snapshots, versions, found, uncounted, precounted = {}, {}, [], [], []
+    if hasattr(type(root), "_queue_load"):
+        level = [root]
     else:
-        return None
+        versions[root._addr_] = root.version()
+        snapshots[root._addr_] = snapshot = root._load()
+        precounted = _proxies_in(snapshot)
+        found.extend(precounted)
+        level = _next_level(precounted, snapshots)
+        if depth is not None:
+            depth -= 1
+    try:
+        for _ in (itertools.count() if depth is None else xrange(depth)):
+            if not level:
+                break
+            increments = uncounted if counted else []
+            with collected_proxies() as proxies:
+                for obj, version, snapshot in _read_level(level, increments):
+                    snapshots[obj._addr_] = snapshot
+                    versions[obj._addr_] = version
+            if counted:
+                uncounted = []
+            found.extend(proxies)
+            uncounted.extend(proxies)
+            level = _next_level(proxies, snapshots)
+        if counted and uncounted:
+            _update_refcnts(uncounted, 1)
+            uncounted = []
+    finally:
+        # the proxies of a failed load are dropped without touching the counts
+        for proxy in uncounted:
+            proxy.__dict__['_released_'] = True
+    return snapshots, versions, found, precounted
+
+@contextlib.contextmanager
+def _loaded_graph(root, depth):
+    # see dbase.loaded()
+    snapshots, versions, proxies, _ = _walk_graph(root, depth, True)
+    cached = [proxy for proxy in [root] + proxies if proxy._addr_ in snapshots]
+    for proxy in cached:
+        proxy.cache = snapshots[proxy._addr_]
+        proxy._thread_state().version = versions[proxy._addr_]
+    try:
+        yield root.cache
+    finally:
+        for proxy in cached:
+            proxy.cache = None
+
+def load_graph(root, depth=None):
+    """ A native copy of root and the objects it references, depth levels deep
+    (None for the whole graph): RedisLists become lists, RedisDicts and
+    RedisObjects dicts and RedisStrs strs. Each level is read with one pipeline
+    per node, so a document three levels deep takes three round trips per node
+    however many objects it holds. Shared and cyclic references are kept as such.
+    Set members, the objects past depth and sharded containers are left as
+    proxies, except a sharded root, which becomes a dict, set or list.
+    >>> doc = load_graph(mydoc)
+    >>> doc["sections"][0]["title"]
+    """
+    snapshots, _, proxies, precounted = _walk_graph(root, depth, False)
+    precounted = set(id(proxy) for proxy in precounted)
+    replaced = []
+    def substitute(proxy):
+        # only the proxies counted when decoded hold a reference to drop
+        if id(proxy) in precounted:
+            replaced.append(proxy)
+        else:
+            proxy.__dict__['_released_'] = True
+        return snapshots[proxy._addr_]
+    try:
+        for snapshot in snapshots.itervalues():
+            if isinstance(snapshot, list):
+                for i, v in enumerate(snapshot):
+                    if isinstance(v, dbase) and v._addr_ in snapshots:
+                        snapshot[i] = substitute(v)
+            elif isinstance(snapshot, dict):
+                for k, v in snapshot.items():
+                    if isinstance(v, dbase) and v._addr_ in snapshots:
+                        snapshot[k] = substitute(v)
+        kept = [proxy for proxy in proxies if not proxy._released_ and id(proxy) not in precounted]
+        _update_refcnts(kept, 1)
+    except:
+        for proxy in proxies:
+            if id(proxy) not in precounted:
+                proxy.__dict__['_released_'] = True
+        raise
+    release_proxies(replaced)
+    return snapshots[root._addr_]
+
+def release_proxies(proxies):
+    """ Drop the references held by a batch of proxies with one pipelined DECR per
+    node, instead of one DECR each when they are garbage collected.
+    The proxies must not be used afterwards.
+    """
+    proxies = [p for p in proxies if isinstance(p, dbase) and not p._released_]
+    for proxy, refcnt in zip(proxies, _update_refcnts(proxies, -1)):
+        proxy.__dict__['_released_'] = True
+        if proxy._unreferenced(refcnt):
+            proxy.destroy()
+
+# kept under their old names, every container module uses these
+get_redis_object_and_type = encode
+get_value_from_object_and_type = decode
+
+def get_values_from_objects_and_types(objs, types):
+    with batched_refcounts():
+        return decode_many(objs, types)
 
 def test():
     # Configure the client pool singleton instance
@@ -0,0 +1,191 @@
+import time, random, uuid
+import threading
+from utils import *
+from batch import pin_reads, unpin_reads
+from scripts import Script
+
+LOCK_PREFIX = "_lock_"
+NOTIFY_PREFIX = "_lockq_"
+
+DEFAULT_LEASE = 6.0     # seconds
+MIN_BACKOFF = 0.001     # seconds
+MAX_BACKOFF = 0.5       # seconds
+# the shortest wait done with BLPOP, redis truncates shorter timeouts to 0,
+# which blocks for good
+MIN_BLPOP_TIMEOUT = 0.01    # seconds
+
+UNLOCK_LUA_SCRIPT = Script("""
+    if redis.call("get", KEYS[1]) == ARGV[1] then
+        if KEYS[2] then
+            -- wake up one waiter, the token expires if nobody is waiting
+            redis.call("lpush", KEYS[2], "1")
+            redis.call("ltrim", KEYS[2], 0, 0)
+            redis.call("pexpire", KEYS[2], ARGV[2])
+        end
+        return redis.call("del",KEYS[1])
+    else
+        return 0
+    end
+""")
+
+RENEW_LUA_SCRIPT = Script("""
+    if redis.call("get", KEYS[1]) == ARGV[1] then
+        return redis.call("pexpire", KEYS[1], ARGV[2])
+    else
+        return 0
+    end
+""")
+
+class LockStats(object):
+    """ Wait time and contention of the locks taken by this process, per lock key """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def record(self, key, wait, attempts):
+        with self.lock:
+            s = self.stats.setdefault(key, {"acquired": 0, "contended": 0, "attempts": 0,
+                                            "total_wait": 0.0, "max_wait": 0.0})
+            s["acquired"] += 1
+            s["attempts"] += attempts
+            if attempts > 1:
+                s["contended"] += 1
+            s["total_wait"] += wait
+            s["max_wait"] = max(s["max_wait"], wait)
+
+    def get(self, key=None):
+        with self.lock:
+            if key is not None:
+                return dict(self.stats.get(key, {}))
+            return dict((k, dict(v)) for k, v in self.stats.iteritems())
+
+    def hottest(self, n=10):
+        # the n lock keys with the most time spent waiting
+        stats = self.get()
+        return sorted(stats.iteritems(), key=lambda kv: kv[1]["total_wait"], reverse=True)[:n]
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+lock_stats = LockStats()
+
+# per client, whether its server takes fractional BLPOP timeouts
+_float_timeouts = {}
+
+def _takes_float_timeouts(client):
+    # BLPOP takes fractions of a second since redis 6.0, whole seconds before
+    supported = _float_timeouts.get(client)
+    if supported is None:
+        version = client.info("server")["redis_version"]
+        supported = _float_timeouts[client] = int(version.split(".")[0]) >= 6
+    return supported
+
+class RedisLock(object):
+    """ A lock held on one redis node.
+    Waiters retry with jittered exponential backoff between min_backoff and
+    max_backoff seconds. With notify=True they block on BLPOP instead and are woken
+    up by the release; waits too short for a BLPOP timeout (under
+    MIN_BLPOP_TIMEOUT, or under a second before redis 6.0) are slept.
+    The lock expires after lease seconds unless released, with auto_renew=True a
+    background thread extends the lease while the lock is held.
+    Can be used as a context manager:
+    >>> with RedisLock(client, "_lock_mykey", auto_renew=True):
+    ...     pass
+    Entering the context raises LockTimeout if timeout seconds pass first.
+    """
+    def __init__(self, client, key, lease=DEFAULT_LEASE, auto_renew=False, notify=False,
+                 min_backoff=MIN_BACKOFF, max_backoff=MAX_BACKOFF, timeout=None):
+        self.client = client
+        self.timeout = timeout
+        self.key = key
+        self.notify_key = NOTIFY_PREFIX + key if notify else None
+        self.lease = lease
+        self.auto_renew = auto_renew
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.token = None
+        self.renewer = None
+        self.pins = None
+
+    def _try_acquire(self, token):
+        return self.client.set(self.key, token, nx=True, px=int(self.lease*1000))
+
+    def _wait(self, delay):
+        # delay never exceeds the time left before the acquire times out
+        if self.notify_key:
+            timeout = delay if _takes_float_timeouts(self.client) else int(delay)
+            if timeout >= MIN_BLPOP_TIMEOUT:
+                self.client.blpop(self.notify_key, timeout=timeout)
+                return
+        time.sleep(delay)
+
+    def acquire(self, blocking=True, timeout=None):
+        """ Returns True once the lock is held, or False if not blocking or
+        timeout seconds have passed without getting it.
+        """
+        token = uuid.uuid4().hex
+        start = time.time()
+        attempts = 0
+        backoff = self.min_backoff
+        while True:
+            attempts += 1
+            if self._try_acquire(token):
+                break
+            if not blocking:
+                return False
+            delay = random.uniform(backoff/2, backoff)
+            if timeout is not None:
+                remaining = start + timeout - time.time()
+                if remaining <= 0:
+                    return False
+                delay = min(delay, remaining)
+            self._wait(delay)
+            backoff = min(backoff*2, self.max_backoff)
+        self.token = token
+        # the reads of the acquiring thread, also when another thread releases
+        self.pins = pin_reads()
+        lock_stats.record(self.key, time.time() - start, attempts)
+        if self.auto_renew:
+            self.renewer = LeaseRenewer(self)
+        return True
+
+    def renew(self):
+        # extends the lease, returns False if the lock was lost
+        return bool(RENEW_LUA_SCRIPT(self.client, [self.key], [self.token, int(self.lease*1000)]))
+
+    def release(self):
+        if self.renewer:
+            self.renewer.stop()
+            self.renewer = None
+        keys = [self.key, self.notify_key] if self.notify_key else [self.key]
+        UNLOCK_LUA_SCRIPT(self.client, keys, [self.token, int(self.lease*1000)])
+        pins, self.pins = self.pins, None
+        if pins is not None:
+            unpin_reads(pins)
+        self.token = None
+
+    def __enter__(self):
+        if not self.acquire(timeout=self.timeout):
+            raise LockTimeout("Timed out waiting for lock %s" % self.key)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+class LeaseRenewer(threading.Thread):
+    """ Extends the lease of a held lock every third of the lease """
+    def __init__(self, lock):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.lock = lock
+        self.stopped = threading.Event()
+        self.start()
+
+    def run(self):
+        while not self.stopped.wait(self.lock.lease/3.0):
+            if not self.lock.renew():
+                return
+
+    def stop(self):
+        self.stopped.set()
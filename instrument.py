@@ -0,0 +1,286 @@
+""" Instrumentation of the commands dmem sends to redis.
+
+While enabled, every round trip (a command sent on its own or a whole pipeline,
+EVAL included) is counted per node and command, its latency is recorded in a
+histogram per node and dmem type, and the round trips made by each call of a
+container method are counted. Events also go to the sinks, callables taking an
+event dict:
+    {"kind": "round_trip", "node": ..., "type": ..., "commands": [...], "seconds": ...}
+    {"kind": "api_call", "type": ..., "method": ..., "round_trips": ..., "seconds": ...}
+When disabled, the container methods are the plain ones and a command costs
+one extra flag check.
+"""
+import time
+import bisect
+import logging
+import threading
+import functools
+import types
+import redis
+from scripts import ScriptLoadingPipeline
+
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5]
+NO_TYPE = "-"   # the dmem type of commands sent outside container methods
+
+_enabled = False
+_sinks = []
+# the container method call in progress, per thread
+_local = threading.local()
+# the classes given to instrument_methods, and the methods the wrappers replaced
+# while enabled: class -> {name: method in the class's __dict__, or None}
+_classes = []
+_originals = {}
+_install_lock = threading.Lock()
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_dict(self):
+        return {"buckets": list(self.counts), "sum": self.sum, "count": self.count}
+
+class Metrics(object):
+    """ What the instrumentation recorded since it was last reset """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.round_trips = 0
+            self.commands = {}      # (node, command) -> count
+            self.latency = {}       # (node, dmem type) -> Histogram of round trips
+            self.api_calls = {}     # (dmem type, method) -> [calls, round trips, Histogram]
+
+    def record_round_trip(self, node, dmem_type, commands, seconds):
+        with self.lock:
+            self.round_trips += 1
+            for command in commands:
+                key = (node, command)
+                self.commands[key] = self.commands.get(key, 0) + 1
+            histogram = self.latency.get((node, dmem_type))
+            if histogram is None:
+                histogram = self.latency[(node, dmem_type)] = Histogram()
+            histogram.observe(seconds)
+
+    def record_api_call(self, dmem_type, method, round_trips, seconds):
+        with self.lock:
+            stats = self.api_calls.get((dmem_type, method))
+            if stats is None:
+                stats = self.api_calls[(dmem_type, method)] = [0, 0, Histogram()]
+            stats[0] += 1
+            stats[1] += round_trips
+            stats[2].observe(seconds)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "round_trips": self.round_trips,
+                "commands": dict(self.commands),
+                "latency": dict((k, h.to_dict()) for k, h in self.latency.iteritems()),
+                "api_calls": dict((k, {"calls": s[0], "round_trips": s[1], "latency": s[2].to_dict()})
+                                  for k, s in self.api_calls.iteritems()),
+            }
+
+metrics = Metrics()
+
+def enable_instrumentation(*sinks):
+    global _enabled
+    for sink in sinks:
+        add_sink(sink)
+    with _install_lock:
+        if not _enabled:
+            for cls in _classes:
+                _install(cls)
+            _enabled = True
+
+def disable_instrumentation():
+    global _enabled
+    with _install_lock:
+        if _enabled:
+            _enabled = False
+            for cls in _classes:
+                _uninstall(cls)
+
+def instrumentation_enabled():
+    return _enabled
+
+def add_sink(sink):
+    if sink not in _sinks:
+        _sinks.append(sink)
+
+def remove_sink(sink):
+    if sink in _sinks:
+        _sinks.remove(sink)
+
+def _emit(event):
+    for sink in _sinks:
+        sink(event)
+
+def _round_trip(node, commands, seconds):
+    call = getattr(_local, "call", None)
+    if call is not None:
+        call.round_trips += 1
+    dmem_type = call.type if call is not None else NO_TYPE
+    metrics.record_round_trip(node, dmem_type, commands, seconds)
+    if _sinks:
+        _emit({"kind": "round_trip", "node": node, "type": dmem_type,
+               "commands": commands, "seconds": seconds})
+
+class ApiCall(object):
+    __slots__ = ["type", "method", "round_trips"]
+
+    def __init__(self, dmem_type, method):
+        self.type = dmem_type
+        self.method = method
+        self.round_trips = 0
+
+def _instrumented(func, dmem_type, method):
+    @functools.wraps(func)
+    def call(self, *args, **kwargs):
+        # methods called by another method count towards the outer one
+        if getattr(_local, "call", None) is not None:
+            return func(self, *args, **kwargs)
+        current = _local.call = ApiCall(dmem_type, method)
+        start = time.time()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            _local.call = None
+            seconds = time.time() - start
+            metrics.record_api_call(dmem_type, method, current.round_trips, seconds)
+            if _sinks:
+                _emit({"kind": "api_call", "type": dmem_type, "method": method,
+                       "round_trips": current.round_trips, "seconds": seconds})
+    call.original_method = func
+    return call
+
+# methods not counted as API calls, and private ones that are
+SKIPPED_METHODS = ["__del__", "__eq__", "__ne__", "__new__", "initialize"]
+PRIVATE_API_METHODS = ["_load"]
+
+def instrument_methods(cls):
+    """ Count the round trips of each call of cls's public methods and operators
+    while instrumentation is enabled, the wrappers are only in place until it is
+    disabled. Generators and context managers (iterate, loaded, ...) only count
+    the calls that create them.
+    """
+    with _install_lock:
+        _classes.append(cls)
+        if _enabled:
+            _install(cls)
+    return cls
+
+def _install(cls):
+    originals = _originals[cls] = {}
+    seen = set()
+    for klass in cls.__mro__:
+        for name, value in klass.__dict__.items():
+            if name in seen:
+                continue
+            seen.add(name)
+            # a base class's wrapper wraps the method for the base's type
+            value = getattr(value, "original_method", value)
+            if not isinstance(value, types.FunctionType) or name in SKIPPED_METHODS:
+                continue
+            if name.startswith("_") and not (name.startswith("__") and name.endswith("__")) \
+                    and name not in PRIVATE_API_METHODS:
+                continue
+            originals[name] = cls.__dict__.get(name)
+            setattr(cls, name, _instrumented(value, cls.__name__, name))
+
+def _uninstall(cls):
+    for name, original in _originals.pop(cls, {}).iteritems():
+        if original is None:
+            delattr(cls, name)
+        else:
+            setattr(cls, name, original)
+
+class InstrumentedRedis(redis.StrictRedis):
+    """ The redis client of a node, reporting its commands while instrumentation is enabled """
+    def __init__(self, node=None, **kwargs):
+        redis.StrictRedis.__init__(self, **kwargs)
+        self.node = node
+
+    def execute_command(self, *args, **options):
+        if not _enabled:
+            return redis.StrictRedis.execute_command(self, *args, **options)
+        start = time.time()
+        try:
+            return redis.StrictRedis.execute_command(self, *args, **options)
+        finally:
+            _round_trip(self.node, [args[0]], time.time() - start)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = InstrumentedPipeline(self.connection_pool, self.response_callbacks,
+                                    transaction, shard_hint)
+        pipe.node = self.node
+        return pipe
+
+class InstrumentedPipeline(ScriptLoadingPipeline):
+    node = None
+
+    def execute(self, raise_on_error=True):
+        if not _enabled or not self.command_stack:
+            return ScriptLoadingPipeline.execute(self, raise_on_error)
+        commands = [args[0] for args, options in self.command_stack]
+        start = time.time()
+        try:
+            return ScriptLoadingPipeline.execute(self, raise_on_error)
+        finally:
+            _round_trip(self.node, commands, time.time() - start)
+
+class LoggingSink(object):
+    """ Logs each event with the logging module """
+    def __init__(self, logger="dmem", level=logging.DEBUG):
+        self.logger = logging.getLogger(logger) if isinstance(logger, basestring) else logger
+        self.level = level
+
+    def __call__(self, event):
+        if event["kind"] == "round_trip":
+            self.logger.log(self.level, "%s %s: %s (%.3f ms)", event["node"], event["type"],
+                            " ".join(event["commands"]), event["seconds"]*1000)
+        else:
+            self.logger.log(self.level, "%s.%s: %d round trips (%.3f ms)", event["type"],
+                            event["method"], event["round_trips"], event["seconds"]*1000)
+
+def _labels(**labels):
+    return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in sorted(labels.items()))
+
+def _histogram_lines(name, labels, histogram):
+    lines = []
+    cumulative = 0
+    for bound, count in zip(LATENCY_BUCKETS + ["+Inf"], histogram["buckets"]):
+        cumulative += count
+        lines.append("%s_bucket%s %d" % (name, _labels(le=bound, **labels), cumulative))
+    lines.append("%s_sum%s %f" % (name, _labels(**labels), histogram["sum"]))
+    lines.append("%s_count%s %d" % (name, _labels(**labels), histogram["count"]))
+    return lines
+
+def prometheus_text():
+    """ The recorded metrics in the Prometheus text exposition format """
+    snapshot = metrics.snapshot()
+    lines = ["# TYPE dmem_commands_total counter"]
+    for (node, command), count in sorted(snapshot["commands"].items()):
+        lines.append("dmem_commands_total%s %d" % (_labels(node=node, command=command), count))
+    lines.append("# TYPE dmem_round_trip_seconds histogram")
+    for (node, dmem_type), histogram in sorted(snapshot["latency"].items()):
+        lines.extend(_histogram_lines("dmem_round_trip_seconds", {"node": node, "type": dmem_type}, histogram))
+    lines.append("# TYPE dmem_api_round_trips_total counter")
+    for (dmem_type, method), stats in sorted(snapshot["api_calls"].items()):
+        lines.append("dmem_api_round_trips_total%s %d" % (_labels(type=dmem_type, method=method),
+                                                          stats["round_trips"]))
+    lines.append("# TYPE dmem_api_call_seconds histogram")
+    for (dmem_type, method), stats in sorted(snapshot["api_calls"].items()):
+        lines.extend(_histogram_lines("dmem_api_call_seconds", {"type": dmem_type, "method": method},
+                                      stats["latency"]))
+    return "\n".join(lines) + "\n"
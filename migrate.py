@@ -0,0 +1,101 @@
+from dbase import *
+from utils import *
+from nearcache import get_near_cache
+import collections
+
+# dmem types that have a compact encoding, and the type names they migrate to
+COMPACT_TYPES = {
+    "dmem:list": "dmem:list" + COMPACT_SUFFIX,
+    "dmem:list" + INDEXED_SUFFIX: "dmem:list" + COMPACT_SUFFIX + INDEXED_SUFFIX,
+    "dmem:dict": "dmem:dict" + COMPACT_SUFFIX,
+    "dmem:object": "dmem:object" + COMPACT_SUFFIX,
+}
+
+def migrate_to_compact(root):
+    """ Convert root, and every list/dict/object reachable from it, to the compact
+    "tag#value" encoding, dropping their _type_ keys. References held in the
+    migrated containers (including set members) are rewritten to the compact type
+    names, so the graph stays readable. Objects are migrated in place, their
+    addresses don't change.
+    Writers must be stopped while migrating, and proxies of migrated objects other
+    than root must be dropped and loaded again from their containers.
+    >>> l = RedisList([1, RedisDict({"a": 1})])
+    >>> migrate_to_compact(l)
+    >>> l._type_, l[1]._type_
+    ('dmem:list:c', 'dmem:dict:c')
+    """
+    _migrate(root._addr_, root._type_, set())
+    if root._type_ in COMPACT_TYPES:
+        # RedisObject intercepts setattr, so go through __dict__ for all types
+        root.__dict__['_compact_'] = True
+        root.__dict__['_type_'] = COMPACT_TYPES[root._type_]
+
+def _migrate_reference(obj, t, visited):
+    # migrate the object a reference points to, returns the new type of the reference
+    if t.startswith("dmem:"):
+        _migrate(obj, t, visited)
+    return COMPACT_TYPES.get(t, t)
+
+def _migrate(addr, t, visited):
+    if addr in visited:
+        return
+    visited.add(addr)
+    cache = get_near_cache()
+    if cache is not None:
+        # the cached content keeps the old type names of references
+        cache.invalidate(addr)
+    client = RedisClientPool.get_pool().get_client(dbase.get_node_from_addr(addr))
+    type_addr = "_type_" + addr
+    indexed = t.endswith(INDEXED_SUFFIX)
+    compact = t[:len(t) - len(INDEXED_SUFFIX)].endswith(COMPACT_SUFFIX) if indexed \
+        else t.endswith(COMPACT_SUFFIX)
+    if t.startswith("dmem:list"):
+        if compact:
+            objs, types = split_tagged_objects(client.lrange(addr, 0, -1))
+        else:
+            objs = client.lrange(addr, 0, -1)
+            types = client.lrange(type_addr, 0, -1)
+        tagged = [tag_object(obj, _migrate_reference(obj, ot, visited))
+                  for obj, ot in zip(objs, types)]
+        with client.pipeline() as pipe:
+            pipe.delete(addr, type_addr)
+            if tagged:
+                pipe.rpush(addr, *tagged)
+            if indexed:
+                # compact lists count the tagged items
+                pipe.delete(INDEX_PREFIX + addr)
+                for field, count in collections.Counter(tagged).iteritems():
+                    pipe.hincrby(INDEX_PREFIX + addr, field, count)
+            pipe.incr(VERSION_PREFIX + addr)
+            pipe.execute()
+    elif t.startswith("dmem:dict") or t.startswith("dmem:object"):
+        if compact:
+            objdict, tdict = split_tagged_dict(client.hgetall(addr))
+        else:
+            objdict = client.hgetall(addr)
+            tdict = client.hgetall(type_addr)
+        tagged = {}
+        for key, obj in objdict.iteritems():
+            tagged[key] = tag_object(obj, _migrate_reference(obj, tdict[key], visited))
+        with client.pipeline() as pipe:
+            pipe.delete(addr, type_addr)
+            if tagged:
+                pipe.hmset(addr, tagged)
+            pipe.incr(VERSION_PREFIX + addr)
+            pipe.execute()
+    elif t == "dmem:set":
+        # set members already carry their type inline, only references need renaming
+        from redisset import RedisSet
+        renamed = []
+        for member in client.smembers(addr):
+            obj, ot = RedisSet._get_value_type_from_object(member)
+            new_t = _migrate_reference(obj, ot, visited)
+            if new_t != ot:
+                renamed.append((member, RedisSet._get_object_from_value_type(obj, new_t)))
+        if renamed:
+            with client.pipeline() as pipe:
+                for old, new in renamed:
+                    pipe.srem(addr, old)
+                    pipe.sadd(addr, new)
+                pipe.incr(VERSION_PREFIX + addr)
+                pipe.execute()
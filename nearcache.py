@@ -0,0 +1,170 @@
+import threading
+import collections
+import redis
+from utils import *
+
+DEFAULT_MAX_BYTES = 64*1024*1024
+LISTEN_TIMEOUT = 0.5    # seconds, how often the listener checks if it's stopped
+ITEM_OVERHEAD = 64      # rough per item cost of python objects, in bytes
+TYPE_KEY_PREFIX = "_type_"
+
+def estimate_size(raw):
+    # rough memory used by the raw content of an object: strings, lists, dicts or sets of them
+    if raw is None:
+        return 0
+    if isinstance(raw, basestring):
+        return len(raw) + ITEM_OVERHEAD
+    if isinstance(raw, dict):
+        return sum(len(k) + estimate_size(v) for k, v in raw.iteritems()) + ITEM_OVERHEAD
+    return sum(estimate_size(v) for v in raw) + ITEM_OVERHEAD
+
+class NearCache(object):
+    """ Client side cache of the raw content of dmem objects, by address, kept
+    across calls. Entries are evicted least recently used first once max_bytes is
+    exceeded, and invalidated by local writes and by redis keyspace notifications.
+    """
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.loading = {}
+        self.size = 0
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0, "evictions": 0}
+
+    def get(self, addr):
+        with self.lock:
+            entry = self.entries.pop(addr, None)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self.entries[addr] = entry
+            self.stats["hits"] += 1
+            return entry[0]
+
+    def begin_load(self, addr):
+        # returns a token for put(), the load is dropped if addr is invalidated meanwhile
+        token = object()
+        with self.lock:
+            self.loading.setdefault(addr, set()).add(token)
+        return token
+
+    def put(self, addr, raw, token):
+        size = estimate_size(raw)
+        with self.lock:
+            tokens = self.loading.get(addr)
+            if not tokens or token not in tokens:
+                return
+            tokens.discard(token)
+            if not tokens:
+                del self.loading[addr]
+            if size > self.max_bytes:
+                return
+            self._remove(addr)
+            self.entries[addr] = (raw, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                evicted = self.entries.popitem(last=False)
+                self.size -= evicted[1][1]
+                self.stats["evictions"] += 1
+
+    def _remove(self, addr):
+        entry = self.entries.pop(addr, None)
+        if entry is not None:
+            self.size -= entry[1]
+        return entry
+
+    def invalidate(self, addr):
+        with self.lock:
+            self.loading.pop(addr, None)
+            if self._remove(addr) is not None:
+                self.stats["invalidations"] += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.loading.clear()
+            self.size = 0
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self.entries)
+            stats["bytes"] = self.size
+            return stats
+
+class InvalidationListener(redis.client.PubSub):
+    """ Subscribes to the keyspace notifications of one node and invalidates the
+    cached objects whose keys changed. The whole cache is dropped whenever the
+    subscription (re)connects or fails, since notifications may have been missed.
+    """
+    def __init__(self, cache, client):
+        redis.client.PubSub.__init__(self, client.connection_pool)
+        self.cache = cache
+        self.stopped = threading.Event()
+        db = client.connection_pool.connection_kwargs.get("db", 0)
+        self.psubscribe(**{"__keyspace@%d__:*" % db: self.handle})
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.get_message(ignore_subscribe_messages=True, timeout=LISTEN_TIMEOUT)
+            except (redis.ConnectionError, redis.TimeoutError):
+                # the next get_message reconnects and subscribes again
+                self.connection.disconnect()
+                self.cache.clear()
+                self.stopped.wait(LISTEN_TIMEOUT)
+        self.close()
+
+    def on_connect(self, connection):
+        self.cache.clear()
+        redis.client.PubSub.on_connect(self, connection)
+
+    def handle(self, message):
+        key = message["channel"].split(":", 1)[1]
+        if key.startswith(TYPE_KEY_PREFIX):
+            key = key[len(TYPE_KEY_PREFIX):]
+        self.cache.invalidate(key)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+_near_cache = None
+_listeners = []
+
+def get_near_cache():
+    return _near_cache
+
+def enable_near_cache(max_bytes=DEFAULT_MAX_BYTES, configure_server=True):
+    """ Keep the content of loaded dmem objects in a client side cache of
+    max_bytes, so reading them again costs no round trip until they change.
+    Invalidation relies on keyspace notifications, with configure_server=True
+    they are turned on for every node (notify-keyspace-events "KA").
+    """
+    global _near_cache
+    disable_near_cache()
+    cache = NearCache(max_bytes)
+    pool = RedisClientPool.get_pool()
+    for name in pool.names:
+        client = pool.get_client(name).client
+        if configure_server:
+            events = client.config_get("notify-keyspace-events").get("notify-keyspace-events", "")
+            if "K" not in events or "A" not in events:
+                client.config_set("notify-keyspace-events", events + "KA")
+        _listeners.append(InvalidationListener(cache, client))
+    _near_cache = cache
+    return cache
+
+def disable_near_cache():
+    global _near_cache
+    _near_cache = None
+    while _listeners:
+        _listeners.pop().stop()
+
+def near_cache_stats():
+    if _near_cache is None:
+        return {}
+    return _near_cache.get_stats()
@@ -1,78 +1,158 @@
 from dbase import *
 import random, string
-import contextlib
 from utils import *
+from instrument import instrument_methods
+from scripts import Script
 
-POP_ITEM_LUA_SCRIPT = """
+# removes field ARGV[1], returns its value and type (false for compact dicts),
+# false for both if it isn't there
+POP_ITEM_LUA_SCRIPT = Script("""
 local addr = KEYS[1]
 local taddr = KEYS[2]
 local k = ARGV[1]
-v = redis.call('hget', addr, k)
+local v = redis.call('hget', addr, k)
+local t = false
 redis.call('hdel', addr, k)
-redis.call('hdel', taddr, k)
-return v
-"""
+if taddr then
+    t = redis.call('hget', taddr, k)
+    redis.call('hdel', taddr, k)
+end
+return {v, t}
+""")
+
+DEFAULT_SCAN_COUNT = 1000
+
+# copies the source hashes (the keys after the destination keys) in chunks of ARGV[1] fields
+COPY_HASH_LUA_SCRIPT = Script("""
+local n = #KEYS / 2
+local chunk = tonumber(ARGV[1]) * 2
+for k = 1, n do
+    local fields = redis.call('hgetall', KEYS[n+k])
+    for i = 1, #fields, chunk do
+        redis.call('hset', KEYS[k], unpack(fields, i, math.min(i + chunk - 1, #fields)))
+    end
+end
+""")
+
+SCAN_ITEMS_LUA_SCRIPT = Script("""
+local addr = KEYS[1]
+local taddr = KEYS[2]
+local res = redis.call('hscan', addr, ARGV[1], 'COUNT', ARGV[2])
+local fields = res[2]
+local out = {res[1]}
+for i = 1, #fields, 2 do
+    out[#out+1] = fields[i]
+    out[#out+1] = fields[i+1]
+    if taddr then
+        out[#out+1] = redis.call('hget', taddr, fields[i])
+    else
+        out[#out+1] = false
+    end
+end
+return out
+""")
 
 class RedisDict(dbase):
-    def __init__(self, _dict=None):
-        dbase.__init__(self)        
+    def __init__(self, _dict=None, compact=False, node=None):
+        dbase.__init__(self, compact, node)
         if _dict:
             self.update(_dict)
 
     def initialize(self):
         self._type_addr_ = "_type_" + self._addr_
-        self._type_ = "dmem:dict"
+        self._type_ = "dmem:dict" + (COMPACT_SUFFIX if self._compact_ else "")
         self.cache = None
 
     def _load_objects_and_types(self):
-        objdict = self.client.hgetall(self._addr_)
-        tdict = self.client.hgetall(self._type_addr_)
+        return self._near_cached(self._load_hashes)
+
+    def _load_hashes(self):
+        if self._compact_:
+            return split_tagged_dict(self._reader().hgetall(self._addr_))
+        with self._reader().pipeline() as pipe:
+            pipe.hgetall(self._addr_)
+            pipe.hgetall(self._type_addr_)
+            objdict, tdict = pipe.execute()
         return objdict, tdict
 
     def _load(self):
         od, td = self._load_objects_and_types()
-        _dict = {}
-        for key in od:
-            obj = od[key]
-            t = td[key]
-            v = get_value_from_object_and_type(obj, t)
-            _dict[key] = v
-        return _dict
+        return self._decode_hashes(od, td)
+
+    @staticmethod
+    def _decode_hashes(od, td):
+        keys = od.keys()
+        return dict(zip(keys, get_values_from_objects_and_types([od[key] for key in keys],
+                                                                [td[key] for key in keys])))
+
+    def _queue_load(self, pipe):
+        # queues the reads of _load() on pipe, _parse_load() decodes their replies
+        pipe.hgetall(self._addr_)
+        if not self._compact_:
+            pipe.hgetall(self._type_addr_)
+
+    def _parse_load(self, replies):
+        if self._compact_:
+            return self._decode_hashes(*split_tagged_dict(next(replies)))
+        return self._decode_hashes(next(replies), next(replies))
 
     def destroy(self):
         dbase.destroy(self)
         self.client.delete(self._type_addr_)
 
-    @contextlib.contextmanager
-    def loaded(self):
-        self.cache = self._load()
-        try:
-            yield self.cache
-        finally:
-            self.cache = None
-
     def __iter__(self):
         if self.cache:
             return iter(self.cache)
-        return iter(self.keys())
+        return self.iterkeys()
+
+    def _scan_items(self, count):
+        # each HSCAN batch comes back together with its type hints in one round trip,
+        # and is decoded as a whole so nested objects are counted in one pipeline
+        # a cursor is only valid on the server that returned it
+        reader = self._reader()
+        cursor = 0
+        while True:
+            res = self._run_script(SCAN_ITEMS_LUA_SCRIPT, cursor, count, pipe=reader)
+            cursor = int(res[0])
+            keys = res[1::3]
+            if self._compact_:
+                objs, types = split_tagged_objects(res[2::3])
+            else:
+                objs, types = res[2::3], res[3::3]
+            for item in zip(keys, get_values_from_objects_and_types(objs, types)):
+                yield item
+            if cursor == 0:
+                break
 
     def __contains__(self, key):
         if self.cache:
             return key in self.cache
-        return self.client.hexists(self._addr_, key)
+        raw = self._near_cache_entry()
+        if raw is not None:
+            return key in raw[0]
+        return self._reader().hexists(self._addr_, key)
 
     def __len__(self):
         if self.cache:
             return len(self.cache)
-        return self.client.hlen(self._addr_)
+        raw = self._near_cache_entry()
+        if raw is not None:
+            return len(raw[0])
+        return self._reader().hlen(self._addr_)
 
     def __getitem__(self, key):
         if self.cache:
             return self.cache[key]
-        with self.client.pipeline() as pipe:
-            pipe.hget(self._addr_, key)
-            pipe.hget(self._type_addr_, key)
-            [obj, t] = pipe.execute()
+        raw = self._near_cache_entry()
+        if raw is not None:
+            return get_value_from_object_and_type(raw[0].get(key), raw[1].get(key))
+        if self._compact_:
+            obj, t = untag_object(self._reader().hget(self._addr_, key))
+        else:
+            with self._reader().pipeline() as pipe:
+                pipe.hget(self._addr_, key)
+                pipe.hget(self._type_addr_, key)
+                [obj, t] = pipe.execute()
         v = get_value_from_object_and_type(obj, t)
         return v
 
@@ -81,29 +161,34 @@ class RedisDict(dbase):
             raise KeyError("Only string key is supported")
         if self.cache:
             self.cache[key] = value
-        obj, t = get_redis_object_and_type(value)
-        with self.client.pipeline() as pipe:
+        obj, t = self._encode(value)
+        with self._pipeline() as pipe:
             pipe.hset(self._addr_, key, obj)
-            pipe.hset(self._type_addr_, key, t)
-            pipe.execute()
+            if not self._compact_:
+                pipe.hset(self._type_addr_, key, t)
 
     def __delitem__(self, key):
         if self.cache:
             del self.cache[key]
-        with self.client.pipeline() as pipe:
+        with self._pipeline() as pipe:
             pipe.hdel(self._addr_, key)
-            pipe.hdel(self._type_addr_, key)
-            pipe.execute()
+            if not self._compact_:
+                pipe.hdel(self._type_addr_, key)
 
     def clear(self):
         if self.cache:
             self.cache = {}
-        self.client.delete(self._addr_)
-        self.client.delete(self._type_addr_)
+        with self._pipeline() as pipe:
+            pipe.delete(self._addr_, self._type_addr_)
 
     def copy(self):
-        # shallow copy of self
-        return RedisDict(self._load())
+        # shallow copy of self on the same node, made by the server
+        copy = RedisDict(compact=self._compact_, node=self._node_)
+        keys = [copy._addr_, self._addr_] if self._compact_ else \
+            [copy._addr_, copy._type_addr_, self._addr_, self._type_addr_]
+        with copy._pipeline() as pipe:
+            COPY_HASH_LUA_SCRIPT(pipe, keys, [SCRIPT_CHUNK_SIZE])
+        return copy
 
     @classmethod
     def fromkeys(cls, keys, val):
@@ -128,40 +213,64 @@ class RedisDict(dbase):
     def keys(self):
         if self.cache:
             return self.cache.keys()
-        return self.client.hkeys(self._addr_)
+        raw = self._near_cache_entry()
+        if raw is not None:
+            return raw[0].keys()
+        return self._reader().hkeys(self._addr_)
 
     def values(self):
         if self.cache:
             return self.cache.values()
-        with self.client.pipeline() as pipe:
-            pipe.hvals(self._addr_)
-            pipe.hvals(self._type_addr_)
-            objs, ts = pipe.execute()
-        return [get_value_from_object_and_type(obj, t) for obj, t in zip(objs, ts)]
+        if self._compact_:
+            objs, ts = split_tagged_objects(self._reader().hvals(self._addr_))
+        else:
+            with self._reader().pipeline() as pipe:
+                pipe.hvals(self._addr_)
+                pipe.hvals(self._type_addr_)
+                objs, ts = pipe.execute()
+        return get_values_from_objects_and_types(objs, ts)
     
-    # Doesn't seem necessary to implement iterator
-    def iteritems(self):
-        return self.items()
-    def iterkeys(self):
-        return self.keys()
-    def itervalues(self):
-        return self.values()
+    # The iterators stream the hash with HSCAN, count is passed as the COUNT hint.
+    # As with HSCAN itself, a key may be returned more than once if the dict
+    # is modified while iterating.
+    def iteritems(self, count=DEFAULT_SCAN_COUNT):
+        """
+        >>> d = RedisDict({"a":1, "b":2.0})
+        >>> sorted(d.iteritems(count=1))
+        [('a', 1), ('b', 2.0)]
+        """
+        if self.cache:
+            return self.cache.iteritems()
+        return self._scan_items(count)
+
+    def iterkeys(self, count=DEFAULT_SCAN_COUNT):
+        if self.cache:
+            return self.cache.iterkeys()
+        return (key for key, obj in self._reader().hscan_iter(self._addr_, count=count))
+
+    def itervalues(self, count=DEFAULT_SCAN_COUNT):
+        if self.cache:
+            return self.cache.itervalues()
+        return (value for key, value in self._scan_items(count))
 
-    def update(self, updates): 
+    def update(self, updates):
+        # updates is a dict or an iterable of (k, v), consumed as it goes and
+        # written BULK_CHUNK_SIZE fields at a time, see dbase._pipeline_chunks
         if self.cache:
+            updates = dict(updates)
             self.cache.update(updates)
-        if hasattr(updates, "items"): # has to be a list [(k, v), (k, v) ...]
+        if hasattr(updates, "iteritems"):
+            updates = updates.iteritems()
+        elif hasattr(updates, "items"):
             updates = updates.items()
-        objdict ={} 
-        tdict = {}
-        for k, v in updates:
-            obj, t = get_redis_object_and_type(v)
-            objdict[k] = obj
-            tdict[k] = t        
-        with self.client.pipeline() as pipe:
-            pipe.hmset(self._addr_, objdict)
-            pipe.hmset(self._type_addr_, tdict)
-            pipe.execute()
+        encoded = ((k,) + self._encode(v) for k, v in updates)
+        self._pipeline_chunks(encoded, self._queue_hset)
+
+    def _queue_hset(self, pipe, encoded):
+        # a chunk of (k, obj, t), one variadic HSET per hash
+        pipe.hset(self._addr_, mapping=dict((k, obj) for k, obj, t in encoded))
+        if not self._compact_:
+            pipe.hset(self._type_addr_, mapping=dict((k, t) for k, obj, t in encoded))
 
     def setdefault(self, k, d):
         if self.cache:
@@ -174,6 +283,19 @@ class RedisDict(dbase):
 
     def pop(self, k, d=None):
         if self.cache:
-            self.cache.pop(k)
-        v = self.client.eval(POP_ITEM_LUA_SCRIPT, 2, self._addr_, self._type_addr_, k)
-        return v
+            self.cache.pop(k, None)
+        with self.client.pipeline() as pipe:
+            self._run_script(POP_ITEM_LUA_SCRIPT, k, pipe=pipe)
+            self._bump_version(pipe)
+            obj, t = pipe.execute()[0]
+        self._invalidate()
+        if obj is None:
+            return d
+        if self._compact_:
+            obj, t = untag_object(obj)
+        return get_value_from_object_and_type(obj, t)
+
+register_decoder("dmem:dict", RedisDict._from_addr)
+register_decoder("dmem:dict" + COMPACT_SUFFIX, lambda addr: RedisDict._from_addr(addr, compact=True))
+
+instrument_methods(RedisDict)
@@ -1,149 +1,673 @@
 from dbase import *
 import random, string
-import contextlib
+import sys
+import uuid
+import collections
 from utils import *
+from instrument import instrument_methods
+from scripts import Script
 from redisstr import RedisStr
 
-DELETE_PLACE_HOLDER = "__TO_BE_DELETED__"
+DEFAULT_PAGE_SIZE = 1000
 
-FIND_ITEM_LUA_SCRIPT= """
-local key = KEYS[1]
-local obj = ARGV[1]
-local tkey = KEYS[2]
-local tobj = ARGV[2]
-local items = redis.call('lrange', key, 0, -1)
-local types = redis.call('lrange', tkey, 0, -1)
-for i = 1, #items do
-    if items[i] == obj and types[i] == tobj then
-        return i - 1
+# Every list script gets the keys of RedisList._script_keys(): the value list,
+# the type list of typed lists, then the index hash of indexed lists. The index
+# counts the occurrences of each item, as the stored item for compact lists and
+# "type#value" for typed ones, fields are removed when their count drops to 0
+LIST_KEYS_LUA_FUNCTION = """
+local function list_keys(keys)
+    local lists = {}
+    local index = nil
+    for k = 1, #keys do
+        if string.sub(keys[k], 1, %d) == '%s' then
+            index = keys[k]
+        else
+            lists[#lists+1] = keys[k]
+        end
     end
-end 
-return -1
-"""
+    return lists, index
+end
+
+-- t is nil for compact lists
+local function index_field(obj, t)
+    if t then
+        return t .. '#' .. obj
+    end
+    return obj
+end
+
+-- adds delta to the counts of values (with their types for typed lists)
+local function index_update(index, values, types, delta)
+    if not index then
+        return
+    end
+    for i = 1, #values do
+        local field = index_field(values[i], types and types[i])
+        if redis.call('hincrby', index, field, delta) <= 0 then
+            redis.call('hdel', index, field)
+        end
+    end
+end
+""" % (len(INDEX_PREFIX), INDEX_PREFIX)
 
-REVERSE_LUA_SCRIPT = """
-local key = KEYS[1]
-local tkey = KEYS[2]
-local llen = redis.call('llen', key)
-local half = math.floor(llen/2)
-for i = 1, half do
-    local obj1 = redis.call('lindex', key, i-1)
-    local obj2 = redis.call('lindex', key, llen-i)
-    redis.call('lset', key, i-1, obj2)
-    redis.call('lset', key, llen-i, obj1)
-    obj1 = redis.call('lindex', tkey, i-1)
-    obj2 = redis.call('lindex', tkey, llen-i)
-    redis.call('lset', tkey, i-1, obj2)
-    redis.call('lset', tkey, llen-i, obj1)
+# the index of the first item equal to obj (of type t for typed lists), or -1,
+# stopping at the first match. LPOS finds candidates without moving the list to
+# Lua, asking for twice as many each time the types didn't match. The types of
+# the candidates within chunk items of each other come with one LRANGE, and once
+# chunk candidates didn't match the lists are scanned instead. Servers older
+# than 6.0.6 don't have LPOS and get the scan in Lua, chunk items at a time
+FIND_LUA_FUNCTION = """
+local function scan(lists, obj, t, chunk)
+    local llen = redis.call('llen', lists[1])
+    for start = 0, llen - 1, chunk do
+        local items = redis.call('lrange', lists[1], start, start + chunk - 1)
+        local types = {}
+        if lists[2] then
+            types = redis.call('lrange', lists[2], start, start + chunk - 1)
+        end
+        for i = 1, #items do
+            if items[i] == obj and (not lists[2] or types[i] == t) then
+                return start + i - 1
+            end
+        end
+    end
+    return -1
+end
+
+local function find(lists, obj, t, chunk)
+    local wanted = 1
+    local checked = 0
+    while true do
+        local found = redis.pcall('lpos', lists[1], obj, 'COUNT', wanted)
+        if found.err then
+            return scan(lists, obj, t, chunk)
+        end
+        if not lists[2] then
+            return found[1] or -1
+        end
+        local i = checked + 1
+        while i <= #found do
+            local first = found[i]
+            local types = redis.call('lrange', lists[2], first, math.min(first + chunk, found[#found] + 1) - 1)
+            while i <= #found and found[i] < first + chunk do
+                if types[found[i] - first + 1] == t then
+                    return found[i]
+                end
+                i = i + 1
+            end
+        end
+        if #found < wanted then
+            return -1
+        end
+        if #found >= chunk then
+            return scan(lists, obj, t, chunk)
+        end
+        checked = #found
+        wanted = wanted * 2
+    end
 end
 """
 
-INSERT_LUA_SCRIPT = """
-local key = KEYS[1]
-local tkey = KEYS[2]
-local idx = tonumber(ARGV[1])
-local obj = ARGV[2]
-local t = ARGV[3]
-
-local llen = redis.call('llen', key)
-if idx >= llen then 
-    redis.call('rpush', key, obj)
-    redis.call('rpush', tkey, t)
-else
-    local val = redis.call('lindex', key, idx)
-    local valt = redis.call('lindex', tkey, idx)
-    redis.call('lset', key, idx, '_REDIS_LUA_PLACEHOLDER_')
-    redis.call('lset', tkey, idx, '_REDIS_LUA_PLACEHOLDER_')
-    redis.call('linsert', key, 'BEFORE', '_REDIS_LUA_PLACEHOLDER_', obj)
-    redis.call('linsert', tkey, 'BEFORE', '_REDIS_LUA_PLACEHOLDER_', t)
-    redis.call('lset', key, idx+1, val)
-    redis.call('lset', tkey, idx+1, valt)
+# ARGV: obj, t, chunk size. Indexed lists answer -1 without looking at the list
+FIND_ITEM_LUA_SCRIPT = Script(LIST_KEYS_LUA_FUNCTION + FIND_LUA_FUNCTION + """
+local lists, index = list_keys(KEYS)
+if index and redis.call('hexists', index, index_field(ARGV[1], lists[2] and ARGV[2])) == 0 then
+    return -1
+end
+return find(lists, ARGV[1], ARGV[2], tonumber(ARGV[3]))
+""")
+
+# reverses each list in one pass, LPUSH reverses the order of the items
+REVERSE_LUA_SCRIPT = Script(LIST_KEYS_LUA_FUNCTION + """
+local lists = list_keys(KEYS)
+local chunk = tonumber(ARGV[1])
+for k = 1, #lists do
+    local items = redis.call('lrange', lists[k], 0, -1)
+    redis.call('del', lists[k])
+    for i = 1, #items, chunk do
+        redis.call('lpush', lists[k], unpack(items, i, math.min(i + chunk - 1, #items)))
+    end
+end
+""")
+
+# Replaces the items [start, stop) of the lists with the items of inserts[k]
+# (python slice semantics for the indexes), in O(n) or less:
+# - the side of the list before start or after stop, whichever is shorter, is
+#   read and pushed back around an LTRIM: O(min(start, llen - stop)) in Lua
+# - when that side is long and at most chunk items are deleted, or one inserted,
+#   they are marked with token and removed with LREM, or inserted with LINSERT,
+#   scanning from the nearest end: a few O(n) passes, but in C and without
+#   moving the list to Lua
+SPLICE_LUA_FUNCTION = """
+local function push_all(command, key, items, chunk)
+    if command == 'lpush' then
+        -- pushed from the last chunk, LPUSH reverses the order within each one
+        for i = #items, 1, -chunk do
+            local part = {}
+            for j = i, math.max(i - chunk + 1, 1), -1 do
+                part[#part+1] = items[j]
+            end
+            redis.call('lpush', key, unpack(part))
+        end
+    else
+        for i = 1, #items, chunk do
+            redis.call('rpush', key, unpack(items, i, math.min(i + chunk - 1, #items)))
+        end
+    end
+end
+
+local function splice_in_place(key, start, stop, items, token, llen)
+    if stop > start then
+        for i = start, stop - 1 do
+            redis.call('lset', key, i, token)
+        end
+        local count = stop - start
+        if start > llen - stop then
+            count = -count
+        end
+        redis.call('lrem', key, count, token)
+    elseif #items > 0 then
+        local pivot = redis.call('lindex', key, start)
+        redis.call('lset', key, start, token)
+        redis.call('linsert', key, 'BEFORE', token, items[1])
+        redis.call('lset', key, start + 1, pivot)
+    end
+end
+
+local function splice(lists, index, start, stop, inserts, chunk, token)
+    local llen = redis.call('llen', lists[1])
+    if start < 0 then start = math.max(llen + start, 0) end
+    if stop < 0 then stop = math.max(llen + stop, 0) end
+    start = math.min(start, llen)
+    stop = math.min(math.max(stop, start), llen)
+    if index and stop > start then
+        local removed = {}
+        for k = 1, #lists do
+            removed[k] = redis.call('lrange', lists[k], start, stop - 1)
+        end
+        index_update(index, removed[1], removed[2], -1)
+    end
+    index_update(index, inserts[1], inserts[2], 1)
+    local side = math.min(start, llen - stop)
+    local in_place = side > chunk and stop - start <= chunk and
+        ((stop == start and #inserts[1] == 1) or #inserts[1] == 0)
+    for k = 1, #lists do
+        if in_place then
+            splice_in_place(lists[k], start, stop, inserts[k], token, llen)
+        elseif start <= llen - stop then
+            local front = {}
+            if start > 0 then
+                front = redis.call('lrange', lists[k], 0, start - 1)
+            end
+            redis.call('ltrim', lists[k], stop, -1)
+            push_all('lpush', lists[k], inserts[k], chunk)
+            push_all('lpush', lists[k], front, chunk)
+        else
+            local back = redis.call('lrange', lists[k], stop, -1)
+            redis.call('ltrim', lists[k], 0, start - 1)
+            push_all('rpush', lists[k], inserts[k], chunk)
+            push_all('rpush', lists[k], back, chunk)
+        end
+    end
 end
 """
 
-COUNT_LUA_SCRIPT = """
-local key = KEYS[1]
-local tkey = KEYS[2]
+# ARGV: chunk size, token, strict, start, stop, then the inserted items of each
+# list. With strict set, start must be an existing index, as for LSET
+SPLICE_LUA_SCRIPT = Script(LIST_KEYS_LUA_FUNCTION + SPLICE_LUA_FUNCTION + """
+local lists, index = list_keys(KEYS)
+local chunk, token = tonumber(ARGV[1]), ARGV[2]
+local start, stop = tonumber(ARGV[4]), tonumber(ARGV[5])
+if ARGV[3] == '1' then
+    local llen = redis.call('llen', lists[1])
+    if start >= llen or start < -llen then
+        return redis.error_reply('ERR index out of range')
+    end
+end
+local n = (#ARGV - 5) / #lists
+local inserts = {}
+for k = 1, #lists do
+    inserts[k] = {unpack(ARGV, 6 + (k-1)*n, 5 + k*n)}
+end
+splice(lists, index, start, stop, inserts, chunk, token)
+""")
+
+# removes the first item equal to ARGV[3] (of type ARGV[4]), returns its index or -1
+REMOVE_LUA_SCRIPT = Script(LIST_KEYS_LUA_FUNCTION + FIND_LUA_FUNCTION + SPLICE_LUA_FUNCTION + """
+local lists, index = list_keys(KEYS)
+local chunk = tonumber(ARGV[1])
+if index and redis.call('hexists', index, index_field(ARGV[3], lists[2] and ARGV[4])) == 0 then
+    return -1
+end
+local idx = find(lists, ARGV[3], ARGV[4], chunk)
+if idx >= 0 then
+    splice(lists, index, idx, idx + 1, {{}, {}}, chunk, ARGV[2])
+end
+return idx
+""")
+
+# LSET of an indexed list, ARGV: index, obj, t
+SET_ITEM_LUA_SCRIPT = Script(LIST_KEYS_LUA_FUNCTION + """
+local lists, index = list_keys(KEYS)
+local old = {}
+for k = 1, #lists do
+    old[k] = redis.call('lindex', lists[k], ARGV[1])
+end
+if not old[1] then
+    return redis.error_reply('ERR index out of range')
+end
+for k = 1, #lists do
+    redis.call('lset', lists[k], ARGV[1], ARGV[k + 1])
+end
+index_update(index, {old[1]}, lists[2] and {old[2]}, -1)
+index_update(index, {ARGV[2]}, lists[2] and {ARGV[3]}, 1)
+""")
+
+# RPOP or LPOP (ARGV[1]) of an indexed list, returns the item and its type,
+# false for both if the list is empty
+POP_LUA_SCRIPT = Script(LIST_KEYS_LUA_FUNCTION + """
+local lists, index = list_keys(KEYS)
+local popped = {}
+for k = 1, #lists do
+    popped[k] = redis.call(ARGV[1], lists[k])
+end
+if not popped[1] then
+    return {false, false}
+end
+index_update(index, {popped[1]}, lists[2] and {popped[2]}, -1)
+return popped
+""")
+
+COUNT_LUA_SCRIPT = Script(LIST_KEYS_LUA_FUNCTION + """
+local lists = list_keys(KEYS)
 local target = ARGV[1]
 local t = ARGV[2]
-local items = redis.call('lrange', key, 0, -1)
-local types = redis.call('lrange', tkey, 0, -1)
+local items = redis.call('lrange', lists[1], 0, -1)
+local types = {}
+if lists[2] then
+    types = redis.call('lrange', lists[2], 0, -1)
+end
 local cnt = 0
 for i = 1, #items do
-    if items[i] == target and types[i] == t then
+    if items[i] == target and (not lists[2] or types[i] == t) then
         cnt = cnt+1
     end
 end 
 return cnt
-"""
+""")
 
-DELSLICE_LUA_SCRIPT = """
-local key = KEYS[1]
-local tkey = KEYS[2]
-local start = tonumber(ARGV[1])
-local stop = tonumber(ARGV[2])
+# appends the source lists (after the destination lists) in chunks of ARGV[1]
+# items, the length is taken first so that l.extend(l) terminates
+COPY_LIST_LUA_SCRIPT = Script(LIST_KEYS_LUA_FUNCTION + """
+local lists, index = list_keys(KEYS)
+local n = #lists / 2
+local len = redis.call('llen', lists[n+1])
+local chunk = tonumber(ARGV[1])
+for start = 0, len - 1, chunk do
+    local copied = {}
+    for k = 1, n do
+        copied[k] = redis.call('lrange', lists[n+k], start, math.min(start + chunk, len) - 1)
+        redis.call('rpush', lists[k], unpack(copied[k]))
+    end
+    index_update(index, copied[1], n > 1 and copied[2], 1)
+end
+return len
+""")
 
-local llen = redis.call('llen', key)
-if stop > llen then
-    stop = llen
+# Sorts the lists in place by the items' python order: numbers (text or packed)
+# by value before the other types, which are ordered by type name then by their
+# stored string. With alpha every item is compared by its stored string, as
+# SORT ALPHA does. With a field name (ARGV[4]) items are ordered by that field
+# of the dicts or objects they reference, None first for the others. The sort is
+# stable and reverse keeps equal items in their order, like list.sort().
+# A typed list of numbers of one type (in text) is sorted by SORT itself. Returns -1, without sorting, when a referenced dict lives on
+# another node than ARGV[5], its field can't be read here.
+# ARGV[6:] are (type name or tag, kind, hash) triples, see _sort_kinds()
+SORT_LUA_SCRIPT = Script(LIST_KEYS_LUA_FUNCTION + """
+local lists = list_keys(KEYS)
+local chunk = tonumber(ARGV[1])
+local reverse = ARGV[2] == '1'
+local alpha = ARGV[3] == '1'
+local by = ARGV[4]
+local node = ARGV[5]
+local kinds, hashes = {}, {}
+for i = 6, #ARGV, 3 do
+    kinds[ARGV[i]] = ARGV[i+1]
+    hashes[ARGV[i]] = ARGV[i+2]
 end
-for i = start, stop-1 do
-    redis.call('lset', key, i, '_REDIS_LUA_PLACEHOLDER_')
-    redis.call('lset', tkey, i, '_REDIS_LUA_PLACEHOLDER_')
+local values = redis.call('lrange', lists[1], 0, -1)
+local types = lists[2] and redis.call('lrange', lists[2], 0, -1)
+local n = #values
+
+local function untag(tagged)
+    local at = string.find(tagged, '#', 1, true)
+    return string.sub(tagged, at + 1), string.sub(tagged, 1, at - 1)
 end
-redis.call('lrem', key, stop-start, '_REDIS_LUA_PLACEHOLDER_')
-redis.call('lrem', tkey, stop-start, '_REDIS_LUA_PLACEHOLDER_')
-"""
+
+if types and by == '' and n > 1 then
+    local t = types[1]
+    local same = true
+    for i = 2, n do
+        if types[i] ~= t then
+            same = false
+            break
+        end
+    end
+    if same and kinds[t] == '#n' and not alpha then
+        -- a list holding nan, which SORT can't parse, takes the lua sort
+        local stored = redis.pcall('sort', lists[1], reverse and 'desc' or 'asc', 'store', lists[1])
+        if type(stored) == 'number' then
+            return n
+        end
+    end
+end
+
+-- items are grouped by sort key, numbers by value and the others by "order name,
+-- stored string", and the distinct keys sorted by table.sort without a
+-- comparator, which compares in C. A group keeps its positions in list order,
+-- so the sort is stable. \0 is escaped as \0\1 and the two parts separated by
+-- \0\0, which keeps the order of the bytes
+local nones = {}
+local groups = {{}, {}}
+local keys = {{}, {}}
+
+local function escape(s)
+    if string.find(s, '\\0', 1, true) then
+        return (string.gsub(s, '%z', '\\0\\1'))
+    end
+    return s
+end
+
+local function add(g, key, i)
+    local group = groups[g][key]
+    if group == nil then
+        -- most keys are unique, a single position is stored as is
+        groups[g][key] = i
+        keys[g][#keys[g]+1] = key
+    elseif type(group) == 'number' then
+        groups[g][key] = {group, i}
+    else
+        group[#group+1] = i
+    end
+end
+
+local function rank(i, obj, t)
+    if not obj then
+        nones[#nones+1] = i
+        return
+    end
+    if alpha then
+        add(2, obj, i)
+        return
+    end
+    local kind = kinds[t] or t
+    local num = nil
+    if kind == '#n' then
+        num = tonumber(obj)
+    elseif kind == '#bi' then
+        num = struct.unpack('>i' .. #obj, obj)
+    elseif kind == '#bf' then
+        num = struct.unpack('>d', obj)
+    elseif kind == '#bb' then
+        num = obj == '\\1' and 1 or 0
+    end
+    -- nan can't be a table key
+    if num and num == num then
+        add(1, num, i)
+    else
+        add(2, escape(kind) .. '\\0\\0' .. escape(obj), i)
+    end
+end
+
+for i = 1, n do
+    local obj, t
+    if types then
+        obj, t = values[i], types[i]
+    else
+        obj, t = untag(values[i])
+    end
+    if by == '' then
+        rank(i, obj, t)
+    elseif hashes[t] ~= 't' and hashes[t] ~= 'c' then
+        rank(i, nil)
+    elseif string.sub(obj, 1, #node) ~= node then
+        return -1
+    elseif hashes[t] == 'c' then
+        local tagged = redis.call('hget', obj, by)
+        if tagged then
+            rank(i, untag(tagged))
+        else
+            rank(i, nil)
+        end
+    else
+        rank(i, redis.call('hget', obj, by), redis.call('hget', '_type_' .. obj, by))
+    end
+end
+
+-- lua compares strings with the server's collation, python compares bytes
+local bytewise = not ('a' < 'B')
+local function bytes_less(x, y)
+    for i = 1, math.min(#x, #y) do
+        local a, b = string.byte(x, i), string.byte(y, i)
+        if a ~= b then
+            return a < b
+        end
+    end
+    return #x < #y
+end
+table.sort(keys[1])
+if bytewise then
+    table.sort(keys[2])
+else
+    table.sort(keys[2], bytes_less)
+end
+
+-- None before the numbers before the rest, the other way round for reverse
+local order = {}
+local function take(g)
+    local first, last, step = 1, #keys[g], 1
+    if reverse then
+        first, last, step = last, first, -1
+    end
+    for k = first, last, step do
+        local group = groups[g][keys[g][k]]
+        if type(group) == 'number' then
+            order[#order+1] = group
+        else
+            for j = 1, #group do
+                order[#order+1] = group[j]
+            end
+        end
+    end
+end
+if not reverse then
+    for k = 1, #nones do
+        order[k] = nones[k]
+    end
+end
+take(reverse and 2 or 1)
+take(reverse and 1 or 2)
+if reverse then
+    for k = 1, #nones do
+        order[#order+1] = nones[k]
+    end
+end
+
+for k = 1, #lists do
+    local items = k == 1 and values or types
+    redis.call('del', lists[k])
+    for start = 1, n, chunk do
+        local sorted = {}
+        for i = start, math.min(start + chunk - 1, n) do
+            sorted[#sorted+1] = items[order[i]]
+        end
+        redis.call('rpush', lists[k], unpack(sorted))
+    end
+end
+return n
+""")
+
+# numbers sorted by value, see SORT_LUA_SCRIPT: text, packed ints, floats and bools
+SORT_NUMBER_KINDS = {"int": "#n", "long": "#n", "float": "#n", "bool": "#n",
+                     "bint": "#bi", "bfloat": "#bf", "bbool": "#bb"}
+# python orders values of different types by the name of their class
+SORT_CLASS_NAMES = {"str": "str", "dmem:str": "RedisStr", "dmem:list": "RedisList",
+                    "dmem:dict": "RedisDict", "dmem:set": "RedisSet", "dmem:object": "RedisObject"}
+
+def _sort_kinds():
+    # the ARGV triples of SORT_LUA_SCRIPT: each type name and its tag, how its
+    # items are compared and whether they are typed ("t") or compact ("c") hashes
+    args = []
+    for t, tag in TYPE_TAGS.items():
+        base = ":".join(t.split(":")[:2])
+        kind = SORT_NUMBER_KINDS.get(t) or SORT_CLASS_NAMES.get(base, t)
+        hashed = ""
+        if base in ("dmem:dict", "dmem:object"):
+            hashed = "c" if t.endswith(COMPACT_SUFFIX) else "t"
+        args.extend([t, kind, hashed])
+        if tag != t:
+            args.extend([tag, kind, hashed])
+    return args
+
+def _sort_field(v, field):
+    # the field of a dict or object item, which sort(by=field) orders by
+    if isinstance(v, dbase) and v._type_.startswith("dmem:dict"):
+        return v[field]
+    if isinstance(v, dbase) and v._type_.startswith("dmem:object"):
+        return getattr(v, field, None)
+    return None
+
+def _splice_token():
+    # marks the items a splice removes in place, unique so it can't match an item
+    return "_splice_" + uuid.uuid4().hex
 
 class RedisList(dbase):
-    def __init__(self, _list=None):
+    _indexed_ = False
+
+    def __init__(self, _list=None, compact=False, node=None, indexed=False):
         """
         >>> l = RedisList([1,2.0,True,"abc"])
         >>> l._load()
         [1, 2.0, True, 'abc']
         >>> l._load_objects_and_types()
         (['1', '2.0', '1', 'abc'], ['int', 'float', 'bool', 'str'])
+
+        With compact=True each item is stored as "tag#value" in the list itself,
+        there's no parallel _type_ list:
+        >>> l = RedisList([1,2.0,True,"abc"], compact=True)
+        >>> l.client.lrange(l._addr_, 0, -1)
+        ['i#1', 'f#2.0', 'b#1', 's#abc']
+
+        With indexed=True the number of occurrences of each item is kept in a hash
+        next to the list, updated by every mutation in the same script or pipeline,
+        so that `in` and count() are a single HEXISTS/HGET:
+        >>> l = RedisList(["a", "b", "a"], indexed=True)
+        >>> l.count("a"), "c" in l
+        (2, False)
         """
-        dbase.__init__(self)
+        self._indexed_ = indexed
+        dbase.__init__(self, compact, node)
         # save to redis when initializing
         if _list:
             self.extend(_list)
         
     def initialize(self):
-        self._type_ = "dmem:list"
+        self._type_ = "dmem:list" + (COMPACT_SUFFIX if self._compact_ else "") + \
+            (INDEXED_SUFFIX if self._indexed_ else "")
         self._type_addr_ = "_type_" + self._addr_
+        self._index_addr_ = INDEX_PREFIX + self._addr_
         self.cache = None
 
-    def _load_objects_and_types(self):
-        objects = self.client.lrange(self._addr_, 0, -1)
-        types = self.client.lrange(self._type_addr_, 0, -1)
+    def _script_keys(self):
+        # see LIST_KEYS_LUA_FUNCTION
+        keys = dbase._script_keys(self)
+        if self._indexed_:
+            keys.append(self._index_addr_)
+        return keys
+
+    def _index_field(self, obj, t):
+        # the field counting an encoded item in the index
+        return obj if self._compact_ else t + "#" + obj
+
+    def _load_range(self, start, stop):
+        # values and types of a range come back in a single round trip
+        if self._compact_:
+            return split_tagged_objects(self._reader().lrange(self._addr_, start, stop))
+        with self._reader().pipeline() as pipe:
+            pipe.lrange(self._addr_, start, stop)
+            pipe.lrange(self._type_addr_, start, stop)
+            objects, types = pipe.execute()
         return objects, types
 
+    def _load_objects_and_types(self):
+        return self._near_cached(lambda: self._load_range(0, -1))
+
     def _load(self):
         objs, types = self._load_objects_and_types()
         assert(len(objs) == len(types))
-        values = []
-        for i in range(len(objs)):
-            value = get_value_from_object_and_type(objs[i], types[i])
-            values.append(value)
-        return values
+        return get_values_from_objects_and_types(objs, types)
+
+    def _queue_load(self, pipe):
+        # queues the reads of _load() on pipe, _parse_load() decodes their replies
+        pipe.lrange(self._addr_, 0, -1)
+        if not self._compact_:
+            pipe.lrange(self._type_addr_, 0, -1)
+
+    def _parse_load(self, replies):
+        if self._compact_:
+            objs, types = split_tagged_objects(next(replies))
+        else:
+            objs, types = next(replies), next(replies)
+        return get_values_from_objects_and_types(objs, types)
 
     def destroy(self):
         dbase.destroy(self)
-        self.client.delete(self._type_addr_)
+        self.client.delete(self._type_addr_, self._index_addr_)
         
-    @contextlib.contextmanager
-    def loaded(self):
-        self.cache = self._load()
-        try: 
-            yield self.cache
-        finally:
-            self.cache = None
-    
     def __iter__(self):
-	if self.cache:
-		return iter(self.cache)
-	return iter(self._load())
+        if self.cache:
+            return iter(self.cache)
+        return self.iterate()
+
+    def _load_page(self, start, page_size):
+        return self._load_range(start, start+page_size-1)
+
+    def _iter_raw(self, page_size=DEFAULT_PAGE_SIZE):
+        # the (obj, t) pairs of the list, read a page at a time
+        start = 0
+        while True:
+            objs, types = self._load_page(start, page_size)
+            for item in zip(objs, types):
+                yield item
+            if len(objs) < page_size:
+                break
+            start += len(objs)
+
+    def iterate(self, page_size=DEFAULT_PAGE_SIZE, prefetch=False):
+        """ Stream the list in pages of page_size items, decoding a page only when
+        it's reached, so only one page (two with prefetch) is held in memory at a time.
+        With prefetch=True the next page is fetched in a background thread
+        while the current one is consumed.
+        If the list is modified while iterating, items may be skipped or repeated.
+        >>> l = RedisList(range(5))
+        >>> list(l.iterate(page_size=2, prefetch=True))
+        [0, 1, 2, 3, 4]
+        """
+        start = 0
+        objs, types = self._load_page(start, page_size)
+        while objs:
+            start += len(objs)
+            pending = None
+            if len(objs) == page_size and prefetch:
+                pending = BackgroundCall(self._load_page, start, page_size)
+            for value in get_values_from_objects_and_types(objs, types):
+                yield value
+            if len(objs) < page_size:
+                break
+            if pending:
+                objs, types = pending.result()
+            else:
+                objs, types = self._load_page(start, page_size)
 
     def __len__(self):
         """
@@ -157,8 +681,10 @@ class RedisList(dbase):
         """
         if self.cache:
             return len(self.cache)
-        else:
-            return self.client.llen(self._addr_)
+        raw = self._near_cache_entry()
+        if raw is not None:
+            return len(raw[0])
+        return self._reader().llen(self._addr_)
 
     def __getitem__(self, idx):
         """
@@ -179,10 +705,19 @@ class RedisList(dbase):
         """
         if self.cache:
             return self.cache[idx]
-        with self.client.pipeline() as pipe:
-            pipe.lindex(self._addr_, idx)
-            pipe.lindex(self._type_addr_, idx)
-            [obj, t] = pipe.execute()
+        raw = self._near_cache_entry()
+        if raw is not None:
+            objs, types = raw
+            if not -len(objs) <= idx < len(objs):
+                raise IndexError("Index out of range")
+            return get_value_from_object_and_type(objs[idx], types[idx])
+        if self._compact_:
+            obj, t = untag_object(self._reader().lindex(self._addr_, idx))
+        else:
+            with self._reader().pipeline() as pipe:
+                pipe.lindex(self._addr_, idx)
+                pipe.lindex(self._type_addr_, idx)
+                [obj, t] = pipe.execute()
         if not obj:
             raise IndexError("Index out of range")
         v = get_value_from_object_and_type(obj, t)
@@ -206,11 +741,14 @@ class RedisList(dbase):
         """
         if self.cache:
             self.cache[idx] = val
-        obj, t = get_redis_object_and_type(val)
-        with self.client.pipeline() as pipe:
-            pipe.lset(self._addr_, idx, obj)
-            pipe.lset(self._type_addr_, idx, t)
-            pipe.execute()
+        obj, t = self._encode(val)
+        with self._pipeline() as pipe:
+            if self._indexed_:
+                self._run_script(SET_ITEM_LUA_SCRIPT, idx, obj, t or "", pipe=pipe)
+            else:
+                pipe.lset(self._addr_, idx, obj)
+                if not self._compact_:
+                    pipe.lset(self._type_addr_, idx, t)
 
     def __delitem__(self, idx):
         """
@@ -226,12 +764,22 @@ class RedisList(dbase):
         """
         if self.cache:
             del self.cache[idx]
-        with self.client.pipeline() as pipe:
-            pipe.lset(self._addr_, idx, DELETE_PLACE_HOLDER)
-            pipe.lrem(self._addr_, 1, DELETE_PLACE_HOLDER)
-            pipe.lset(self._type_addr_, idx, DELETE_PLACE_HOLDER)
-            pipe.lrem(self._type_addr_, 1, DELETE_PLACE_HOLDER)
-            pipe.execute()
+        self._delete_at(idx)
+
+    def _delete_at(self, idx):
+        # idx + 1 would be the head of the list for the last item
+        stop = idx + 1 if idx != -1 else sys.maxint
+        with self._pipeline() as pipe:
+            self._splice(pipe, idx, stop, strict=True)
+
+    def _splice(self, pipe, start, stop, encoded=(), strict=False):
+        # queues the replacement of the items [start, stop) by the (obj, t)
+        # pairs of encoded, see SPLICE_LUA_SCRIPT
+        args = [obj for obj, t in encoded]
+        if not self._compact_:
+            args += [t for obj, t in encoded]
+        self._run_script(SPLICE_LUA_SCRIPT, SCRIPT_CHUNK_SIZE, _splice_token(), 1 if strict else 0,
+                         start, stop, *args, pipe=pipe)
 
     def __getslice__(self, start, end):
         """
@@ -245,12 +793,11 @@ class RedisList(dbase):
             return self.cache[start:end]
         if end==0:
             return []
-        objs = self.client.lrange(self._addr_, start, end-1)
-        ts = self.client.lrange(self._type_addr_, start, end-1)
-        values = []
-        for obj, t in zip(objs, ts):
-            values.append(get_value_from_object_and_type(obj, t))
-        return values
+        raw = self._near_cache_entry()
+        if raw is not None:
+            return get_values_from_objects_and_types(raw[0][start:end], raw[1][start:end])
+        objs, ts = self._load_range(start, end-1)
+        return get_values_from_objects_and_types(objs, ts)
 
     def __delslice__(self, start, end):
         """
@@ -262,19 +809,21 @@ class RedisList(dbase):
         >>> l._load()
         [2.0]
         """
+        # python already added the length to negative bounds, the script would
+        # add it again
+        start, end = max(start, 0), max(end, 0)
         if self.cache:
             del self.cache[start:end]
-        if start == 0:
-            self.client.ltrim(self._addr_, end, -1)
-            self.client.ltrim(self._type_addr_, end, -1)
-        else:
-            self.client.eval(DELSLICE_LUA_SCRIPT, 2, self._addr_, self._type_addr_, start, end)
+        with self._pipeline() as pipe:
+            self._splice(pipe, start, end)
 
     def __contains__(self, val):
         if self.cache:
             return val in self.cache
-        obj, t = get_redis_object_and_type(val)
-        idx = self.client.eval(FIND_ITEM_LUA_SCRIPT, 2, self._addr_, self._type_addr_, obj, t)
+        if self._indexed_:
+            obj, t = self._encode(val)
+            return self._reader().hexists(self._index_addr_, self._index_field(obj, t))
+        idx = self._find(val)
         if idx < 0:
             return False
         return True
@@ -290,43 +839,74 @@ class RedisList(dbase):
         """
         if self.cache:
             self.cache.append(val)
-        obj, t = get_redis_object_and_type(val)
-        with self.client.pipeline() as pipe:
+        obj, t = self._encode(val)
+        with self._pipeline() as pipe:
             pipe.rpush(self._addr_, obj)
-            pipe.rpush(self._type_addr_, t)
-            pipe.execute()
+            if not self._compact_:
+                pipe.rpush(self._type_addr_, t)
+            if self._indexed_:
+                pipe.hincrby(self._index_addr_, self._index_field(obj, t), 1)
 
     def extend(self, iterable):
+        """ Items are pushed BULK_CHUNK_SIZE at a time with variadic RPUSH, and
+        iterable is consumed as it goes, see dbase._pipeline_chunks
+        >>> l = RedisList(xrange(100000))
+        >>> len(l)
+        100000
+        """
         if isinstance(iterable, RedisList):
-            objs, types = iterable._load_objects_and_types()
-            # multi value rpush only after redis >= 2.4
-            # self.client.rpush(self._addr_, *objs)
-            # self.client.rpush(self._type_addr_, *types)
-            with self.client.pipeline() as pipe:
-                for obj, t in zip(objs, types):
-                    pipe.rpush(self._addr_, obj)
-                    pipe.rpush(self._type_addr_, t)
-                pipe.execute()
-        else:            
+            if iterable._node_ == self._node_ and iterable._compact_ == self._compact_:
+                # copied by the server, the items never come to the client
+                keys = self._script_keys() + dbase._script_keys(iterable)
+                with self._pipeline() as pipe:
+                    COPY_LIST_LUA_SCRIPT(pipe, keys, [SCRIPT_CHUNK_SIZE])
+                return
+            # read page by page, from another node or with the other encoding
+            if self._compact_:
+                encoded = ((tag_object(obj, t), None) for obj, t in iterable._iter_raw())
+            else:
+                encoded = iterable._iter_raw()
+        else:
             if isinstance(iterable, RedisStr):
                 iterable = iterable.value()
-            for item in iterable:
-                obj, t = get_redis_object_and_type(item)
-                self.client.rpush(self._addr_, obj)
-                self.client.rpush(self._type_addr_, t)
+            encoded = (self._encode(item) for item in iterable)
+        self._pipeline_chunks(encoded, self._queue_push)
+
+    def _queue_push(self, pipe, encoded):
+        # a chunk of (obj, t) pairs, one RPUSH per key
+        pipe.rpush(self._addr_, *[obj for obj, t in encoded])
+        if not self._compact_:
+            pipe.rpush(self._type_addr_, *[t for obj, t in encoded])
+        if self._indexed_:
+            counts = collections.Counter(self._index_field(obj, t) for obj, t in encoded)
+            for field, count in counts.iteritems():
+                pipe.hincrby(self._index_addr_, field, count)
 
     def pop(self):
         if self.cache:
             self.cache.pop()
+        return self._pop("rpop")
+
+    def _pop(self, command):
+        # command is rpop or lpop, indexed lists pop with a script updating the index
         with self.client.pipeline() as pipe:
-            pipe.rpop(self._addr_)
-            pipe.rpop(self._type_addr_)
-            [obj, t] = pipe.execute()
-        v = get_value_from_object_and_type(obj, t)
-        return v
+            if self._indexed_:
+                self._run_script(POP_LUA_SCRIPT, command, pipe=pipe)
+            else:
+                getattr(pipe, command)(self._addr_)
+                if not self._compact_:
+                    getattr(pipe, command)(self._type_addr_)
+            self._bump_version(pipe)
+            res = pipe.execute()
+        self._invalidate()
+        if self._indexed_:
+            res = res[0]
+        if not res or res[0] is None:
+            return None     # the list was empty
+        obj, t = untag_object(res[0]) if self._compact_ else res[:2]
+        return get_value_from_object_and_type(obj, t)
 
     def remove(self, val):
-        # this is a bit convoluted, don't call this unless necessary
         """
         >>> l = RedisList([2.0, "sdfdsf", RedisList([1,2,3])])
         >>> l.append("abc")
@@ -337,29 +917,82 @@ class RedisList(dbase):
         """
         if self.cache:
             self.cache.remove(val)
-        obj, t = get_redis_object_and_type(val)
-        idx = self.client.eval(FIND_ITEM_LUA_SCRIPT, 2, self._addr_, self._type_addr_, obj, t)
-
-        if idx >= 0:
-            with self.client.pipeline() as pipe:
-                # First mark the type at index to be deleted, then call LREM
-                pipe.lset(self._addr_, idx, DELETE_PLACE_HOLDER)
-                pipe.lrem(self._addr_, 1, DELETE_PLACE_HOLDER)
-                pipe.lset(self._type_addr_, idx, DELETE_PLACE_HOLDER)
-                pipe.lrem(self._type_addr_, 1, DELETE_PLACE_HOLDER)
-                pipe.execute()
-
-    def sort(self):
-        """
-        >>> l = RedisList([1,3, 5, 24, 4, -2])
+        obj, t = self._encode(val)
+        with self._pipeline() as pipe:
+            self._run_script(REMOVE_LUA_SCRIPT, SCRIPT_CHUNK_SIZE, _splice_token(), obj, t or "",
+                             pipe=pipe)
+
+    def sort(self, key=None, reverse=False, alpha=False, by=None):
+        """ Sort the list in place on the server, values and types together, in
+        python's order: numbers by value, before the other types. As with
+        list.sort() the sort is stable, also with reverse=True.
+        >>> l = RedisList([3, "b", 1.5, "a", True])
         >>> l.sort()
         >>> l._load()
-        [-2, 1, 3, 4, 5, 24]
+        [True, 1.5, 3, 'a', 'b']
+
+        alpha=True compares the items as their stored strings, like SORT ALPHA:
+        >>> l = RedisList([10, 9, "1"])
+        >>> l.sort(alpha=True)
+        >>> l._load()
+        ['1', 10, 9]
+
+        by orders the items by a field of the dicts (or attribute of the objects)
+        they reference, "*->field" as in SORT BY is accepted too. Items without
+        it come first, as None would:
+        >>> l = RedisList([RedisDict({"age": 30}), RedisDict({"age": 20})])
+        >>> l.sort(by="age")
+        >>> [d["age"] for d in l]
+        [20, 30]
+
+        A key function can't run on the server, with one the list is loaded,
+        sorted here and written back, which isn't atomic. So are lists whose
+        dicts live on other nodes when sorting by a field.
+        Numbers are compared as doubles, ints above 2**53 may tie.
         """
-        # different from list.sort(), this doesn't accept parameters
+        if by and by.startswith("*->"):
+            by = by[3:]
         if self.cache:
-            self.cache.sort()
-        self.client.sort(self._addr_, store=self._addr_) # sort in place
+            self.cache.sort(key=self._sort_key(key, alpha, by), reverse=reverse)
+        if key is not None:
+            return self._sort_client_side(key, reverse)
+        with self.client.pipeline() as pipe:
+            self._run_script(SORT_LUA_SCRIPT, SCRIPT_CHUNK_SIZE, int(reverse), int(alpha), by or "",
+                             self._node_ + ":", *_sort_kinds(), pipe=pipe)
+            self._bump_version(pipe)
+            sorted_count = pipe.execute()[0]
+        self._invalidate()
+        if sorted_count < 0:
+            self._sort_client_side(self._sort_key(None, False, by), reverse)
+
+    @staticmethod
+    def _sort_key(key, alpha, by):
+        # the key function of list.sort() ordering local values like sort(...) does
+        if key is not None:
+            return key
+        if by:
+            return lambda v: _sort_field(v, by)
+        if alpha:
+            return lambda v: get_redis_object_and_type(v)[0]
+        return None
+
+    def _sort_client_side(self, key, reverse):
+        # sorts the (obj, t) pairs by the key of their values and rewrites the lists
+        with primary_reads():
+            objs, types = self._load_range(0, -1)
+        values = get_values_from_objects_and_types(objs, types)
+        try:
+            order = sorted(xrange(len(values)), key=lambda i: key(values[i]), reverse=reverse)
+        finally:
+            release_proxies(values)
+        with self._pipeline() as pipe:
+            pipe.delete(*dbase._script_keys(self))
+            for chunk in chunked(order):
+                if self._compact_:
+                    pipe.rpush(self._addr_, *[tag_object(objs[i], types[i]) for i in chunk])
+                else:
+                    pipe.rpush(self._addr_, *[objs[i] for i in chunk])
+                    pipe.rpush(self._type_addr_, *[types[i] for i in chunk])
 
     def index(self, val):
         """
@@ -379,40 +1012,56 @@ class RedisList(dbase):
         """
         if self.cache:
             return self.cache.index(val)
-        obj, t = get_redis_object_and_type(val)
-        idx = self.client.eval(FIND_ITEM_LUA_SCRIPT, 2, self._addr_, self._type_addr_, obj, t)
-        return idx
+        return self._find(val)
+
+    def _find(self, val):
+        obj, t = self._encode(val)
+        return self._run_script(FIND_ITEM_LUA_SCRIPT, obj, t or "", SCRIPT_CHUNK_SIZE, readonly=True)
 
     def reverse(self):
         if self.cache:
             self.cache.reverse()
-        self.client.eval(REVERSE_LUA_SCRIPT, 2, self._addr_, self._type_addr_)
+        with self._pipeline() as pipe:
+            self._run_script(REVERSE_LUA_SCRIPT, SCRIPT_CHUNK_SIZE, pipe=pipe)
 
     def insert(self,idx, val):
         if self.cache:
             self.cache.insert(idx, val)
-        obj, t = get_redis_object_and_type(val)
-        self.client.eval(INSERT_LUA_SCRIPT, 2, self._addr_, self._type_addr_, idx, obj, t)
+        obj, t = self._encode(val)
+        with self._pipeline() as pipe:
+            self._splice(pipe, idx, idx, [(obj, t)])
 
     def count(self, val):
         if self.cache:
             return self.cache.count(val)
-        obj, t = get_redis_object_and_type(val)
-        return self.client.eval(COUNT_LUA_SCRIPT, 2, self._addr_, self._type_addr_, obj, t)
+        obj, t = self._encode(val)
+        if self._indexed_:
+            return int(self._reader().hget(self._index_addr_, self._index_field(obj, t)) or 0)
+        return self._run_script(COUNT_LUA_SCRIPT, obj, t or "", readonly=True)
 
     # define methods for redis specific commands
     def lpush(self, val):
         if self.cache:
             self.cache.insert(0, val)
-        obj, t = get_redis_object_and_type(val)
-        self.client.lpush(self._addr_, obj)
-        self.client.lpush(self._type_addr_, t)
+        obj, t = self._encode(val)
+        with self._pipeline() as pipe:
+            pipe.lpush(self._addr_, obj)
+            if not self._compact_:
+                pipe.lpush(self._type_addr_, t)
+            if self._indexed_:
+                pipe.hincrby(self._index_addr_, self._index_field(obj, t), 1)
 
     def lpop(self):
         if self.cache:
             v = self.cache[0]
             del self.cache[0]
             return v
-        obj = self.client.lpop(self._addr_)
-        t = self.client.lpop(self._type_addr_)
-        return get_value_from_object_and_type(obj, t)
+        return self._pop("lpop")
+
+register_decoder("dmem:list", RedisList._from_addr)
+register_decoder("dmem:list" + COMPACT_SUFFIX, lambda addr: RedisList._from_addr(addr, compact=True))
+register_decoder("dmem:list" + INDEXED_SUFFIX, lambda addr: RedisList._from_addr(addr, indexed=True))
+register_decoder("dmem:list" + COMPACT_SUFFIX + INDEXED_SUFFIX,
+                 lambda addr: RedisList._from_addr(addr, compact=True, indexed=True))
+
+instrument_methods(RedisList)
@@ -1,79 +1,103 @@
 from dbase import *
-import contextlib
 from utils import *
+from instrument import instrument_methods
 
 class RedisObject(dbase):	
     def initialize(self):
-        self.__dict__['_type_'] = "dmem:object"
+        self.__dict__['_type_'] = "dmem:object" + (COMPACT_SUFFIX if self._compact_ else "")
         self.__dict__['_type_addr_'] = "_type_" + self._addr_
-        self.__dict__['cache'] = None
+        self.cache = None
         self.__dict__['refs'] = {}
 
     def _load_objects_and_types(self):
-        objdict = self.client.hgetall(self._addr_)
-        tdict = self.client.hgetall(self._type_addr_)
+        return self._near_cached(self._load_hashes)
+
+    def _load_hashes(self):
+        if self._compact_:
+            return split_tagged_dict(self._reader().hgetall(self._addr_))
+        with self._reader().pipeline() as pipe:
+            pipe.hgetall(self._addr_)
+            pipe.hgetall(self._type_addr_)
+            objdict, tdict = pipe.execute()
         return objdict, tdict
 
     def _load(self):
         od, td = self._load_objects_and_types()
         assert(len(od) == len(td))
-        _attributes = {}
-        for key in od:
-            obj = od[key]
-            t = td[key]
-            v = get_value_from_object_and_type(obj, t)
-            _attributes[key] = v
-        return _attributes
+        return self._decode_hashes(od, td)
+
+    @staticmethod
+    def _decode_hashes(od, td):
+        keys = od.keys()
+        return dict(zip(keys, get_values_from_objects_and_types([od[key] for key in keys],
+                                                                [td[key] for key in keys])))
+
+    def _queue_load(self, pipe):
+        # queues the reads of _load() on pipe, _parse_load() decodes their replies
+        pipe.hgetall(self._addr_)
+        if not self._compact_:
+            pipe.hgetall(self._type_addr_)
+
+    def _parse_load(self, replies):
+        if self._compact_:
+            return self._decode_hashes(*split_tagged_dict(next(replies)))
+        return self._decode_hashes(next(replies), next(replies))
 
     def destroy(self):
         dbase.destroy(self)
         self.client.delete(self._type_addr_)
 
-	@contextlib.contextmanager
-	def loaded(self):
-	    self.cache = self._load()
-	    try:
-	        yield self.cache
-	    finally:
-	        self.cache = None
-
     def __setattr__(self, name, val):
-        if callable(val) or name in ['_node_', 'client', '_addr_', '_type_', 'cache']:
+        if name == 'cache':
+            object.__setattr__(self, name, val)
+        elif callable(val) or name in ['_node_', 'client', '_addr_', '_type_', '_compact_']:
             self.__dict__[name] = val
         else:
             v, t = get_redis_object_and_type(val)
             if t.startswith("dmem"):
                 self.__dict__['refs'][name] = val
-            with self.client.pipeline() as pipe:
-                pipe.hset(self._addr_, name, v)
-                pipe.hset(self._type_addr_, name, t)
-                pipe.execute()
+            with self._pipeline() as pipe:
+                if self._compact_:
+                    pipe.hset(self._addr_, name, tag_object(v, t))
+                else:
+                    pipe.hset(self._addr_, name, v)
+                    pipe.hset(self._type_addr_, name, t)
             if self.cache:
-            	   self.cache[name] = val
+                self.cache[name] = val
 
     def __getattr__(self, name):
-    	if name in self.__dict__:
-    		return self.__dict__[name]
-    	if self.__dict__['cache']:
-    		if name not in self.__dict__["cache"]:
-    			raise AttributeError("attribute not found")
-    		return self.__dict__["cache"][name]
-    	else:
-    		with self.client.pipeline() as pipe:
-    			pipe.hget(self._addr_, name)
-    			pipe.hget(self._type_addr_, name)
-    			[v, t] = pipe.execute()
-    	attr = get_value_from_object_and_type(v, t)
-    	return attr
+        if name in self.__dict__:
+            return self.__dict__[name]
+        if self.cache:
+            if name not in self.cache:
+                raise AttributeError("attribute not found")
+            return self.cache[name]
+        raw = self._near_cache_entry()
+        if raw is not None:
+            v, t = raw[0].get(name), raw[1].get(name)
+        elif self._compact_:
+            v, t = untag_object(self._reader().hget(self._addr_, name))
+        else:
+            with self._reader().pipeline() as pipe:
+                pipe.hget(self._addr_, name)
+                pipe.hget(self._type_addr_, name)
+                [v, t] = pipe.execute()
+        attr = get_value_from_object_and_type(v, t)
+        return attr
 
     def __delattr__(self, name):
         if name in self.__dict__:
-        	del self.__dict__[name]
-        	return
+            del self.__dict__[name]
+            return
         if self.cache:
-        	del self.cache[name]
-        with self.client.pipeline() as pipe:
-        	pipe.hdel(self._addr_, name)
-        	pipe.hdel(self._type_addr_, name)
-        	pipe.execute()
-        del self.__dict__['refs'][name]
+            del self.cache[name]
+        with self._pipeline() as pipe:
+            pipe.hdel(self._addr_, name)
+            if not self._compact_:
+                pipe.hdel(self._type_addr_, name)
+        self.__dict__['refs'].pop(name, None)
+
+register_decoder("dmem:object", RedisObject._from_addr)
+register_decoder("dmem:object" + COMPACT_SUFFIX, lambda addr: RedisObject._from_addr(addr, compact=True))
+
+instrument_methods(RedisObject)
@@ -1,35 +1,87 @@
 from dbase import *
 import random, string
-import contextlib
+import operator
+import itertools
+import uuid
 from utils import *
+from instrument import instrument_methods
+from scripts import Script
 
 TEMP_PREFIX = "_temp_"
-
-XOR_LUA_SCRIPT = """
-local key1 = KEYS[1]
-local key2 = KEYS[2]
-local diff1 = redis.call('sdiff', key1, key2)
-local diff2 = redis.call('sdiff', key2, key1)
-local len1 = #diff1
-for i=1,#diff2 do
-    diff1[len1+i] = diff2[i]
-end
-return diff1
-"""
-
-XORSTORE_LUA_SCRIPT = """
-local key1 = KEYS[1]
-local key2 = KEYS[2]
+# seconds a temporary copy of a set on another node is kept if the client
+# doesn't get to delete it
+TEMP_TTL = 3600
+DEFAULT_SCAN_COUNT = 1000
+
+# stores the symmetric difference of KEYS[2] and KEYS[3] in KEYS[1], which may be
+# one of them, removing the intersection ARGV[1] members at a time
+XORSTORE_LUA_SCRIPT = Script("""
+local dest = KEYS[1]
+local key1 = KEYS[2]
+local key2 = KEYS[3]
+local chunk = tonumber(ARGV[1])
 local intersection = redis.call('sinter', key1, key2)
-redis.call('sunionstore', key1, key1, key2)
-for i=1,#intersection do
-    redis.call('srem', key1, intersection[i])
+redis.call('sunionstore', dest, key1, key2)
+for i = 1, #intersection, chunk do
+    redis.call('srem', dest, unpack(intersection, i, math.min(i + chunk - 1, #intersection)))
 end
-"""
+""")
+
+# the operations between two sets, by the command running them on the server
+OPERATIONS = {
+    "sinter": operator.and_,
+    "sunion": operator.or_,
+    "sdiff": operator.sub,
+    "xor": operator.xor,
+}
+# the largest size of the result of each operation, from the sizes of the operands
+RESULT_SIZES = {
+    "sinter": min,
+    "sunion": operator.add,
+    "sdiff": lambda a, b: a,
+    "xor": operator.add,
+}
+
+def _queue_store_operation(pipe, command, dest, key1, key2):
+    # dest = key1 <command> key2, dest may be key1
+    if command == "xor":
+        XORSTORE_LUA_SCRIPT(pipe, [dest, key1, key2], [SCRIPT_CHUNK_SIZE])
+    else:
+        getattr(pipe, command + "store")(dest, key1, key2)
+
+def _scan_members(client, key, count=DEFAULT_SCAN_COUNT):
+    # the raw members of the set at key, streamed with SSCAN
+    cursor = 0
+    while True:
+        cursor, members = client.sscan(key, cursor, count=count)
+        for member in members:
+            yield member
+        if cursor == 0:
+            break
+
+def _write_temp(client, key, members):
+    """ Add members, an iterable consumed as it goes, to the temporary set at
+    key, BULK_CHUNK_SIZE members per SADD and PIPELINE_CHUNKS SADDs per round
+    trip. The set expires after TEMP_TTL.
+    """
+    for chunks in chunked(chunked(members), PIPELINE_CHUNKS):
+        with client.pipeline(transaction=False) as pipe:
+            for chunk in chunks:
+                pipe.sadd(key, *chunk)
+            pipe.expire(key, TEMP_TTL)
+            pipe.execute()
+
+def _copy_members(source_client, source_key, target_client, target_key):
+    # copy the set at source_key to target_key on another node through this
+    # client, streamed with SSCAN
+    _write_temp(target_client, target_key, _scan_members(source_client, source_key))
+
+def _temp_key():
+    return TEMP_PREFIX + uuid.uuid4().hex
 
 class RedisSet(dbase):
-    def __init__(self, _elements=None):
-        dbase.__init__(self)
+    def __init__(self, _elements=None, node=None):
+        dbase.__init__(self, node=node)
         if _elements:
             self.update(_elements)
 
@@ -37,17 +89,25 @@ class RedisSet(dbase):
         self._type_ = "dmem:set"
         self.cache = None
 
+    def _members(self):
+        return self._near_cached(lambda: self._reader().smembers(self._addr_))
+
     def _load_objects_and_types(self):
-        objs = self.client.smembers(self._addr_)
+        objs = self._members()
         tuples = []
         for obj in objs:
             tuples.append(self._get_value_type_from_object(obj))
         return tuples
 
     def _load(self):
-        tuples = self._load_objects_and_types()
-        values = set([get_value_from_object_and_type(o, t) for o,t in tuples])
-        return values
+        return set(self.get_values_from_redis(self._members()))
+
+    def _queue_load(self, pipe):
+        # queues the reads of _load() on pipe, _parse_load() decodes their replies
+        pipe.smembers(self._addr_)
+
+    def _parse_load(self, replies):
+        return set(self.get_values_from_redis(next(replies)))
     
     @staticmethod
     def _get_value_type_from_object(obj):
@@ -59,6 +119,52 @@ class RedisSet(dbase):
         v, t = RedisSet._get_value_type_from_object(r)
         return get_value_from_object_and_type(v, t)
 
+    @staticmethod
+    def get_values_from_redis(rs):
+        # decodes a batch of members, nested objects are counted in one pipeline
+        objs, types = [], []
+        for r in rs:
+            obj, t = RedisSet._get_value_type_from_object(r)
+            objs.append(obj)
+            types.append(t)
+        return get_values_from_objects_and_types(objs, types)
+
+    def _upload_temp(self, values):
+        # a temporary set on self's node holding values, to be deleted by the caller
+        tempkey = _temp_key()
+        _write_temp(self.client, tempkey, (self.convert_value_into_redis(v) for v in values))
+        return tempkey
+
+    @staticmethod
+    def _stored(node, command, key1, key2, tempkey=None):
+        # a new set on node holding key1 <command> key2, made by the server,
+        # tempkey is deleted in the same round trip
+        result = RedisSet(node=node)
+        with result._pipeline() as pipe:
+            _queue_store_operation(pipe, command, result._addr_, key1, key2)
+            if tempkey:
+                pipe.delete(tempkey)
+        return result
+
+    def _apply(self, command, other):
+        # a new set holding self <command> other, a python iterable, uploaded
+        # next to self instead of loading self
+        if self.cache:
+            return RedisSet(OPERATIONS[command](self.cache, set(other)))
+        tempkey = self._upload_temp(other)
+        return self._stored(self._node_, command, self._addr_, tempkey, tempkey)
+
+    def _apply_in_place(self, command, other):
+        # self = self <command> other, a python iterable uploaded next to self
+        if self.cache:
+            other = set(other)
+        tempkey = self._upload_temp(other)
+        with self._pipeline() as pipe:
+            _queue_store_operation(pipe, command, self._addr_, self._addr_, tempkey)
+            pipe.delete(tempkey)
+        if self.cache:
+            self.cache = OPERATIONS[command](self.cache, other)
+
     @staticmethod
     def _get_object_from_value_type(v, t):
         return t+"#"+v
@@ -68,140 +174,161 @@ class RedisSet(dbase):
         obj, t = get_redis_object_and_type(v)
         return RedisSet._get_object_from_value_type(obj, t)
 
-    @contextlib.contextmanager
-    def loaded(self):
-        self.cache = self._load()
-        try:
-            yield self.cache
-        finally:
-            self.cache = None
-
     def __contains__(self, element):
         if self.cache:
             return element in self.cache
         v = self.convert_value_into_redis(element)
-        return self.client.sismember(self._addr_, v)
+        raw = self._near_cache_entry()
+        if raw is not None:
+            return v in raw
+        return self._reader().sismember(self._addr_, v)
 
     def __len__(self):
         if self.cache:
             return len(self.cache)
-        return self.client.scard(self._addr_)
+        raw = self._near_cache_entry()
+        if raw is not None:
+            return len(raw)
+        return self._reader().scard(self._addr_)
 
     def __iter__(self):
-        return iter(self._load())
+        if self.cache:
+            return iter(self.cache)
+        return self.iterate()
+
+    def iterate(self, count=DEFAULT_SCAN_COUNT):
+        """ Stream the members with SSCAN, count is passed as the COUNT hint.
+        As with SSCAN itself, a member may be returned more than once if the set
+        is modified while iterating.
+        >>> s = RedisSet([1, "a"])
+        >>> sorted(s.iterate(count=1))
+        [1, 'a']
+        """
+        # a cursor is only valid on the server that returned it
+        reader = self._reader()
+        cursor = 0
+        while True:
+            cursor, members = reader.sscan(self._addr_, cursor, count=count)
+            for value in self.get_values_from_redis(members):
+                yield value
+            if cursor == 0:
+                break
+
+    def _plan(self, other, command, in_place):
+        """ How to run command between self and other when they live on different
+        nodes, the plan moving the fewest members through the client (sizes are
+        counted in members, the result's by its largest size):
+        "here" copies other to a temporary key on self's node, "there" copies
+        self to other's node (and the result back when in place).
+        """
+        a = self._reader().scard(self._addr_)
+        b = other._reader().scard(other._addr_)
+        r = RESULT_SIZES[command](a, b)
+        # on a tie the first plan is taken
+        costs = [(2 * b, 0, "here"),
+                 (2 * a + (2 * r if in_place else 0), 1, "there")]
+        return min(costs)[2]
+
+    def _combine(self, other, command):
+        """ A new set holding self <command> other, a RedisSet on any node. The
+        server stores the result in the new set, on self's node, or on other's
+        node when self is copied there.
+        """
+        if other._node_ == self._node_:
+            return self._stored(self._node_, command, self._addr_, other._addr_)
+        tempkey = _temp_key()
+        if self._plan(other, command, False) == "here":
+            _copy_members(other._reader(), other._addr_, self.client, tempkey)
+            return self._stored(self._node_, command, self._addr_, tempkey, tempkey)
+        _copy_members(self._reader(), self._addr_, other.client, tempkey)
+        return self._stored(other._node_, command, tempkey, other._addr_, tempkey)
+
+    def _combine_in_place(self, other, command):
+        # self = self <command> other, a RedisSet on any node
+        if other._node_ == self._node_:
+            with self._pipeline() as pipe:
+                _queue_store_operation(pipe, command, self._addr_, self._addr_, other._addr_)
+        else:
+            if self._plan(other, command, True) == "here":
+                tempkey = _temp_key()
+                _copy_members(other._reader(), other._addr_, self.client, tempkey)
+                with self._pipeline() as pipe:
+                    _queue_store_operation(pipe, command, self._addr_, self._addr_, tempkey)
+                    pipe.delete(tempkey)
+            else:
+                # computed on other's node, the result is copied back next to self
+                # and replaces its members in one transaction
+                there, back = _temp_key(), _temp_key()
+                try:
+                    _copy_members(self._reader(), self._addr_, other.client, there)
+                    with other.client.pipeline() as pipe:
+                        _queue_store_operation(pipe, command, there, there, other._addr_)
+                        pipe.execute()
+                    _copy_members(other.client, there, self.client, back)
+                finally:
+                    other.client.delete(there)
+                with self._pipeline() as pipe:
+                    pipe.delete(self._addr_)
+                    pipe.sunionstore(self._addr_, back)
+                    pipe.delete(back)
+        if self.cache:
+            self.cache = self._load_snapshot() # reload local cache
 
     def __and__(self, other):
         if isinstance(other, RedisSet):
-            objs = self.client.sinter(self._addr_, other._addr_)
-            intersection = set()
-            for obj in objs:                
-                v = self.get_value_from_redis(obj)
-                intersection.add(v)
-        else:
-            if self.cache:
-                intersection = self.cache&other
-            else:
-                intersection = self._load()&other
-        return RedisSet(intersection)
+            return self._combine(other, "sinter")
+        return self._apply("sinter", other)
 
     def __iand__(self, other):
         if isinstance(other, RedisSet):
-            self.client.sinterstore(self._addr_, self._addr_, other._addr_)
-            if self.cache:
-                self.cache = self._load() # reload local cache
+            self._combine_in_place(other, "sinter")
         else:
-            elements = [self.convert_value_into_redis(v) for v in other]
-            with self.client.pipeline() as pipe:
-                tempkey = TEMP_PREFIX + self._addr_
-                pipe.sadd(tempkey, *elements)
-                pipe.sinterstore(self._addr_, self._addr_, tempkey)
-                pipe.delete(tempkey)
-                pipe.execute()
-            if self.cache:
-                self.cache &= other
+            self._apply_in_place("sinter", other)
         return self
 
     def __or__(self, other):
         if isinstance(other, RedisSet):
-            objs = self.client.sunion(self._addr_, other._addr_)
-            union = set()
-            for obj in objs:
-                v = self.get_value_from_redis(obj)
-                union.add(v)
-        else:
-            if self.cache:
-                union = self.cache|other
-            else:
-                union = self._load()|other
-        return RedisSet(union)
+            return self._combine(other, "sunion")
+        return self._apply("sunion", other)
 
     def __ior__(self, other):
         if isinstance(other, RedisSet):
-            self.client.sunionstore(self._addr_, self._addr_, other._addr_)
-            if self.cache:
-                self.cache = self._load()
+            self._combine_in_place(other, "sunion")
         else:
-            elements = [self.convert_value_into_redis(v) for v in other]
-            self.client.sadd(self._addr_, *elements)
+            # other is consumed as it goes and added BULK_CHUNK_SIZE elements
+            # at a time, see dbase._pipeline_chunks
             if self.cache:
+                other = set(other)
                 self.cache |= other
+            elements = (self.convert_value_into_redis(v) for v in other)
+            self._pipeline_chunks(elements, self._queue_sadd)
         return self
 
+    def _queue_sadd(self, pipe, elements):
+        pipe.sadd(self._addr_, *elements)
+
     def __sub__(self, other):
         if isinstance(other, RedisSet):
-            objs = self.client.sdiff(self._addr_, other._addr_)
-            diff = set()
-            for obj in objs:
-                v = self.get_value_from_redis(obj)
-                diff.add(v)
-        else:
-            if self.cache:
-                diff = self.cache-other
-            else:
-                diff = self._load()-other
-        return RedisSet(diff)
+            return self._combine(other, "sdiff")
+        return self._apply("sdiff", other)
 
     def __isub__(self, other):
         if isinstance(other, RedisSet):
-            self.client.sdiffstore(self._addr_, self._addr_, other._addr_)
-            if self.cache:
-                self.cache = self._load()
+            self._combine_in_place(other, "sdiff")
         else:
-            elements = [self.convert_value_into_redis(v) for v in other]
-            self.client.srem(self._addr_, *elements)
-            if self.cache:
-                self.cache -= other
+            self._apply_in_place("sdiff", other)
         return self
 
     def __xor__(self, other):
         if isinstance(other, RedisSet):
-            objs = self.client.eval(XOR_LUA_SCRIPT, 2, self._addr_, other._addr_)
-            xor = set()
-            for obj in objs:
-                v = self.get_value_from_redis(obj)
-                xor.add(v)
-        else:
-            if self.cache:
-                xor = self.cache^other
-            else:
-                xor = self._load()^other
-        return RedisSet(xor)
+            return self._combine(other, "xor")
+        return self._apply("xor", other)
 
     def __ixor__(self, other):
         if isinstance(other, RedisSet):
-            self.client.eval(XORSTORE_LUA_SCRIPT, 2, self._addr_, other._addr_)
-            if self.cache:
-                self.cache = self._load()
+            self._combine_in_place(other, "xor")
         else:
-            elements = [self.convert_value_into_redis(v) for v in other]
-            with self.client.pipeline() as pipe:
-                tempkey = TEMP_PREFIX + self._addr_
-                pipe.sadd(tempkey, *elements)
-                pipe.eval(XORSTORE_LUA_SCRIPT, 2, self._addr_, tempkey)
-                pipe.delete(tempkey)
-                pipe.execute()
-            if self.cache:
-                self.cache ^= other
+            self._apply_in_place("xor", other)
         return self
 
     def update(self, other):
@@ -211,15 +338,21 @@ class RedisSet(dbase):
         if self.cache:
             self.cache.add(ele)
         r = self.convert_value_into_redis(ele)
-        self.client.sadd(self._addr_, r)
+        with self._pipeline() as pipe:
+            pipe.sadd(self._addr_, r)
 
     def clear(self):
         if self.cache:
             self.cache.clear()
-        self.client.delete(self._addr_)
+        with self._pipeline() as pipe:
+            pipe.delete(self._addr_)
 
     def copy(self):
-        return RedisSet(self._load())
+        # made by the server, on the same node
+        copy = RedisSet(node=self._node_)
+        with copy._pipeline() as pipe:
+            pipe.sunionstore(copy._addr_, self._addr_)
+        return copy
 
     def difference(self, other):
         return self.__sub__(other)
@@ -246,7 +379,8 @@ class RedisSet(dbase):
         if self.cache:
             self.cache.discard(ele)
         r = self.convert_value_into_redis(ele)
-        self.client.srem(self._addr_, r)
+        with self._pipeline() as pipe:
+            pipe.srem(self._addr_, r)
 
     def isdisjoint(self, other):
         return len(self.intersection(other))==0
@@ -265,11 +399,20 @@ class RedisSet(dbase):
         r = self.convert_value_into_redis(ele)
         if not self.client.sismember(self._addr_, r):
             raise KeyError("element not in set")
-        self.client.srem(self._addr_, r)
+        with self._pipeline() as pipe:
+            pipe.srem(self._addr_, r)
 
     def pop(self):
-        r = self.client.spop(self._addr_)
+        with self.client.pipeline() as pipe:
+            pipe.spop(self._addr_)
+            self._bump_version(pipe)
+            r = pipe.execute()[0]
+        self._invalidate()
         ele = self.get_value_from_redis(r)
         if self.cache:
             self.cache.discard(ele)
         return ele
+
+register_decoder("dmem:set", RedisSet._from_addr)
+
+instrument_methods(RedisSet)
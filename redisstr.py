@@ -2,37 +2,50 @@ from dbase import *
 import random, string
 import contextlib
 from utils import *
+from instrument import instrument_methods
 
 class RedisStr(dbase):
     def __init__(self, s=None):
         dbase.__init__(self)
         # save when initializing
         if s:
-            ret = self.client.set(self._addr_, s)
-            if not ret:
-                raise RedisOperationFailure()
+            self.setvalue(s)
     
     def initialize(self):
         self._type_ = "dmem:str"
+        self.cache = None
+
+    def _load(self):
+        return self._near_cached(lambda: self._reader().get(self._addr_))
+
+    def _queue_load(self, pipe):
+        # queues the read of _load() on pipe, _parse_load() takes its reply
+        pipe.get(self._addr_)
+
+    def _parse_load(self, replies):
+        return next(replies)
 
     def getvalue(self):
-        # refresh the value
-        s = self.client.get(self._addr_)
-        return s
+        # refresh the value, unless it's loaded() or in the near cache
+        if self.cache is not None:
+            return self.cache
+        return self._load()
 
     def setvalue(self, s):
-        ret = self.client.set(self._addr_, s)
-        if not ret:
-            raise RedisOperationFailure()
+        with self._pipeline() as pipe:
+            pipe.set(self._addr_, s)
+        if self.cache is not None:
+            self.cache = s
 
     def __iadd__(self, more):
         if isinstance(more, RedisStr):
             more = more.getvalue()
         if not isinstance(more, basestring):
             raise TypeError("The argument is not a string")
-        ret = self.client.append(self._addr_, more)
-        if not ret:
-            raise RedisOperationFailure()
+        with self._pipeline() as pipe:
+            pipe.append(self._addr_, more)
+        if self.cache is not None:
+            self.cache += more
         return self
 
     def __add__(self, more):
@@ -50,18 +63,24 @@ class RedisStr(dbase):
         return sub in self.getvalue()
 
     def __getslice__(self, i, j):
-        ret = self.client.getrange(self._addr_, i, j)
+        ret = self._reader().getrange(self._addr_, i, j)
         if not ret:
             raise RedisOperationFailure()
         return ret
 
     def __setslice__(self, i, j, val):
         ret = self.client.setrange(self._addr_, i, j, val)
+        self.cache = None
         if not ret:
             raise RedisOperationFailure()
     
     def __len__(self):
-        ret = self.client.strlen(self._addr_)
+        if self.cache is not None:
+            return len(self.cache)
+        raw = self._near_cache_entry()
+        if raw is not None:
+            return len(raw)
+        ret = self._reader().strlen(self._addr_)
         return ret
 
     def __getitem__(self, idx):
@@ -75,10 +94,6 @@ class RedisStr(dbase):
             return getattr(s, attr)
         
 
+register_decoder("dmem:str", RedisStr._from_addr)
 
-
-
-
-
-
-
+instrument_methods(RedisStr)
@@ -0,0 +1,69 @@
+import hashlib
+import threading
+import redis
+
+# source of every registered script, in registration order
+_sources = []
+_lock = threading.Lock()
+
+class Script(object):
+    """ A Lua script called by its SHA1 with EVALSHA, so only the hash is sent.
+    Scripts are registered when created, at import time for the module level
+    ones, and loaded once on each node when it is configured (see load_scripts).
+    A call that gets NOSCRIPT anyway (a script created after that, a restarted
+    server or SCRIPT FLUSH) loads the scripts and is sent again, in a pipeline
+    too (see ScriptLoadingPipeline).
+    >>> INCR_SCRIPT = Script("return redis.call('incr', KEYS[1])")
+    >>> INCR_SCRIPT(client, ["counter"])
+    1
+    """
+    def __init__(self, source):
+        self.source = source
+        self.sha = hashlib.sha1(source).hexdigest()
+        with _lock:
+            _sources.append(source)
+
+    def __call__(self, client, keys, args=()):
+        # client may also be a pipeline, the call is then queued
+        argv = list(keys) + list(args)
+        if isinstance(client, redis.client.Pipeline):
+            return client.evalsha(self.sha, len(keys), *argv)
+        try:
+            return client.evalsha(self.sha, len(keys), *argv)
+        except redis.exceptions.NoScriptError:
+            load_scripts(client)
+            return client.evalsha(self.sha, len(keys), *argv)
+
+def load_scripts(client):
+    # loads the registered scripts on client's server with one round trip
+    with _lock:
+        sources = list(_sources)
+    pipe = redis.client.Pipeline(client.connection_pool, client.response_callbacks, False, None)
+    with pipe:
+        for source in sources:
+            pipe.script_load(source)
+        pipe.execute()
+
+class ScriptLoadingPipeline(redis.client.Pipeline):
+    """ A pipeline that recovers from NOSCRIPT: once the server has lost its
+    script cache, the EVALSHA commands that got it are sent again after loading
+    the scripts. Only those are, the rest of the pipeline is not applied twice,
+    but they then run after it.
+    """
+    def execute(self, raise_on_error=True):
+        commands = self.command_stack
+        replies = redis.client.Pipeline.execute(self, False)
+        failed = [i for i, reply in enumerate(replies)
+                  if isinstance(reply, redis.exceptions.NoScriptError)]
+        if failed:
+            load_scripts(self)
+            for i in failed:
+                args, options = commands[i]
+                self.execute_command(*args, **options)
+            for i, reply in zip(failed, redis.client.Pipeline.execute(self, False)):
+                replies[i] = reply
+        if raise_on_error:
+            for reply in replies:
+                if isinstance(reply, Exception):
+                    raise reply
+        return replies
@@ -0,0 +1,601 @@
+from dbase import *
+import zlib
+import itertools
+from utils import *
+from instrument import instrument_methods
+from aio import submit, gather
+from batch import current_batch, keep_reads_pinned
+from redislist import RedisList
+from redisdict import RedisDict, DEFAULT_SCAN_COUNT
+from redisset import RedisSet
+
+# items of a ShardedRedisList chunk, a new chunk is started on the next node
+# when the last one holds that many
+SHARD_CHUNK_SIZE = 10000
+
+def _shard_index(encoded, count):
+    # the shard of a dict key or encoded set element, stable across processes
+    return (zlib.crc32(encoded) & 0xffffffff) % count
+
+class ShardedContainer(dbase):
+    """ Base of the containers whose items are spread over all the nodes of the
+    pool, so they can grow past the memory of one node. The container's own key
+    is a list of the addresses of its shards, plain dmem containers one per node
+    (chunks of the list for ShardedRedisList). Operations on all the shards
+    (len, loading, bulk updates) run on the nodes in parallel, in the thread
+    pool of AsyncProxy. Inside batch() they are queued in the caller's thread
+    instead, so they are part of the batch.
+    The version of a sharded container is the sum of its shards' versions.
+    """
+    _shard_type_ = None
+
+    def initialize(self):
+        self._shards_ = None
+        self.cache = None
+
+    @property
+    def shards(self):
+        if self._shards_ is None:
+            addrs = self.client.lrange(self._addr_, 0, -1)
+            self._shards_ = get_values_from_objects_and_types(addrs, [self._shard_type_] * len(addrs))
+        return self._shards_
+
+    def _create_shards(self, new_shard):
+        # one shard on each node of the pool, new_shard(node) creates it
+        self._shards_ = [new_shard(node) for node in RedisClientPool.get_pool().names]
+        self.client.rpush(self._addr_, *[shard._addr_ for shard in self._shards_])
+
+    def _fan_out(self, func, shards=None):
+        # func(shard) for each shard, in parallel, returns the results in order
+        shards = self.shards if shards is None else shards
+        if current_batch() is not None or len(shards) < 2:
+            return [func(shard) for shard in shards]
+        func = keep_reads_pinned(func)
+        return gather([submit(func, shard) for shard in shards])
+
+    def version(self):
+        return sum(self._fan_out(lambda shard: shard.version()))
+
+    def destroy(self):
+        for shard in self.shards:
+            shard.destroy()
+        dbase.destroy(self)
+
+    def __len__(self):
+        if self.cache:
+            return len(self.cache)
+        return sum(self._fan_out(len))
+
+class ShardedRedisDict(ShardedContainer):
+    """ A dict spread over the nodes by the CRC32 of its keys
+    >>> d = ShardedRedisDict({"a": 1, "b": 2.0})
+    >>> len(d.shards) == len(RedisClientPool.get_pool().names)
+    True
+    >>> d["a"], sorted(d.keys())
+    (1, ['a', 'b'])
+    """
+    def __init__(self, _dict=None, compact=False, node=None):
+        dbase.__init__(self, compact, node)
+        self._create_shards(lambda node: RedisDict(compact=compact, node=node))
+        if _dict:
+            self.update(_dict)
+
+    def initialize(self):
+        ShardedContainer.initialize(self)
+        self._type_ = "dmem:sharded:dict" + (COMPACT_SUFFIX if self._compact_ else "")
+        self._shard_type_ = "dmem:dict" + (COMPACT_SUFFIX if self._compact_ else "")
+
+    def _shard(self, key):
+        shards = self.shards
+        return shards[_shard_index(key, len(shards))]
+
+    def _load(self):
+        d = {}
+        for part in self._fan_out(lambda shard: shard._load()):
+            d.update(part)
+        return d
+
+    def __getitem__(self, key):
+        if self.cache:
+            return self.cache[key]
+        return self._shard(key)[key]
+
+    def __setitem__(self, key, value):
+        if not isinstance(key, basestring):
+            raise KeyError("Only string key is supported")
+        if self.cache:
+            self.cache[key] = value
+        self._shard(key)[key] = value
+
+    def __delitem__(self, key):
+        if self.cache:
+            del self.cache[key]
+        del self._shard(key)[key]
+
+    def __contains__(self, key):
+        if self.cache:
+            return key in self.cache
+        return key in self._shard(key)
+
+    def __iter__(self):
+        if self.cache:
+            return iter(self.cache)
+        return self.iterkeys()
+
+    def get(self, key, default=None):
+        v = self.__getitem__(key)
+        if not v:
+            return default
+        return v
+
+    def has_key(self, key):
+        return key in self
+
+    def keys(self):
+        if self.cache:
+            return self.cache.keys()
+        return list(itertools.chain(*self._fan_out(lambda shard: shard.keys())))
+
+    def values(self):
+        if self.cache:
+            return self.cache.values()
+        return list(itertools.chain(*self._fan_out(lambda shard: shard.values())))
+
+    def items(self):
+        if self.cache:
+            return self.cache.items()
+        return self._load().items()
+
+    # the iterators stream the shards one after the other, see RedisDict.iteritems
+    def iteritems(self, count=DEFAULT_SCAN_COUNT):
+        if self.cache:
+            return self.cache.iteritems()
+        return itertools.chain.from_iterable(shard.iteritems(count) for shard in self.shards)
+
+    def iterkeys(self, count=DEFAULT_SCAN_COUNT):
+        if self.cache:
+            return self.cache.iterkeys()
+        return itertools.chain.from_iterable(shard.iterkeys(count) for shard in self.shards)
+
+    def itervalues(self, count=DEFAULT_SCAN_COUNT):
+        if self.cache:
+            return self.cache.itervalues()
+        return itertools.chain.from_iterable(shard.itervalues(count) for shard in self.shards)
+
+    def update(self, updates):
+        # updates is consumed BULK_CHUNK_SIZE items per shard at a time, each
+        # part written to its shard in parallel
+        if self.cache:
+            updates = dict(updates)
+            self.cache.update(updates)
+        if hasattr(updates, "iteritems"):
+            updates = updates.iteritems()
+        elif hasattr(updates, "items"):
+            updates = updates.items()
+        shards = self.shards
+        for chunk in chunked(updates, BULK_CHUNK_SIZE * len(shards)):
+            parts = [[] for shard in shards]
+            for k, v in chunk:
+                if not isinstance(k, basestring):
+                    raise KeyError("Only string key is supported")
+                parts[_shard_index(k, len(shards))].append((k, v))
+            self._fan_out(lambda (shard, part): shard.update(part), zip(shards, parts))
+
+    def setdefault(self, k, d):
+        if self.cache:
+            self.cache.setdefault(k, d)
+        return self._shard(k).setdefault(k, d)
+
+    def pop(self, k, d=None):
+        if self.cache:
+            self.cache.pop(k, None)
+        return self._shard(k).pop(k, d)
+
+    def clear(self):
+        if self.cache:
+            self.cache = {}
+        self._fan_out(lambda shard: shard.clear())
+
+class ShardedRedisSet(ShardedContainer):
+    """ A set spread over the nodes by the CRC32 of its encoded elements
+    >>> s = ShardedRedisSet([1, "a", 2.5])
+    >>> 1 in s, "1" in s, len(s)
+    (True, False, 3)
+    """
+    def __init__(self, _elements=None, node=None):
+        dbase.__init__(self, node=node)
+        self._create_shards(lambda node: RedisSet(node=node))
+        if _elements:
+            self.update(_elements)
+
+    def initialize(self):
+        ShardedContainer.initialize(self)
+        self._type_ = "dmem:sharded:set"
+        self._shard_type_ = "dmem:set"
+
+    def _shard(self, element):
+        shards = self.shards
+        return shards[_shard_index(RedisSet.convert_value_into_redis(element), len(shards))]
+
+    def _load(self):
+        return set(itertools.chain(*self._fan_out(lambda shard: shard._load())))
+
+    def __contains__(self, element):
+        if self.cache:
+            return element in self.cache
+        return element in self._shard(element)
+
+    def __iter__(self):
+        if self.cache:
+            return iter(self.cache)
+        return self.iterate()
+
+    def iterate(self, count=DEFAULT_SCAN_COUNT):
+        # streams the shards one after the other, see RedisSet.iterate
+        return itertools.chain.from_iterable(shard.iterate(count) for shard in self.shards)
+
+    def add(self, ele):
+        if self.cache:
+            self.cache.add(ele)
+        self._shard(ele).add(ele)
+
+    def discard(self, ele):
+        if self.cache:
+            self.cache.discard(ele)
+        self._shard(ele).discard(ele)
+
+    def remove(self, ele):
+        if self.cache:
+            if ele not in self.cache:
+                raise KeyError("element not in set")
+            self.cache.remove(ele)
+        self._shard(ele).remove(ele)
+
+    def update(self, other):
+        # other is consumed BULK_CHUNK_SIZE elements per shard at a time, each
+        # part added to its shard in parallel
+        if self.cache:
+            other = set(other)
+            self.cache |= other
+        shards = self.shards
+        for chunk in chunked(other, BULK_CHUNK_SIZE * len(shards)):
+            parts = [[] for shard in shards]
+            for ele in chunk:
+                parts[_shard_index(RedisSet.convert_value_into_redis(ele), len(shards))].append(ele)
+            self._fan_out(lambda (shard, part): shard.update(part), zip(shards, parts))
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def pop(self):
+        # from the first shard holding an element
+        for shard in self.shards:
+            if len(shard):
+                ele = shard.pop()
+                if self.cache:
+                    self.cache.discard(ele)
+                return ele
+        raise KeyError("pop from an empty set")
+
+    def clear(self):
+        if self.cache:
+            self.cache.clear()
+        self._fan_out(lambda shard: shard.clear())
+
+class ShardedRedisList(ShardedContainer):
+    """ A list stored as a sequence of RedisList chunks, created on the nodes in
+    turn as the list grows: appends go to the last chunk until it holds
+    SHARD_CHUNK_SIZE items. Indexing reads the chunk lengths with one pipeline
+    per node, in parallel, and then the item from its chunk.
+    Chunks are never split or merged, inserts and deletes change the length of
+    the chunks they touch. It has the methods of RedisList except sort(), and
+    slices without a step. The chunks are read from the container's key by every operation,
+    so that proxies in other processes see the chunks added by this one.
+    >>> l = ShardedRedisList(xrange(25000))
+    >>> len(l), l[12345], l[-1]
+    (25000, 12345, 24999)
+    """
+    def __init__(self, _list=None, compact=False, node=None):
+        dbase.__init__(self, compact, node)
+        if _list:
+            self.extend(_list)
+
+    def initialize(self):
+        ShardedContainer.initialize(self)
+        self._type_ = "dmem:sharded:list" + (COMPACT_SUFFIX if self._compact_ else "")
+        self._shard_type_ = "dmem:list" + (COMPACT_SUFFIX if self._compact_ else "")
+        self._chunk_proxies_ = {}
+
+    @property
+    def shards(self):
+        # the chunks in order, the proxies of the chunks seen before are reused
+        addrs = self.client.lrange(self._addr_, 0, -1)
+        new = [addr for addr in addrs if addr not in self._chunk_proxies_]
+        for addr, chunk in zip(new, get_values_from_objects_and_types(new, [self._shard_type_] * len(new))):
+            self._chunk_proxies_[addr] = chunk
+        return [self._chunk_proxies_[addr] for addr in addrs]
+
+    def _add_chunk(self, chunks):
+        # a new last chunk, on the node after the current last one
+        names = RedisClientPool.get_pool().names
+        node = names[(names.index(chunks[-1]._node_) + 1) % len(names)] if chunks else self._node_
+        chunk = RedisList(compact=self._compact_, node=node)
+        self.client.rpush(self._addr_, chunk._addr_)
+        self._chunk_proxies_[chunk._addr_] = chunk
+        chunks.append(chunk)
+        return chunk
+
+    def _lengths(self, chunks):
+        # the length of each chunk, with one pipeline per node
+        by_node = {}
+        for i, chunk in enumerate(chunks):
+            by_node.setdefault(chunk._node_, []).append(i)
+        def read(indexes):
+            with chunks[indexes[0]]._reader().pipeline(transaction=False) as pipe:
+                for i in indexes:
+                    pipe.llen(chunks[i]._addr_)
+                return pipe.execute()
+        lengths = [0] * len(chunks)
+        groups = by_node.values()
+        for indexes, counts in zip(groups, self._fan_out(read, groups)):
+            for i, count in zip(indexes, counts):
+                lengths[i] = count
+        return lengths
+
+    def _locate(self, idx):
+        # the chunk holding item idx and the index within it
+        chunks = self.shards
+        lengths = self._lengths(chunks)
+        if idx < 0:
+            idx += sum(lengths)
+        if idx >= 0:
+            for chunk, length in zip(chunks, lengths):
+                if idx < length:
+                    return chunk, idx
+                idx -= length
+        raise IndexError("list index out of range")
+
+    def _slice_parts(self, start, end):
+        # the chunks, their lengths and (chunk, low, high) for each chunk
+        # overlapping the items [start, end), in order
+        chunks = self.shards
+        lengths = self._lengths(chunks)
+        parts = []
+        first = 0
+        for chunk, length in zip(chunks, lengths):
+            low, high = max(start - first, 0), min(end - first, length)
+            if low < high:
+                parts.append((chunk, low, high))
+            first += length
+        return chunks, lengths, parts
+
+    @staticmethod
+    def _slice_bounds(idx, length):
+        # the bounds of a slice object, extended slices aren't supported
+        if idx.step not in (None, 1):
+            raise TypeError("ShardedRedisList doesn't support extended slices")
+        start, end, step = idx.indices(length)
+        return start, end
+
+    def _load(self):
+        return list(itertools.chain(*self._fan_out(lambda chunk: chunk._load())))
+
+    def __iter__(self):
+        if self.cache:
+            return iter(self.cache)
+        return self.iterate()
+
+    def iterate(self, prefetch=True):
+        """ Stream the list a chunk at a time, the next chunk is read in the
+        thread pool while the current one is consumed unless prefetch is False.
+        """
+        chunks = self.shards
+        # inside a batch the chunks are read in this thread, see _fan_out
+        prefetch = prefetch and current_batch() is None
+        load = keep_reads_pinned(lambda chunk: chunk._load())
+        pending = submit(load, chunks[0]) if chunks and prefetch else None
+        for i, chunk in enumerate(chunks):
+            values = pending.get() if pending else chunk._load()
+            pending = submit(load, chunks[i+1]) if i + 1 < len(chunks) and prefetch else None
+            for value in values:
+                yield value
+
+    def __getitem__(self, idx):
+        if self.cache:
+            return self.cache[idx]
+        if isinstance(idx, slice):
+            return self._load()[idx]
+        chunk, offset = self._locate(idx)
+        return chunk[offset]
+
+    def __getslice__(self, start, end):
+        # only the chunks overlapping the slice are read, in parallel
+        if self.cache:
+            return self.cache[start:end]
+        chunks, lengths, parts = self._slice_parts(start, end)
+        return list(itertools.chain(*self._fan_out(lambda (chunk, low, high): chunk[low:high], parts)))
+
+    def __setslice__(self, start, end, values):
+        # the values replace the part of the slice in its first chunk, the parts
+        # in the other chunks are deleted, in parallel
+        values = list(values)
+        start, end = max(start, 0), max(end, start, 0)
+        chunks, lengths, parts = self._slice_parts(start, end)
+        if not parts:
+            if start >= sum(lengths):
+                # also extends the loaded() copy
+                self.extend(values)
+                return
+            chunk, offset = self._locate(start)
+            parts = [(chunk, offset, offset)]
+        if self.cache:
+            self.cache[start:end] = values
+        def splice((chunk, low, high), values):
+            with chunk._pipeline() as pipe:
+                chunk._splice(pipe, low, high, [chunk._encode(v) for v in values])
+        splice(parts[0], values)
+        self._fan_out(lambda part: splice(part, ()), parts[1:])
+
+    def __delslice__(self, start, end):
+        # python already added the length to negative bounds
+        start, end = max(start, 0), max(end, 0)
+        if self.cache:
+            del self.cache[start:end]
+        chunks, lengths, parts = self._slice_parts(start, end)
+        self._fan_out(lambda (chunk, low, high): chunk.__delslice__(low, high), parts)
+
+    def __setitem__(self, idx, val):
+        if isinstance(idx, slice):
+            self.__setslice__(*(self._slice_bounds(idx, len(self)) + (val,)))
+            return
+        if self.cache:
+            self.cache[idx] = val
+        chunk, offset = self._locate(idx)
+        chunk[offset] = val
+
+    def __delitem__(self, idx):
+        if isinstance(idx, slice):
+            self.__delslice__(*self._slice_bounds(idx, len(self)))
+            return
+        if self.cache:
+            del self.cache[idx]
+        chunk, offset = self._locate(idx)
+        del chunk[offset]
+
+    def __contains__(self, val):
+        if self.cache:
+            return val in self.cache
+        return any(self._fan_out(lambda chunk: val in chunk))
+
+    def append(self, val):
+        if self.cache:
+            self.cache.append(val)
+        chunks = self.shards
+        if not chunks or len(chunks[-1]) >= SHARD_CHUNK_SIZE:
+            self._add_chunk(chunks)
+        chunks[-1].append(val)
+
+    def extend(self, iterable):
+        # fills the last chunk, then new chunks of SHARD_CHUNK_SIZE items, one
+        # on each node in parallel
+        if self.cache:
+            iterable = list(iterable)
+            self.cache.extend(iterable)
+        it = iter(iterable)
+        chunks = self.shards
+        if chunks:
+            room = SHARD_CHUNK_SIZE - len(chunks[-1])
+            if room > 0:
+                chunks[-1].extend(itertools.islice(it, room))
+        nodes = len(RedisClientPool.get_pool().names)
+        while True:
+            parts = list(itertools.islice(chunked(it, SHARD_CHUNK_SIZE), nodes))
+            if not parts:
+                break
+            targets = [self._add_chunk(chunks) for part in parts]
+            self._fan_out(lambda (chunk, part): chunk.extend(part), zip(targets, parts))
+
+    def insert(self, idx, val):
+        if self.cache:
+            self.cache.insert(idx, val)
+        chunks = self.shards
+        lengths = self._lengths(chunks)
+        if idx < 0:
+            idx = max(idx + sum(lengths), 0)
+        for chunk, length in zip(chunks, lengths):
+            if idx < length:
+                chunk.insert(idx, val)
+                return
+            idx -= length
+        # at or past the end
+        if not chunks or lengths[-1] >= SHARD_CHUNK_SIZE:
+            self._add_chunk(chunks)
+        chunks[-1].append(val)
+
+    def pop(self):
+        # from the last chunk that isn't empty
+        chunks = self.shards
+        for chunk, length in reversed(zip(chunks, self._lengths(chunks))):
+            if length:
+                if self.cache:
+                    self.cache.pop()
+                return chunk.pop()
+        raise IndexError("pop from empty list")
+
+    def lpop(self):
+        # from the first chunk that isn't empty
+        chunks = self.shards
+        for chunk, length in zip(chunks, self._lengths(chunks)):
+            if length:
+                if self.cache:
+                    del self.cache[0]
+                return chunk.lpop()
+        raise IndexError("pop from empty list")
+
+    def lpush(self, val):
+        if self.cache:
+            self.cache.insert(0, val)
+        chunks = self.shards
+        if not chunks:
+            self._add_chunk(chunks)
+        chunks[0].lpush(val)
+
+    def remove(self, val):
+        # from the first chunk holding val, nothing happens if none does, as RedisList.remove
+        if self.cache:
+            self.cache.remove(val)
+        chunks = self.shards
+        for chunk, idx in zip(chunks, self._fan_out(lambda chunk: chunk.index(val), chunks)):
+            if idx >= 0:
+                chunk.remove(val)
+                return
+
+    def reverse(self):
+        # each chunk is reversed on its node, in parallel, then the order of the chunks
+        if self.cache:
+            self.cache.reverse()
+        chunks = self.shards
+        self._fan_out(lambda chunk: chunk.reverse(), chunks)
+        if chunks:
+            with self._pipeline() as pipe:
+                pipe.delete(self._addr_)
+                pipe.rpush(self._addr_, *[chunk._addr_ for chunk in reversed(chunks)])
+
+    def index(self, val):
+        # -1 when missing, as RedisList.index
+        if self.cache:
+            return self.cache.index(val)
+        chunks = self.shards
+        found = self._fan_out(lambda chunk: chunk.index(val), chunks)
+        first = 0
+        for idx, length in zip(found, self._lengths(chunks)):
+            if idx >= 0:
+                return first + idx
+            first += length
+        return -1
+
+    def count(self, val):
+        if self.cache:
+            return self.cache.count(val)
+        return sum(self._fan_out(lambda chunk: chunk.count(val)))
+
+    def clear(self):
+        if self.cache:
+            del self.cache[:]
+        chunks = self.shards
+        with self._pipeline() as pipe:
+            pipe.delete(self._addr_)
+        for chunk in chunks:
+            chunk.destroy()
+        self._chunk_proxies_ = {}
+
+register_decoder("dmem:sharded:dict", ShardedRedisDict._from_addr)
+register_decoder("dmem:sharded:dict" + COMPACT_SUFFIX, lambda addr: ShardedRedisDict._from_addr(addr, compact=True))
+register_decoder("dmem:sharded:set", ShardedRedisSet._from_addr)
+register_decoder("dmem:sharded:list", ShardedRedisList._from_addr)
+register_decoder("dmem:sharded:list" + COMPACT_SUFFIX, lambda addr: ShardedRedisList._from_addr(addr, compact=True))
+
+instrument_methods(ShardedRedisDict)
+instrument_methods(ShardedRedisSet)
+instrument_methods(ShardedRedisList)
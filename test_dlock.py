@@ -0,0 +1,91 @@
+""" Tests of the distributed locks, run against a local redis-server:
+
+    python -m unittest test_dlock
+
+DMEM_TEST_HOST and DMEM_TEST_PORT select the server (default 127.0.0.1:6379),
+the tests are skipped if it can't be reached.
+"""
+import os
+import threading
+import time
+import unittest
+import uuid
+import redis
+from dlock import RedisLock
+from batch import reads_pinned, primary_reads
+
+HOST = os.environ.get("DMEM_TEST_HOST", "127.0.0.1")
+PORT = int(os.environ.get("DMEM_TEST_PORT", 6379))
+
+def connect():
+    client = redis.StrictRedis(host=HOST, port=PORT)
+    try:
+        client.ping()
+    except redis.ConnectionError:
+        raise unittest.SkipTest("no redis-server at %s:%d" % (HOST, PORT))
+    return client
+
+class RedisLockTest(unittest.TestCase):
+    def setUp(self):
+        self.client = connect()
+        self.key = "_lock_test_" + uuid.uuid4().hex
+
+    def tearDown(self):
+        self.client.delete(self.key)
+
+    def acquire_in_thread(self, lock, timeout, join_timeout):
+        # acquire() in a thread, so a waiter that blocks for good fails the test
+        result = []
+        waiter = threading.Thread(target=lambda: result.append(lock.acquire(timeout=timeout)))
+        waiter.daemon = True
+        waiter.start()
+        waiter.join(join_timeout)
+        self.assertFalse(waiter.is_alive(), "acquire() is still blocked")
+        return result[0]
+
+    def test_notify_waiter_takes_over_when_holder_dies(self):
+        # the holder's thread dies without releasing, the waiter gets the lock once the lease expires
+        holder = RedisLock(self.client, self.key, lease=0.5)
+        self.assertTrue(self.acquire_in_thread(holder, None, 5.0))
+        waiter = RedisLock(self.client, self.key, notify=True)
+        start = time.time()
+        self.assertTrue(self.acquire_in_thread(waiter, 5.0, 10.0))
+        self.assertGreaterEqual(time.time() - start, 0.3)
+        waiter.release()
+
+    def test_notify_waiter_times_out(self):
+        holder = RedisLock(self.client, self.key, lease=10)
+        self.assertTrue(holder.acquire())
+        waiter = RedisLock(self.client, self.key, notify=True)
+        start = time.time()
+        self.assertFalse(self.acquire_in_thread(waiter, 1.0, 5.0))
+        self.assertLess(time.time() - start, 2.0)
+        holder.release()
+
+    def test_notify_waiter_woken_by_release(self):
+        holder = RedisLock(self.client, self.key, lease=10, notify=True)
+        self.assertTrue(holder.acquire())
+        threading.Timer(0.2, holder.release).start()
+        waiter = RedisLock(self.client, self.key, notify=True)
+        self.assertTrue(self.acquire_in_thread(waiter, 5.0, 10.0))
+        waiter.release()
+
+    def test_release_from_another_thread_unpins_the_acquiring_thread(self):
+        lock = RedisLock(self.client, self.key, lease=10)
+        self.assertTrue(lock.acquire())
+        self.assertTrue(reads_pinned())
+        pinned_in_releaser = []
+        def release():
+            lock.release()
+            # the releasing thread's own pins are untouched
+            with primary_reads():
+                pinned_in_releaser.append(reads_pinned())
+            pinned_in_releaser.append(reads_pinned())
+        releaser = threading.Thread(target=release)
+        releaser.start()
+        releaser.join()
+        self.assertEqual(pinned_in_releaser, [True, False])
+        self.assertFalse(reads_pinned())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+""" Tests of RedisDict, run against a local redis-server:
+
+    python -m unittest test_redisdict
+
+DMEM_TEST_HOST and DMEM_TEST_PORT select the server (default 127.0.0.1:6379),
+the tests are skipped if it can't be reached.
+"""
+import os
+import unittest
+import redis
+from utils import RedisClientPool
+from redisdict import RedisDict
+from sharded import ShardedRedisDict
+
+HOST = os.environ.get("DMEM_TEST_HOST", "127.0.0.1")
+PORT = int(os.environ.get("DMEM_TEST_PORT", 6379))
+
+def setUpModule():
+    pool = RedisClientPool.get_pool()
+    if "test" in pool.clients:
+        return
+    try:
+        pool.load_config({"test": {"host": HOST, "port": PORT, "db": 0}})
+    except redis.ConnectionError:
+        raise unittest.SkipTest("no redis-server at %s:%d" % (HOST, PORT))
+
+class PopTest(unittest.TestCase):
+    def check(self, d):
+        try:
+            self.assertEqual(d.pop("int"), 1)
+            self.assertEqual(d.pop("float"), 2.5)
+            self.assertEqual(d.pop("str"), "1")
+            self.assertIs(d.pop("bool"), True)
+            self.assertIsNone(d.pop("int"))
+            self.assertEqual(d.pop("missing", "default"), "default")
+            self.assertEqual(d.keys(), ["other"])
+        finally:
+            d.destroy()
+
+    def items(self):
+        return {"int": 1, "float": 2.5, "str": "1", "bool": True, "other": 0}
+
+    def test_typed(self):
+        self.check(RedisDict(self.items(), node="test"))
+
+    def test_compact(self):
+        self.check(RedisDict(self.items(), compact=True, node="test"))
+
+    def test_loaded(self):
+        d = RedisDict(self.items(), node="test")
+        with d.loaded():
+            self.check(d)
+
+    def test_sharded(self):
+        self.check(ShardedRedisDict(self.items()))
+
+if __name__ == "__main__":
+    unittest.main()
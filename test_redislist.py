@@ -0,0 +1,120 @@
+""" Tests of RedisList, run against a local redis-server:
+
+    python -m unittest test_redislist
+
+DMEM_TEST_HOST and DMEM_TEST_PORT select the server (default 127.0.0.1:6379),
+the tests are skipped if it can't be reached.
+"""
+import os
+import sys
+import unittest
+import redis
+from utils import RedisClientPool
+from redislist import RedisList
+
+HOST = os.environ.get("DMEM_TEST_HOST", "127.0.0.1")
+PORT = int(os.environ.get("DMEM_TEST_PORT", 6379))
+
+def setUpModule():
+    pool = RedisClientPool.get_pool()
+    if "test" in pool.clients:
+        return
+    try:
+        pool.load_config({"test": {"host": HOST, "port": PORT, "db": 0}})
+    except redis.ConnectionError:
+        raise unittest.SkipTest("no redis-server at %s:%d" % (HOST, PORT))
+
+class DelSliceTest(unittest.TestCase):
+    def check(self, start, end, compact=False, loaded=False):
+        expected = range(11)
+        del expected[start:end]
+        l = RedisList(range(11), compact=compact, node="test")
+        try:
+            if loaded:
+                with l.loaded():
+                    del l[start:end]
+            else:
+                del l[start:end]
+            self.assertEqual(l._load(), expected, "del l[%s:%s]" % (start, end))
+        finally:
+            l.destroy()
+
+    def test_negative_bounds(self):
+        for start, end in [(-15, sys.maxint), (-15, 3), (-4, sys.maxint), (-4, -1), (2, -3), (-20, -15), (3, -15)]:
+            for compact in (False, True):
+                self.check(start, end, compact)
+
+    def test_negative_bounds_loaded(self):
+        self.check(-15, sys.maxint, loaded=True)
+        self.check(-15, 3, loaded=True)
+
+    def test_positive_bounds(self):
+        for start, end in [(0, sys.maxint), (1, 2), (3, 100), (8, 2)]:
+            self.check(start, end)
+
+    def test_literal_slice(self):
+        l = RedisList(range(11), node="test")
+        try:
+            del l[-15:3]
+            self.assertEqual(l._load(), range(3, 11))
+            del l[-15:]
+            self.assertEqual(l._load(), [])
+        finally:
+            l.destroy()
+
+class EmptyPopTest(unittest.TestCase):
+    def test_pop_empty(self):
+        for compact in (False, True):
+            for indexed in (False, True):
+                l = RedisList([1], compact=compact, node="test", indexed=indexed)
+                try:
+                    self.assertEqual(l.pop(), 1)
+                    self.assertIsNone(l.pop())
+                    self.assertIsNone(l.lpop())
+                    self.assertEqual(l._load_objects_and_types(), ([], []))
+                finally:
+                    l.destroy()
+
+class FindTest(unittest.TestCase):
+    # the int 1 and the str "1" are stored alike, typed lists tell them apart by type
+    def check(self, items):
+        l = RedisList(items, node="test")
+        try:
+            self.assertEqual(l.index(1), items.index(1))
+            l.remove(1)
+            expected = list(items)
+            expected.remove(1)
+            self.assertEqual(l._load(), expected)
+        finally:
+            l.destroy()
+
+    def test_other_types_first(self):
+        self.check([1])
+        self.check(["1", "1", 0, "1", 1, "1", 1])
+
+    def test_candidates_far_apart(self):
+        self.check(["1"] + [0] * 1500 + ["1", 0, 1])
+
+    def test_more_candidates_than_a_chunk(self):
+        self.check(["1"] * 2500 + [1, "1"])
+
+class ScriptCacheTest(unittest.TestCase):
+    # the server loses its scripts, the calls and pipelines that get NOSCRIPT load them again
+    def setUp(self):
+        self.client = RedisClientPool.get_pool().get_client("test")
+        self.list = RedisList([1, 2, 3, 2], node="test", indexed=True)
+
+    def tearDown(self):
+        self.list.destroy()
+
+    def test_call(self):
+        self.client.script_flush()
+        self.assertEqual(self.list.index(2), 1)
+
+    def test_pipeline(self):
+        self.client.script_flush()
+        self.assertEqual(self.list.pop(), 2)
+        self.assertEqual(self.list._load(), [1, 2, 3])
+
+if __name__ == "__main__":
+    unittest.main()
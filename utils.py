@@ -1,20 +1,56 @@
 import redis
 import json
+import threading
+import sys
+import time
+import itertools
+from batch import current_batch, reads_pinned
+from scripts import load_scripts
+from instrument import InstrumentedRedis, enable_instrumentation, disable_instrumentation, \
+    instrumentation_enabled, add_sink, remove_sink
 
-DEBUG = False
+ALLOC_PREFIX = "_alloc_"
+ADDR_BLOCK_SIZE = 1000
+
+# node settings passed on to the redis connections
+CONNECTION_OPTIONS = ["password", "socket_timeout", "socket_connect_timeout", "socket_keepalive",
+                      "socket_keepalive_options", "retry_on_timeout", "health_check_interval"]
+# these have no meaning for unix domain sockets
+TCP_ONLY_OPTIONS = ["socket_connect_timeout", "socket_keepalive", "socket_keepalive_options"]
+DEFAULT_POOL_TIMEOUT = 20   # seconds a thread waits for a free connection
+
+READ_POLICIES = ["primary", "round_robin", "least_latency"]
+LATENCY_REFRESH = 5.0       # seconds between latency measurements of the replicas
+DEFAULT_BULK_CHUNK_SIZE = 1000
+BULK_CHUNK_SIZE = DEFAULT_BULK_CHUNK_SIZE   # items per variadic RPUSH/SADD/HSET of bulk writes
+
+def print_commands(event):
+    # the debug sink, prints each command sent to redis
+    if event["kind"] == "round_trip":
+        for command in event["commands"]:
+            print "Calling command %s of redis client %s" % (command.lower(), event["node"])
+
+_debug_enabled_instrumentation = False
 
 def enable_debug():
-    global DEBUG
-    DEBUG = True
+    global _debug_enabled_instrumentation
+    add_sink(print_commands)
+    if not instrumentation_enabled():
+        _debug_enabled_instrumentation = True
+        enable_instrumentation()
 
 def disable_debug():
-    global DEBUG
-    DEBUG = False
+    global _debug_enabled_instrumentation
+    remove_sink(print_commands)
+    if _debug_enabled_instrumentation:
+        _debug_enabled_instrumentation = False
+        disable_instrumentation()
 
 class RedisClientPool(object):
     singleton = None
     def __init__(self):
         self.clients = {}
+        self.allocators = {}
         self.names = []
     
     @classmethod
@@ -29,6 +65,14 @@ class RedisClientPool(object):
             "redis1": {"host":"192.168.1.1", "port":3279, "db":0},
             "redis2": {"host":"192.168.1.2", "port":3279, "db":0}
         }
+        A node may also set "addr_block_size", the number of object addresses
+        reserved at a time (default ADDR_BLOCK_SIZE), "unix_socket_path" to connect
+        through a unix domain socket instead of host and port, and any of
+        CONNECTION_OPTIONS. With "max_connections", threads wait up to
+        "pool_timeout" seconds for a free connection once that many are open.
+        A node may list "replicas", each a dict with its own "host" and "port" (or
+        "unix_socket_path") and the node's other settings by default. Reads are
+        then spread over the replicas by "read_policy", see ReadRouter.
         """
         if isinstance(config, basestring):
             try:
@@ -41,24 +85,212 @@ class RedisClientPool(object):
             raise Exception("Invalid config passed to load_config")
         for k in config:
             v = config[k]
-            self.clients[k] = RedisClient(v["host"], v["port"], v["db"])
-            self.clients[k].ping()
+            self.clients[k] = RedisClient(v.get("host"), v.get("port"), v["db"], name=k,
+                                          pool=make_connection_pool(v))
+            load_scripts(self.clients[k])
+            if v.get("replicas"):
+                self.clients[k].router = self._make_router(k, v)
+            self.allocators[k] = AddressAllocator(k, self.clients[k],
+                                                  v.get("addr_block_size", ADDR_BLOCK_SIZE))
             self.names.append(k)
 
+    def _make_router(self, name, node_config):
+        replicas = []
+        for replica_config in node_config["replicas"]:
+            config = dict(node_config)
+            config.pop("unix_socket_path", None)
+            config.update(replica_config)
+            replica = RedisClient(config.get("host"), config.get("port"), config["db"], name=name,
+                                  pool=make_connection_pool(config))
+            load_scripts(replica)
+            replicas.append(replica)
+        return ReadRouter(self.clients[name], replicas, node_config.get("read_policy", "round_robin"),
+                          node_config.get("read_your_writes", 0))
+
     def get_client(self, name):
         if name not in self.clients:
             raise InvalidRedisClientName()
         return self.clients[name]
 
+    def get_allocator(self, name):
+        if name not in self.allocators:
+            raise InvalidRedisClientName()
+        return self.allocators[name]
+
+def set_bulk_chunk_size(size):
+    """ The number of items sent per command by bulk writes (extend, update,
+    constructors), larger chunks save round trips but block the server longer
+    """
+    global BULK_CHUNK_SIZE
+    if size < 1:
+        raise ValueError("chunk size must be positive")
+    BULK_CHUNK_SIZE = size
+
+def chunked(iterable, size=None):
+    # lists of at most size items (BULK_CHUNK_SIZE by default), iterable is consumed lazily
+    it = iter(iterable)
+    size = size or BULK_CHUNK_SIZE
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+def base36(n):
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    s = ""
+    while True:
+        n, r = divmod(n, 36)
+        s = digits[r] + s
+        if not n:
+            return s
+
+class AddressAllocator(object):
+    """ Hands out object addresses on a node. Ids are reserved block_size at a
+    time with INCRBY on a counter kept on the node, so creating objects costs one
+    round trip per block instead of one per object. Addresses look like
+    "redis1:o-1k3", the "-" keeps them apart from the random keys used before.
+    """
+    def __init__(self, node, client, block_size=ADDR_BLOCK_SIZE):
+        self.node = node
+        self.client = client
+        self.block_size = block_size
+        self.next_id = self.limit = 0
+        self.lock = threading.Lock()
+
+    def allocate(self):
+        with self.lock:
+            if self.next_id >= self.limit:
+                self.limit = self.client.incrby(ALLOC_PREFIX + self.node, self.block_size)
+                self.next_id = self.limit - self.block_size
+            self.next_id += 1
+            return "%s:o-%s" % (self.node, base36(self.next_id))
+
+def make_connection_pool(node_config):
+    # the connection pool for a node's config, see RedisClientPool.load_config
+    kwargs = dict((k, node_config[k]) for k in CONNECTION_OPTIONS if k in node_config)
+    kwargs["db"] = node_config["db"]
+    if "unix_socket_path" in node_config:
+        for k in TCP_ONLY_OPTIONS:
+            kwargs.pop(k, None)
+        kwargs["path"] = node_config["unix_socket_path"]
+        kwargs["connection_class"] = redis.UnixDomainSocketConnection
+    else:
+        kwargs["host"] = node_config["host"]
+        kwargs["port"] = node_config["port"]
+    if node_config.get("max_connections"):
+        return redis.BlockingConnectionPool(max_connections=node_config["max_connections"],
+                                            timeout=node_config.get("pool_timeout", DEFAULT_POOL_TIMEOUT),
+                                            **kwargs)
+    return redis.ConnectionPool(**kwargs)
+
+class ReadRouter(object):
+    """ Picks the client that reads of a node's objects go to, by read policy:
+    "primary" reads from the primary only, "round_robin" takes the replicas in
+    turn and "least_latency" the replica with the lowest PING time, measured
+    every LATENCY_REFRESH seconds in the background.
+    Inside batch(), while a lock is held and inside primary_reads(), reads go to
+    the primary. With read_your_writes set, reads of an object this process
+    changed in the last read_your_writes seconds also go to the primary.
+    """
+    def __init__(self, primary, replicas, policy="round_robin", read_your_writes=0):
+        if policy not in READ_POLICIES:
+            raise ConfigReadError("Unknown read policy %s" % policy)
+        self.primary = primary
+        self.replicas = replicas
+        self.policy = policy
+        self.read_your_writes = read_your_writes
+        self.recent_writes = {}
+        self.rotation = itertools.cycle(replicas)
+        self.latencies = [0.0] * len(replicas)
+        self.measured_at = 0
+        self.measuring = None
+
+    def record_write(self, addr):
+        if not self.read_your_writes:
+            return
+        now = time.time()
+        if len(self.recent_writes) > 10000:
+            self.recent_writes = dict((a, t) for a, t in self.recent_writes.items() if t > now)
+        self.recent_writes[addr] = now + self.read_your_writes
+
+    def reader(self, addr=None):
+        if self.policy == "primary" or reads_pinned():
+            return self.primary
+        if addr is not None and self.recent_writes.get(addr, 0) > time.time():
+            return self.primary
+        if self.policy == "round_robin":
+            return next(self.rotation)
+        if time.time() - self.measured_at > LATENCY_REFRESH and self.measuring is None:
+            self.measuring = BackgroundCall(self.measure_latencies)
+        return self.replicas[self.latencies.index(min(self.latencies))]
+
+    def measure_latencies(self):
+        latencies = []
+        for replica in self.replicas:
+            start = time.time()
+            try:
+                replica.client.ping()
+                latencies.append(time.time() - start)
+            except redis.RedisError:
+                latencies.append(float("inf"))
+        self.latencies = latencies
+        self.measured_at = time.time()
+        self.measuring = None
+
 class RedisClient(object): # A wrapper of redis client for debugging, etc
-    def __init__(self, host, port, db):
-        self.client = redis.StrictRedis(host=host, port=port, db=db)
+    router = None
+
+    def __init__(self, host, port, db, name=None, pool=None):
+        if pool is not None:
+            self.client = InstrumentedRedis(node=name, connection_pool=pool)
+        else:
+            self.client = InstrumentedRedis(node=name, host=host, port=port, db=db)
+        self.name = name
+
+    def reader(self, addr=None):
+        # the client to read the object at addr from, a replica if there are any
+        if self.router is None:
+            return self
+        return self.router.reader(addr)
+
+    def record_write(self, addr):
+        if self.router is not None:
+            self.router.record_write(addr)
 
     def __getattr__(self, attr):
-        if DEBUG:
-            print "Calling command %s of redis client"%attr
+        batch = current_batch()
+        if batch and not batch.transaction and batch.has_pending(self.name):
+            # a command that is sent right away has to see the writes buffered before it
+            batch.flush_node(self.name)
         return getattr(self.client, attr)
         
+class BackgroundCall(threading.Thread):
+    """ Runs func(*args) in a daemon thread, so a round trip can overlap with
+    work done by the caller. result() waits for the call and returns its value,
+    re-raising any exception in the calling thread.
+    """
+    def __init__(self, func, *args):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.func = func
+        self.args = args
+        self.value = None
+        self.exc_info = None
+        self.start()
+
+    def run(self):
+        try:
+            self.value = self.func(*self.args)
+        except:
+            self.exc_info = sys.exc_info()
+
+    def result(self):
+        self.join()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
 class ConfigReadError(Exception):
     """Raised when failed to read or parse config file"""
 
@@ -71,5 +303,11 @@ class RedisOperationFailure(Exception):
 class RedisNestedTypeError(Exception):
     """Raised when a nested type within dbase is neither atomic type or a dbase type"""
     
+class LockTimeout(Exception):
+    """Raised when a lock couldn't be acquired in time"""
+
+class CodecInUse(Exception):
+    """Raised when the codec is switched after dmem objects were created or read"""
+
 class InvalidRedisClientName(Exception):
     """Raised when the redis client of that name is not found"""